@@ -0,0 +1,187 @@
+import argparse
+import json
+import statistics
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import torch
+
+from main import (
+    build_pipeline,
+    create_cpu_options,
+    generate,
+    parse_args,
+    preflight,
+    select_device,
+)
+from schedulers import PRESETS, get_preset
+
+
+DEFAULT_PROMPTS = [
+    "a wooden treasure chest on a beach, studio lighting",
+    "logo of a rocket launching into space, flat vector",
+]
+DEFAULT_SEEDS = [1234, 5678]
+DEFAULT_STEPS = [1, 2, 4, 8, 12, 20, 30]
+
+
+def psnr(image: object, reference: object) -> float:
+    a = np.asarray(image, dtype=np.float64)
+    b = np.asarray(reference, dtype=np.float64)
+    mse = float(np.mean((a - b) ** 2))
+    return 100.0 if mse == 0.0 else 10.0 * np.log10(255.0**2 / mse)
+
+
+def sample(
+    pipe: object, args: argparse.Namespace, device: str, preset: str, steps: int, guidance: float
+) -> tuple[list[object], float]:
+    settings = get_preset(preset)
+    run_args = argparse.Namespace(**vars(args))
+    run_args.sampler_name = settings.sampler_name
+    run_args.scheduler = settings.scheduler
+    run_args.steps = steps
+    run_args.guidance_scale = guidance
+    run_args.positive_prompts = [prompt for prompt in args.prompts for _ in args.seed_list]
+    run_args.negative_prompts = [args.negative for _ in run_args.positive_prompts]
+    run_args.seeds = [seed for _ in args.prompts for seed in args.seed_list]
+    run_args.batch_size = len(run_args.seeds)
+    if device == "cuda":
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    images, _ = generate(pipe, run_args, device, "", "")
+    if device == "cuda":
+        torch.cuda.synchronize()
+    return images, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=(
+            "Steps-to-quality and latency of each scheduler preset on one warm pipeline. "
+            "Quality is PSNR against a high-step reference rendered with the same prompts and seeds."
+        )
+    )
+    parser.add_argument("--base-model", default=None, help="Checkpoint, as for main.py.")
+    parser.add_argument("--lora", default=None, help="LoRA, as for main.py ('none' to disable).")
+    parser.add_argument("--lora-weight", default=None)
+    parser.add_argument("--device", default="auto", choices=["auto", "mps", "cuda", "cpu"])
+    parser.add_argument("--height", type=int, default=1024)
+    parser.add_argument("--width", type=int, default=1024)
+    parser.add_argument(
+        "--presets", nargs="+", choices=sorted(PRESETS), default=sorted(PRESETS)
+    )
+    parser.add_argument("--steps", nargs="+", type=int, default=DEFAULT_STEPS)
+    parser.add_argument("--prompts", nargs="+", default=DEFAULT_PROMPTS)
+    parser.add_argument("--negative", default="blurry, deformed, watermark")
+    parser.add_argument("--seeds", nargs="+", type=int, default=DEFAULT_SEEDS)
+    parser.add_argument("--repeats", type=int, default=2, help="Timed runs per point (median).")
+    parser.add_argument(
+        "--reference-preset",
+        choices=sorted(PRESETS),
+        default=None,
+        help="Preset rendering the reference. Defaults to each preset's own sampler.",
+    )
+    parser.add_argument("--reference-steps", type=int, default=50)
+    parser.add_argument(
+        "--target-psnr",
+        type=float,
+        default=30.0,
+        help="PSNR (dB) against the reference that counts as converged.",
+    )
+    parser.add_argument("--output", default=None, help="Optional path for the JSON report.")
+    options = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="tti-schedulers-") as tmp:
+        config_path = Path(tmp) / "config.json"
+        config_path.write_text("{}", encoding="utf-8")
+        argv = ["--config", str(config_path), "--device", options.device]
+        for flag, value in (
+            ("--base-model", options.base_model),
+            ("--lora", options.lora),
+            ("--lora-weight", options.lora_weight),
+        ):
+            if value:
+                argv += [flag, value]
+        args = parse_args(argv + ["--height", str(options.height), "--width", str(options.width)])
+        base_model, loras, lora_repo_or_dir, lora_weight_name = preflight(args)
+        device, dtype = select_device(args.device)
+        pipe = build_pipeline(
+            base_model,
+            device,
+            dtype,
+            lora_repo_or_dir,
+            lora_weight_name,
+            loras,
+            cpu_options=create_cpu_options(args),
+        )
+        args.prompts = options.prompts
+        args.negative = options.negative
+        args.seed_list = options.seeds
+
+        references: dict[str, list[object]] = {}
+        report: dict[str, object] = {
+            "base_model": base_model,
+            "device": device,
+            "dtype": str(dtype),
+            "height": options.height,
+            "width": options.width,
+            "images_per_run": len(options.prompts) * len(options.seeds),
+            "reference_steps": options.reference_steps,
+            "target_psnr": options.target_psnr,
+            "presets": {},
+        }
+        for preset in options.presets:
+            settings = get_preset(preset)
+            reference_preset = options.reference_preset or preset
+            if reference_preset not in references:
+                reference = get_preset(reference_preset)
+                references[reference_preset], _ = sample(
+                    pipe,
+                    args,
+                    device,
+                    reference_preset,
+                    options.reference_steps,
+                    reference.guidance_scale,
+                )
+            points = []
+            for steps in sorted(set(options.steps) | {settings.steps}):
+                # The first call warms the swapped scheduler and any lazy kernels.
+                images, _ = sample(pipe, args, device, preset, steps, settings.guidance_scale)
+                latencies = [
+                    sample(pipe, args, device, preset, steps, settings.guidance_scale)[1]
+                    for _ in range(options.repeats)
+                ]
+                quality = statistics.mean(
+                    psnr(image, reference)
+                    for image, reference in zip(images, references[reference_preset])
+                )
+                points.append(
+                    {
+                        "steps": steps,
+                        "latency_s": round(statistics.median(latencies), 4),
+                        "psnr_db": round(quality, 3),
+                    }
+                )
+                print(json.dumps({"event": "scheduler_point", "preset": preset, **points[-1]}))
+            converged = [point for point in points if point["psnr_db"] >= options.target_psnr]
+            preset_point = next(point for point in points if point["steps"] == settings.steps)
+            report["presets"][preset] = {
+                **settings.as_dict(),
+                "reference": reference_preset,
+                "latency_s": preset_point["latency_s"],
+                "psnr_db": preset_point["psnr_db"],
+                "steps_to_quality": converged[0]["steps"] if converged else None,
+                "latency_to_quality_s": converged[0]["latency_s"] if converged else None,
+                "points": points,
+            }
+
+    print(json.dumps(report, indent=2))
+    if options.output:
+        with open(options.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,376 @@
+import argparse
+import itertools
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from pathlib import Path
+
+import torch
+from diffusers import (
+    AutoencoderKL,
+    EulerDiscreteScheduler,
+    StableDiffusionXLPipeline,
+    UNet2DConditionModel,
+)
+from transformers import (
+    CLIPTextConfig,
+    CLIPTextModel,
+    CLIPTextModelWithProjection,
+    CLIPTokenizer,
+)
+
+
+DEFAULT_RESOLUTIONS = ["256x256", "512x512"]
+DEFAULT_BATCH_SIZES = [1, 2]
+LORA_WEIGHT_NAME = "tiny_lora.safetensors"
+
+# CPU configurations that can be compared in one report. "fp32" is the plain path
+# and keeps the original case names so existing baselines stay comparable.
+CPU_PRESETS = {
+    "fp32": ["--cpu-mode", "default"],
+    "optimized": ["--cpu-mode", "optimized"],
+    "optimized-int8": ["--cpu-mode", "optimized", "--cpu-quantize-text-encoders"],
+}
+
+# Metrics compared against the baseline. Values are medians over --repeats runs.
+METRICS = (
+    "cold_load_s",
+    "lora_fuse_s",
+    "text_encode_s",
+    "step_s",
+    "vae_decode_s",
+    "png_encode_s",
+    "total_s",
+    "peak_rss_bytes",
+)
+# Differences below these floors are treated as noise regardless of the ratio.
+ABSOLUTE_FLOORS = {"peak_rss_bytes": 32 * 1024 * 1024}
+DEFAULT_FLOOR_S = 0.005
+
+
+def write_tokenizer(path: Path) -> CLIPTokenizer:
+    # A byte-level vocabulary with no merges: every byte is its own token, which is
+    # all a randomly initialised text encoder needs and avoids any download.
+    from transformers.models.clip.tokenization_clip import bytes_to_unicode
+
+    path.mkdir(parents=True, exist_ok=True)
+    vocab = {"<|startoftext|>": 0, "<|endoftext|>": 1}
+    for char in bytes_to_unicode().values():
+        vocab.setdefault(char, len(vocab))
+        vocab.setdefault(f"{char}</w>", len(vocab))
+    with (path / "vocab.json").open("w", encoding="utf-8") as f:
+        json.dump(vocab, f)
+    (path / "merges.txt").write_text("#version: 0.2\n", encoding="utf-8")
+    return CLIPTokenizer(
+        str(path / "vocab.json"), str(path / "merges.txt"), model_max_length=77
+    )
+
+
+def build_tiny_sdxl(root: Path, seed: int = 0) -> tuple[Path, Path]:
+    """
+    Saves a randomly initialised SDXL-shaped pipeline and a matching LoRA under root.
+
+    Every component has the SDXL structure (two CLIP text encoders, text-time
+    conditioned UNet, 8x VAE) at a fraction of the width, so the benchmark walks
+    the same diffusers code paths as the real checkpoint.
+    """
+    torch.manual_seed(seed)
+    unet = UNet2DConditionModel(
+        block_out_channels=(32, 64),
+        layers_per_block=2,
+        sample_size=32,
+        in_channels=4,
+        out_channels=4,
+        down_block_types=("DownBlock2D", "CrossAttnDownBlock2D"),
+        up_block_types=("CrossAttnUpBlock2D", "UpBlock2D"),
+        attention_head_dim=(2, 4),
+        use_linear_projection=True,
+        addition_embed_type="text_time",
+        addition_time_embed_dim=8,
+        transformer_layers_per_block=(1, 2),
+        projection_class_embeddings_input_dim=80,  # 6 * addition_time_embed_dim + projection_dim
+        cross_attention_dim=64,
+    )
+    vae = AutoencoderKL(
+        block_out_channels=[32, 32, 32, 32],
+        in_channels=3,
+        out_channels=3,
+        down_block_types=["DownEncoderBlock2D"] * 4,
+        up_block_types=["UpDecoderBlock2D"] * 4,
+        latent_channels=4,
+        layers_per_block=1,
+        sample_size=128,
+    )
+    scheduler = EulerDiscreteScheduler(
+        beta_start=0.00085,
+        beta_end=0.012,
+        steps_offset=1,
+        beta_schedule="scaled_linear",
+        timestep_spacing="leading",
+    )
+    encoder_config = CLIPTextConfig(
+        bos_token_id=0,
+        eos_token_id=1,
+        pad_token_id=1,
+        hidden_size=32,
+        intermediate_size=37,
+        layer_norm_eps=1e-05,
+        num_attention_heads=4,
+        num_hidden_layers=5,
+        vocab_size=1000,
+        hidden_act="gelu",
+        projection_dim=32,
+    )
+    tokenizer = write_tokenizer(root / "tokenizer-src")
+    pipe = StableDiffusionXLPipeline(
+        vae=vae,
+        text_encoder=CLIPTextModel(encoder_config),
+        text_encoder_2=CLIPTextModelWithProjection(encoder_config),
+        tokenizer=tokenizer,
+        tokenizer_2=tokenizer,
+        unet=unet,
+        scheduler=scheduler,
+    )
+    model_dir = root / "tiny-sdxl"
+    pipe.save_pretrained(model_dir, safe_serialization=True)
+
+    from peft import LoraConfig
+    from peft.utils import get_peft_model_state_dict
+
+    pipe.unet.add_adapter(
+        LoraConfig(
+            r=4,
+            lora_alpha=4,
+            init_lora_weights=False,
+            target_modules=["to_q", "to_k", "to_v", "to_out.0"],
+        )
+    )
+    lora_dir = root / "loras"
+    StableDiffusionXLPipeline.save_lora_weights(
+        save_directory=str(lora_dir),
+        unet_lora_layers=get_peft_model_state_dict(pipe.unet),
+        weight_name=LORA_WEIGHT_NAME,
+        safe_serialization=True,
+    )
+    return model_dir, lora_dir / LORA_WEIGHT_NAME
+
+
+def run_case(
+    model_dir: str,
+    lora_path: str,
+    height: int,
+    width: int,
+    batch_size: int,
+    steps: int,
+    workdir: str,
+    extra_args: list[str] | None = None,
+) -> dict[str, float]:
+    """Runs one generation through main.run() and reduces its trace to benchmark metrics."""
+    from main import parse_args, run
+
+    work = Path(workdir)
+    config_path = work / "config.json"
+    trace_path = work / "trace.jsonl"
+    config = {
+        "base_model": model_dir,
+        "loras": [{"path": lora_path, "weight": 1.0}],
+        "steps": steps,
+        "guidance_scale": 5.0,
+        "seed": 1234,
+        "latent": {"height": height, "width": width, "batch_size": batch_size},
+        "prompt": {"positive": "a wooden treasure chest", "negative": "blurry"},
+        "output_dir": str(work / "outputs"),
+        "filename_prefix": "bench",
+    }
+    config_path.write_text(json.dumps(config), encoding="utf-8")
+    run(
+        parse_args(
+            [
+                "--config",
+                str(config_path),
+                "--device",
+                "cpu",
+                "--prompt-cache-size",
+                "0",
+                "--model-cache-dir",
+                "none",
+                "--trace-file",
+                str(trace_path),
+                *(extra_args or []),
+            ]
+        )
+    )
+
+    with trace_path.open("r", encoding="utf-8") as f:
+        record = json.loads(f.readlines()[-1])
+    stages = record["stages"]
+
+    def wall(*names: str) -> float:
+        return sum(float(stages[name]["wall_s"]) for name in names if name in stages)
+
+    return {
+        "cold_load_s": wall("load_checkpoint", "to_device"),
+        "lora_fuse_s": wall("lora"),
+        "text_encode_s": wall("text_encode"),
+        "step_s": wall("denoise") / max(steps, 1),
+        "vae_decode_s": wall("vae_decode"),
+        "png_encode_s": wall("save"),
+        "total_s": float(record["total_s"]),
+        "peak_rss_bytes": max(
+            int(entry["max_rss_bytes"] or 0) for entry in stages.values()
+        ),
+    }
+
+
+def compare_presets(report: dict[str, object]) -> dict[str, dict[str, float]]:
+    """Ratios of each non-fp32 preset against the fp32 case with the same shape."""
+    cases = dict(report["cases"])
+    comparison: dict[str, dict[str, float]] = {}
+    for case, metrics in cases.items():
+        shape, _, preset = case.partition("_cpu-")
+        reference = cases.get(shape)
+        if not preset or not reference:
+            continue
+        comparison[case] = {
+            "total_speedup": round(reference["total_s"] / max(metrics["total_s"], 1e-9), 3),
+            "step_speedup": round(reference["step_s"] / max(metrics["step_s"], 1e-9), 3),
+            "text_encode_speedup": round(
+                reference["text_encode_s"] / max(metrics["text_encode_s"], 1e-9), 3
+            ),
+            "peak_rss_ratio": round(metrics["peak_rss_bytes"] / max(reference["peak_rss_bytes"], 1), 3),
+        }
+    return comparison
+
+
+def compare(
+    report: dict[str, object], baseline: dict[str, object], threshold: float
+) -> list[str]:
+    regressions: list[str] = []
+    for case, metrics in dict(report["cases"]).items():
+        reference = dict(baseline.get("cases", {})).get(case)
+        if not reference:
+            continue
+        for metric in METRICS:
+            if metric not in metrics or metric not in reference:
+                continue
+            current, previous = float(metrics[metric]), float(reference[metric])
+            floor = ABSOLUTE_FLOORS.get(metric, DEFAULT_FLOOR_S)
+            if current > previous * (1.0 + threshold) and current - previous > floor:
+                regressions.append(
+                    f"{case} {metric}: {previous:.4g} -> {current:.4g} "
+                    f"(+{(current / max(previous, 1e-12) - 1.0) * 100:.1f}%)"
+                )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the SDXL service code paths on CPU with a tiny random model."
+    )
+    parser.add_argument("--resolutions", nargs="+", default=DEFAULT_RESOLUTIONS, help="HxW sizes.")
+    parser.add_argument("--batch-sizes", nargs="+", type=int, default=DEFAULT_BATCH_SIZES)
+    parser.add_argument("--steps", type=int, default=4)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--threads", type=int, default=None, help="torch CPU threads per run.")
+    parser.add_argument(
+        "--cpu-presets",
+        nargs="+",
+        choices=sorted(CPU_PRESETS),
+        default=["fp32"],
+        help="CPU configurations to run; add 'optimized' to compare it against 'fp32'.",
+    )
+    parser.add_argument("--output", default=None, help="Optional path for the JSON report.")
+    parser.add_argument("--baseline", default=None, help="Baseline JSON to compare against.")
+    parser.add_argument(
+        "--write-baseline", action="store_true", help="Write the report to --baseline instead of comparing."
+    )
+    parser.add_argument(
+        "--threshold", type=float, default=0.2, help="Allowed slowdown before failing (0.2 = 20%%)."
+    )
+    args = parser.parse_args()
+
+    if args.threads:
+        os.environ["OMP_NUM_THREADS"] = str(args.threads)
+
+    with tempfile.TemporaryDirectory(prefix="tti-bench-") as tmp:
+        root = Path(tmp)
+        model_dir, lora_path = build_tiny_sdxl(root)
+        report: dict[str, object] = {
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "machine": platform.machine(),
+            "cpu_count": os.cpu_count(),
+            "threads": args.threads,
+            "cpu_presets": args.cpu_presets,
+            "steps": args.steps,
+            "repeats": args.repeats,
+            "cases": {},
+        }
+
+        spawn = get_context("spawn")
+        for resolution in args.resolutions:
+            height, width = (int(value) for value in resolution.lower().split("x"))
+            for batch_size, preset in itertools.product(args.batch_sizes, args.cpu_presets):
+                case = f"{height}x{width}_b{batch_size}"
+                if preset != "fp32":
+                    case = f"{case}_cpu-{preset}"
+                extra_args = list(CPU_PRESETS[preset])
+                if args.threads:
+                    extra_args += ["--cpu-threads", str(args.threads)]
+                samples: list[dict[str, float]] = []
+                for repeat in range(args.repeats):
+                    workdir = root / case / str(repeat)
+                    workdir.mkdir(parents=True)
+                    # A fresh process per run keeps the load cold and the RSS peak per case.
+                    with ProcessPoolExecutor(max_workers=1, mp_context=spawn) as pool:
+                        samples.append(
+                            pool.submit(
+                                run_case,
+                                str(model_dir),
+                                str(lora_path),
+                                height,
+                                width,
+                                batch_size,
+                                args.steps,
+                                str(workdir),
+                                extra_args,
+                            ).result()
+                        )
+                report["cases"][case] = {
+                    metric: round(statistics.median(sample[metric] for sample in samples), 5)
+                    for metric in METRICS
+                }
+        comparison = compare_presets(report)
+        if comparison:
+            report["cpu_comparison"] = comparison
+
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+    if not args.baseline:
+        return
+    if args.write_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"Baseline written to {args.baseline}")
+        return
+    with open(args.baseline, "r", encoding="utf-8") as f:
+        baseline = json.load(f)
+    regressions = compare(report, baseline, args.threshold)
+    if regressions:
+        print("Regressions over the baseline:")
+        for line in regressions:
+            print(f"  {line}")
+        sys.exit(1)
+    print(f"No regressions above {args.threshold * 100:.0f}% against {args.baseline}")
+
+
+if __name__ == "__main__":
+    main()
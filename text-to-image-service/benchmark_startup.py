@@ -0,0 +1,120 @@
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+
+ROOT_DIR = Path(__file__).resolve().parent
+
+# Modules that must not be imported until a pipeline is actually needed.
+HEAVY_MODULES = ("torch", "diffusers", "transformers", "safetensors", "accelerate", "peft")
+
+ENTRYPOINTS = ("main", "main_aws", "main_mac")
+
+
+def import_profile(module: str) -> dict[str, object]:
+    """Imports `module` under `python -X importtime` and summarises the report."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=ROOT_DIR,
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"import {module} failed:\n{result.stderr}")
+
+    # Lines look like: "import time:       120 |        340 |   package.module"
+    entries: list[tuple[str, int, int]] = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        parts = line[len("import time:") :].split("|")
+        if len(parts) != 3:
+            continue
+        entries.append((parts[2].strip(), int(parts[0]), int(parts[1])))
+
+    imported = {name.split(".")[0] for name, _, _ in entries}
+    top_level = [entry for entry in entries if entry[0] == module]
+    total_us = top_level[-1][2] if top_level else sum(self_us for _, self_us, _ in entries)
+    slowest = sorted(entries, key=lambda entry: entry[1], reverse=True)[:10]
+    return {
+        "import_ms": round(total_us / 1000.0, 2),
+        "heavy_imported": sorted(imported.intersection(HEAVY_MODULES)),
+        "slowest_self_ms": {name: round(self_us / 1000.0, 2) for name, self_us, _ in slowest},
+    }
+
+
+def command_ms(args: list[str], repeats: int) -> tuple[float, int]:
+    samples: list[float] = []
+    returncode = 0
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = subprocess.run(
+            [sys.executable, *args], cwd=ROOT_DIR, capture_output=True, text=True
+        )
+        samples.append((time.perf_counter() - start) * 1000.0)
+        returncode = result.returncode
+    return round(statistics.median(samples), 2), returncode
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Check that CLI startup and pre-flight validation stay free of heavy imports."
+    )
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument(
+        "--budget-ms",
+        type=float,
+        default=1000.0,
+        help="Slowest allowed median wall time for --help and for rejecting bad input.",
+    )
+    parser.add_argument("--output", default=None, help="Optional path for the JSON report.")
+    args = parser.parse_args()
+
+    report: dict[str, object] = {"python": sys.version.split()[0], "imports": {}, "commands": {}}
+    failures: list[str] = []
+
+    for module in ENTRYPOINTS:
+        profile = import_profile(module)
+        report["imports"][module] = profile
+        if profile["heavy_imported"]:
+            failures.append(f"import {module} pulls in {', '.join(profile['heavy_imported'])}")
+
+    with tempfile.TemporaryDirectory(prefix="tti-startup-") as tmp:
+        missing = str(Path(tmp) / "does-not-exist")
+        missing_model_config = Path(tmp) / "missing_model.json"
+        missing_model_config.write_text(json.dumps({"base_model": missing}), encoding="utf-8")
+        commands = {
+            "help": (["main.py", "--help"], 0),
+            "help_aws": (["main_aws.py", "--help"], 0),
+            "help_mac": (["main_mac.py", "--help"], 0),
+            "bad_config": (["main.py", "--config", f"{missing}.json"], 1),
+            "missing_checkpoint": (["main.py", "--config", str(missing_model_config)], 1),
+        }
+        for name, (command, expected) in commands.items():
+            elapsed_ms, returncode = command_ms(command, args.repeats)
+            report["commands"][name] = {"ms": elapsed_ms, "returncode": returncode}
+            if (returncode == 0) != (expected == 0):
+                failures.append(f"{name}: exit code {returncode}, expected {expected}")
+            if elapsed_ms > args.budget_ms:
+                failures.append(
+                    f"{name}: {elapsed_ms:.0f} ms exceeds the {args.budget_ms:.0f} ms budget"
+                )
+
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    if failures:
+        print("Startup checks failed:")
+        for line in failures:
+            print(f"  {line}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+import contextlib
+from dataclasses import dataclass
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from diffusers import StableDiffusionXLPipeline
+
+
+CPU_MODES = ("default", "optimized")
+BF16_CHOICES = ("auto", "on", "off")
+
+_threads_configured = False
+
+
+@dataclass(frozen=True)
+class CPUOptions:
+    """
+    Tuning applied when a pipeline runs on the CPU.
+
+    The `default` mode is the plain fp32 path. `optimized` enables bf16 autocast
+    (`auto`: only when the CPU has native bf16 support), channels-last UNet/VAE
+    weights and attention slicing. Dynamic int8 quantization of the text encoders
+    is opt-in in both modes because it slightly changes the prompt embeddings.
+    Thread counts of 0 keep torch's defaults.
+    """
+
+    threads: int = 0
+    interop_threads: int = 0
+    bf16: str = "off"
+    channels_last: bool = False
+    attention_slicing: bool = False
+    quantize_text_encoders: bool = False
+
+
+def cpu_options(
+    mode: str = "default",
+    threads: int | None = None,
+    interop_threads: int | None = None,
+    bf16: str | None = None,
+    channels_last: bool | None = None,
+    attention_slicing: bool | None = None,
+    quantize_text_encoders: bool | None = None,
+) -> CPUOptions:
+    """Builds the options for `mode`; every argument left as None keeps the mode's default."""
+    if mode not in CPU_MODES:
+        raise RuntimeError(f"Unknown cpu mode {mode!r}; expected one of {', '.join(CPU_MODES)}")
+    if bf16 is not None and bf16 not in BF16_CHOICES:
+        raise RuntimeError(f"Unknown cpu bf16 setting {bf16!r}; expected one of {', '.join(BF16_CHOICES)}")
+    optimized = mode == "optimized"
+
+    def pick(value: object, default: object) -> object:
+        return default if value is None else value
+
+    return CPUOptions(
+        threads=max(int(pick(threads, 0)), 0),
+        interop_threads=max(int(pick(interop_threads, 0)), 0),
+        bf16=str(pick(bf16, "auto" if optimized else "off")),
+        channels_last=bool(pick(channels_last, optimized)),
+        attention_slicing=bool(pick(attention_slicing, optimized)),
+        quantize_text_encoders=bool(pick(quantize_text_encoders, False)),
+    )
+
+
+def bf16_supported() -> bool:
+    import torch
+
+    try:
+        # oneDNN knows whether the CPU has AVX512-BF16/AMX; without them bf16 is
+        # emulated and slower than fp32.
+        return bool(torch.ops.mkldnn._is_mkldnn_bf16_supported())
+    except (AttributeError, RuntimeError):
+        pass
+    try:
+        with open("/proc/cpuinfo", "r", encoding="utf-8") as f:
+            flags = f.read()
+    except OSError:
+        return False
+    return "avx512_bf16" in flags or "amx_bf16" in flags
+
+
+def use_bf16(options: CPUOptions) -> bool:
+    if options.bf16 == "on":
+        return True
+    if options.bf16 == "auto":
+        return bf16_supported()
+    return False
+
+
+def configure_threads(options: CPUOptions) -> tuple[int, int]:
+    """Applies the thread counts once per process and returns the ones in effect."""
+    global _threads_configured
+    import torch
+
+    if not _threads_configured:
+        _threads_configured = True
+        if options.threads > 0:
+            torch.set_num_threads(options.threads)
+        if options.interop_threads > 0:
+            try:
+                torch.set_num_interop_threads(options.interop_threads)
+            except RuntimeError as exc:
+                # Only allowed before the first inter-op parallel work in the process.
+                print(f"Could not set inter-op threads: {exc}")
+    return torch.get_num_threads(), torch.get_num_interop_threads()
+
+
+def quantize_text_encoders(pipe: "StableDiffusionXLPipeline") -> None:
+    import torch
+    from torch.ao.quantization import quantize_dynamic
+
+    for name in ("text_encoder", "text_encoder_2"):
+        encoder = getattr(pipe, name, None)
+        if encoder is None or getattr(encoder, "asset_quantized", False):
+            continue
+        # Weights become int8; activations are quantized per batch at run time.
+        quantize_dynamic(encoder, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+        encoder.asset_quantized = True
+
+
+def optimize_pipeline(pipe: "StableDiffusionXLPipeline", options: CPUOptions) -> None:
+    import torch
+
+    threads, interop_threads = configure_threads(options)
+    if options.channels_last:
+        pipe.unet.to(memory_format=torch.channels_last)
+        if getattr(pipe, "vae", None) is not None:
+            pipe.vae.to(memory_format=torch.channels_last)
+    if options.attention_slicing:
+        pipe.enable_attention_slicing()
+    if options.quantize_text_encoders:
+        quantize_text_encoders(pipe)
+    bf16 = use_bf16(options)
+    # Read by autocast() around each pipeline call and by PromptEmbeddingCache keys.
+    pipe.asset_autocast_dtype = torch.bfloat16 if bf16 else None
+    # Lets sampler-chain stages loaded later get the same treatment.
+    pipe.asset_cpu_options = options
+    print(
+        f"CPU inference: {threads} threads ({interop_threads} inter-op), "
+        f"bf16 autocast {'on' if bf16 else 'off'}, channels_last {options.channels_last}, "
+        f"attention slicing {options.attention_slicing}, "
+        f"int8 text encoders {options.quantize_text_encoders}"
+    )
+
+
+def autocast(pipe: object) -> contextlib.AbstractContextManager[None]:
+    dtype = getattr(pipe, "asset_autocast_dtype", None)
+    if dtype is None:
+        return contextlib.nullcontext()
+    import torch
+
+    return torch.autocast("cpu", dtype=dtype)
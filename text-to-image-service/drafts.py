@@ -0,0 +1,428 @@
+import argparse
+import json
+import os
+import time
+import uuid
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+import tracing
+from main import (
+    build_pipeline,
+    check_lora_compatibility,
+    check_sampling,
+    combine_loras,
+    create_cpu_options,
+    create_model_cache,
+    create_output_writer,
+    create_prompt_cache,
+    create_prompt_enhancer,
+    create_residency_manager,
+    create_step_monitor,
+    enhance_prompts,
+    expand_batch,
+    generate,
+    model_registry,
+    output_format,
+    prepare_args,
+    preflight,
+    print_configuration,
+    resolve_base_model,
+    resolve_prompts,
+    select_device,
+    stage_pipeline,
+)
+
+if TYPE_CHECKING:
+    import torch
+    from diffusers import StableDiffusionXLPipeline
+
+    from previews import StepMonitor
+    from prompt_cache import PromptEmbeddingCache
+
+
+MANIFEST_NAME = "draft.json"
+LATENTS_NAME = "latents.safetensors"
+# Draft sides are multiples of 64 so every UNet level divides evenly, and never
+# smaller than 256, below which SDXL stops producing a usable composition.
+DRAFT_MULTIPLE = 64
+MIN_DRAFT_SIDE = 256
+
+
+def draft_size(height: int, width: int, scale: float) -> tuple[int, int]:
+    def shrink(value: int) -> int:
+        scaled = int(round(value * scale / DRAFT_MULTIPLE)) * DRAFT_MULTIPLE
+        return min(value, max(MIN_DRAFT_SIDE, scaled))
+
+    return shrink(height), shrink(width)
+
+
+def draft_steps(args: argparse.Namespace) -> int:
+    if args.draft_steps:
+        return int(args.draft_steps)
+    # Few-step (Lightning/LCM) schedules are already as short as they go.
+    return args.steps if args.steps <= 8 else max(8, args.steps // 3)
+
+
+def upscale_latents(latents: "torch.Tensor", height: int, width: int) -> "torch.Tensor":
+    import torch.nn.functional as F
+
+    size = (height // 8, width // 8)
+    if tuple(latents.shape[-2:]) == size:
+        return latents
+    return F.interpolate(latents.float(), size=size, mode="bicubic", align_corners=False).to(
+        latents.dtype
+    )
+
+
+def read_manifest(path: str | Path) -> tuple[Path, dict[str, object]]:
+    session = Path(path)
+    if session.is_file():
+        session = session.parent
+    try:
+        with (session / MANIFEST_NAME).open("r", encoding="utf-8") as f:
+            manifest = json.load(f)
+    except OSError:
+        raise RuntimeError(f"No draft session at '{path}' ({MANIFEST_NAME} not found)")
+    except ValueError as exc:
+        raise RuntimeError(f"Draft manifest in '{session}' is not valid JSON: {exc}")
+    return session, manifest
+
+
+def write_manifest(session: Path, manifest: dict[str, object]) -> None:
+    tmp_path = session / f".{MANIFEST_NAME}.tmp"
+    with tmp_path.open("w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, session / MANIFEST_NAME)
+
+
+def render_drafts(
+    pipe: "StableDiffusionXLPipeline",
+    args: argparse.Namespace,
+    device: str,
+    positives: list[str],
+    negatives: list[str],
+    seeds: list[int],
+    prompt_cache: "PromptEmbeddingCache | None" = None,
+    monitor: "StepMonitor | None" = None,
+) -> tuple[list[object], list["torch.Tensor"]]:
+    """Renders one candidate per seed at draft size and returns the images with their latents."""
+    from cpu_inference import autocast
+    from workflow import decode_latents
+
+    draft = argparse.Namespace(**vars(args))
+    draft.height, draft.width = draft_size(args.height, args.width, args.draft_scale)
+    draft.steps = draft_steps(args)
+    draft.positive_prompts, draft.negative_prompts, draft.seeds = positives, negatives, seeds
+    draft.batch_size = len(seeds)
+    latents, _ = generate(
+        pipe, draft, device, "", "", prompt_cache, monitor, output_type="latent"
+    )
+    images = []
+    with autocast(pipe):
+        # One at a time: the decode peak stays that of a single draft.
+        for latent in latents:
+            images.extend(decode_latents(pipe, latent[None]))
+    return images, latents
+
+
+def finalize_latents(
+    pipe: "StableDiffusionXLPipeline",
+    args: argparse.Namespace,
+    device: str,
+    latents: "torch.Tensor",
+    positive: str,
+    negative: str,
+    seed: int,
+    prompt_cache: "PromptEmbeddingCache | None" = None,
+    monitor: "StepMonitor | None" = None,
+) -> list[object]:
+    """
+    Upscales a draft's latents to the full size and re-runs the last steps on them.
+
+    Only `finalize_strength` of the full steps run, starting from the draft's own
+    composition with the draft's seed, so the result is the approved draft with
+    full-resolution detail rather than a new image.
+    """
+    import torch
+    from cpu_inference import autocast
+    from schedulers import apply_scheduler
+
+    stage_pipe, _ = stage_pipeline(pipe, None)
+    apply_scheduler(
+        stage_pipe, getattr(args, "sampler_name", None), getattr(args, "scheduler", None)
+    )
+    tracing.instrument_pipeline(stage_pipe)
+    generator_device = device if device in {"cuda", "cpu"} else "cpu"
+    clip_skip = getattr(args, "clip_skip", None)
+    if prompt_cache is not None:
+        with autocast(pipe):
+            prompt_kwargs: dict[str, object] = prompt_cache.encode_batch(
+                pipe, [positive], [negative] if args.guidance_scale > 1.0 else None, clip_skip
+            )
+    else:
+        prompt_kwargs = {
+            "prompt": [positive],
+            "negative_prompt": [negative],
+            "clip_skip": clip_skip,
+        }
+    step_kwargs: dict[str, object] = {}
+    if monitor is not None:
+        monitor.begin(0)
+        step_kwargs = {
+            "callback_on_step_end": monitor,
+            "callback_on_step_end_tensor_inputs": ["latents"],
+        }
+    image = upscale_latents(latents[None], args.height, args.width)
+    with tracing.stage("denoise"), autocast(pipe):
+        return list(
+            stage_pipe(
+                **prompt_kwargs,
+                **step_kwargs,
+                image=image.to(dtype=pipe.unet.dtype),
+                strength=min(max(float(args.finalize_strength), 0.05), 1.0),
+                num_inference_steps=args.steps,
+                guidance_scale=args.guidance_scale,
+                generator=[torch.Generator(generator_device).manual_seed(seed)],
+            ).images
+        )
+
+
+def run_drafts(args: argparse.Namespace) -> None:
+    """
+    Renders `--draft N` cheap candidates for review and records how to finish each.
+
+    Every candidate's seed, prompts and denoised latents are written to a session
+    directory next to its preview image, together with the full-size request, so
+    `--finalize` can later render only the approved ones at full cost.
+    """
+    source_digest = model_registry().source_digest
+    from safetensors.torch import save_file
+
+    with tracing.trace_job(trace_file=args.trace_file) as trace:
+        base_model, loras, lora_repo_or_dir, lora_weight_name = preflight(args)
+        loras = combine_loras(loras, lora_repo_or_dir, lora_weight_name)
+        image_format = output_format(args)
+        device, dtype = select_device(args.device)
+        print_configuration(
+            args, device, dtype, base_model, loras, lora_repo_or_dir, lora_weight_name
+        )
+
+        positive, negative = resolve_prompts(args)
+        residency = create_residency_manager(args, device)
+        enhancer = create_prompt_enhancer(args, residency)
+        if enhancer is not None:
+            # The enhanced prompts are recorded per candidate, so finalizing reuses them.
+            positive, negative = enhance_prompts(args, enhancer, positive, negative)
+        counted = argparse.Namespace(**vars(args))
+        counted.batch_size = max(int(args.draft), 1)
+        positives, negatives, seeds = expand_batch(counted, positive, negative)
+        height, width = draft_size(args.height, args.width, args.draft_scale)
+        steps = draft_steps(args)
+        session_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:6]}"
+        session = Path(args.draft_dir or Path(args.output_dir) / "drafts") / session_id
+        session.mkdir(parents=True, exist_ok=True)
+        print(f"Rendering {len(seeds)} drafts at {height}x{width} with {steps} steps")
+
+        pipe = build_pipeline(
+            base_model=base_model,
+            device=device,
+            dtype=dtype,
+            lora_repo_or_dir=None,
+            lora_weight_name=None,
+            loras=loras,
+            model_cache=create_model_cache(args),
+            cpu_options=create_cpu_options(args),
+            residency=residency,
+        )
+        monitor = create_step_monitor(args, f"{args.filename_prefix}_draft")
+        images, latents = render_drafts(
+            pipe, args, device, positives, negatives, seeds, create_prompt_cache(args), monitor
+        )
+
+        writer = create_output_writer(args)
+        try:
+            with tracing.stage("save"):
+                paths = writer.submit(
+                    images, session, f"{args.filename_prefix}_draft", image_format
+                ).result()
+                tensors = {
+                    f"{index:03d}": latent.detach().cpu().contiguous()
+                    for index, latent in enumerate(latents)
+                }
+                save_file(tensors, str(session / LATENTS_NAME))
+        finally:
+            writer.close()
+
+        manifest = {
+            "id": session_id,
+            "created_at": time.time(),
+            "request": {
+                "base_model": base_model,
+                "loras": [list(lora) for lora in loras],
+                "fingerprints": {
+                    "base_model": source_digest(base_model),
+                    "loras": [
+                        source_digest(str(Path(repo_or_dir) / weight_name))
+                        for repo_or_dir, weight_name, _ in loras
+                    ],
+                },
+                "height": args.height,
+                "width": args.width,
+                "steps": args.steps,
+                "guidance_scale": args.guidance_scale,
+                "sampler_name": getattr(args, "sampler_name", None),
+                "scheduler": getattr(args, "scheduler", None),
+                "clip_skip": getattr(args, "clip_skip", None),
+                "ksamplers": getattr(args, "ksamplers", None),
+            },
+            "draft": {"height": height, "width": width, "steps": steps, "scale": args.draft_scale},
+            "candidates": [
+                {
+                    "index": index,
+                    "seed": seed,
+                    "positive": positives[index],
+                    "negative": negatives[index],
+                    "image": path.name,
+                    "latents": f"{index:03d}",
+                }
+                for index, (path, seed) in enumerate(zip(paths, seeds))
+            ],
+            "finalized": [],
+        }
+        write_manifest(session, manifest)
+        trace.annotate("draft", {"session": str(session), "candidates": len(seeds)})
+        for index, (path, seed) in enumerate(zip(paths, seeds)):
+            print(f"Draft {index}: {path} (seed {seed})")
+        print(f"Finalize approved drafts with: --finalize {session} --pick <index> [<index> ...]")
+        if residency is not None:
+            residency.report()
+    print(json.dumps(trace.record()))
+    if args.metrics_file:
+        tracing.METRICS.write(args.metrics_file)
+
+
+def apply_draft_request(args: argparse.Namespace, request: dict[str, object]) -> None:
+    # The recorded request wins over the CLI and config: finalizing must render
+    # exactly what was reviewed, only bigger and with more steps.
+    for attr in (
+        "height",
+        "width",
+        "steps",
+        "guidance_scale",
+        "sampler_name",
+        "scheduler",
+        "clip_skip",
+    ):
+        setattr(args, attr, request.get(attr))
+    args.ksamplers = request.get("ksamplers")
+    args.base_model = request["base_model"]
+
+
+def run_finalize(args: argparse.Namespace) -> None:
+    """Renders the `--pick` candidates of a draft session at full resolution and steps."""
+    source_digest = model_registry().source_digest
+
+    with tracing.trace_job(trace_file=args.trace_file) as trace:
+        session, manifest = read_manifest(args.finalize)
+        candidates = list(manifest.get("candidates", []))
+        picks = args.pick if args.pick is not None else ([0] if len(candidates) == 1 else None)
+        if not picks:
+            raise RuntimeError(f"Draft session has {len(candidates)} candidates; choose with --pick")
+        for pick in picks:
+            if not 0 <= pick < len(candidates):
+                raise RuntimeError(f"--pick {pick} is out of range (0-{len(candidates) - 1})")
+
+        request = dict(manifest["request"])
+        prepare_args(args)
+        apply_draft_request(args, request)
+        with tracing.stage("resolve_model"):
+            base_model = resolve_base_model(str(request["base_model"]))
+        loras = [(str(repo), str(weight), float(scale)) for repo, weight, scale in request["loras"]]
+        check_lora_compatibility(base_model, loras)
+        check_sampling(args)
+        image_format = output_format(args)
+        fingerprints = dict(request.get("fingerprints") or {})
+        current = [source_digest(base_model)] + [
+            source_digest(str(Path(repo_or_dir) / weight_name))
+            for repo_or_dir, weight_name, _ in loras
+        ]
+        recorded = [fingerprints.get("base_model")] + list(fingerprints.get("loras", []))
+        if json.loads(json.dumps(current)) != recorded:
+            print("Warning: the checkpoint or a LoRA changed since the drafts were rendered")
+
+        out_dir = Path(args.output_dir)
+        out_dir.mkdir(parents=True, exist_ok=True)
+        device, dtype = select_device(args.device)
+        print_configuration(args, device, dtype, base_model, loras, None, None)
+        residency = create_residency_manager(args, device)
+        pipe = build_pipeline(
+            base_model=base_model,
+            device=device,
+            dtype=dtype,
+            lora_repo_or_dir=None,
+            lora_weight_name=None,
+            loras=loras,
+            model_cache=create_model_cache(args),
+            cpu_options=create_cpu_options(args),
+            residency=residency,
+        )
+        prompt_cache = create_prompt_cache(args)
+        monitor = create_step_monitor(args, args.filename_prefix)
+        latents = {}
+        if args.finalize_mode == "upscale":
+            from safetensors.torch import load_file
+
+            latents = load_file(str(session / LATENTS_NAME))
+
+        writer = create_output_writer(args)
+        finalized = []
+        try:
+            for pick in picks:
+                candidate = candidates[pick]
+                seed = int(candidate["seed"])
+                if args.finalize_mode == "upscale":
+                    images = finalize_latents(
+                        pipe,
+                        args,
+                        device,
+                        latents[str(candidate["latents"])],
+                        str(candidate["positive"]),
+                        str(candidate["negative"]),
+                        seed,
+                        prompt_cache,
+                        monitor,
+                    )
+                else:
+                    full = argparse.Namespace(**vars(args))
+                    full.positive_prompts = [str(candidate["positive"])]
+                    full.negative_prompts = [str(candidate["negative"])]
+                    full.seeds, full.batch_size = [seed], 1
+                    images, _ = generate(pipe, full, device, "", "", prompt_cache, monitor)
+                with tracing.stage("save"):
+                    paths = writer.submit(images, out_dir, args.filename_prefix, image_format).result()
+                for path in paths:
+                    print(f"Draft {pick} finalized to {path} (seed {seed})")
+                    finalized.append(
+                        {
+                            "index": pick,
+                            "image": str(path),
+                            "mode": args.finalize_mode,
+                            "strength": (
+                                args.finalize_strength if args.finalize_mode == "upscale" else None
+                            ),
+                            "finalized_at": time.time(),
+                        }
+                    )
+        finally:
+            writer.close()
+        manifest["finalized"] = list(manifest.get("finalized", [])) + finalized
+        write_manifest(session, manifest)
+        trace.annotate(
+            "finalize", {"session": str(session), "picks": picks, "mode": args.finalize_mode}
+        )
+        if residency is not None:
+            residency.report()
+    print(json.dumps(trace.record()))
+    if args.metrics_file:
+        tracing.METRICS.write(args.metrics_file)
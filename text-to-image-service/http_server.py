@@ -0,0 +1,543 @@
+import argparse
+import asyncio
+import json
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+import torch
+
+from main import (
+    check_lora_compatibility,
+    check_memory_budget,
+    check_sampling,
+    create_cpu_options,
+    create_model_cache,
+    create_output_writer,
+    create_prompt_cache,
+    create_prompt_enhancer,
+    create_residency_manager,
+    create_step_monitor,
+    enhance_prompts,
+    expand_batch,
+    generate,
+    lora_specs,
+    output_format,
+    parse_size,
+    preflight,
+    resolve_sampler_stages,
+    print_configuration,
+    resolve_base_model,
+    resolve_prompts,
+    select_device,
+)
+import tracing
+from output_writer import WriteBatch
+from pipeline_cache import PipelineCache
+from previews import CancellationToken, GenerationCancelled, StepMonitor
+from worker import job_args
+
+if TYPE_CHECKING:
+    from llm_prompt_enhancer import LLMPromptEnhancer
+
+
+MAX_BODY_BYTES = 1 << 20
+MAX_FINISHED_JOBS = 10_000
+
+HTTP_REASONS = {
+    200: "OK",
+    202: "Accepted",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    413: "Payload Too Large",
+    429: "Too Many Requests",
+    500: "Internal Server Error",
+}
+
+
+@dataclass
+class GenerationRequest:
+    id: str
+    args: argparse.Namespace
+    key: tuple[object, ...]
+    loras: list[tuple[str, str, float]]
+    base_model: str
+    arrived: float
+    status: str = "queued"
+    result: dict[str, object] = field(default_factory=dict)
+    error: str | None = None
+    token: CancellationToken = field(default_factory=CancellationToken)
+    monitor: StepMonitor | None = None
+
+
+def batch_key(
+    args: argparse.Namespace, base_model: str, loras: list[tuple[str, str, float]]
+) -> tuple[object, ...]:
+    # Requests can share one pipeline call only if every per-call setting matches.
+    return (
+        base_model,
+        tuple(loras),
+        args.height,
+        args.width,
+        args.steps,
+        args.guidance_scale,
+        getattr(args, "sampler_name", None),
+        getattr(args, "scheduler", None),
+        getattr(args, "clip_skip", None),
+        tuple(
+            (
+                stage["model"],
+                stage["start"],
+                stage["end"],
+                stage["cfg"],
+                stage["sampler_name"],
+                stage["scheduler"],
+            )
+            for stage in resolve_sampler_stages(args)
+        ),
+    )
+
+
+class MicroBatcher:
+    """
+    Groups compatible generation requests into one batched pipeline call.
+
+    A group is dispatched when it reaches max_batch_size or when its oldest request
+    has waited max_wait seconds. Pipeline calls run on a single-thread executor so the
+    event loop keeps accepting and answering requests while the device is busy.
+
+    A request moves from "queued" to "running" to "saving" (images handed to the
+    writer) and ends as "done", "failed" or "cancelled". Status changes come from the
+    event loop, the generation thread and the writer thread, so they hold _lock.
+    """
+
+    def __init__(
+        self,
+        base_args: argparse.Namespace,
+        device: str,
+        dtype: torch.dtype,
+        cache: PipelineCache,
+        max_batch_size: int,
+        max_wait: float,
+        max_queue: int,
+        enhancer: "LLMPromptEnhancer | None" = None,
+    ):
+        self.base_args = base_args
+        self.enhancer = enhancer
+        self.device = device
+        self.dtype = dtype
+        self.cache = cache
+        self.prompt_cache = create_prompt_cache(base_args)
+        self.writer = create_output_writer(base_args)
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0.0, max_wait)
+        self.max_queue = max(1, max_queue)
+        self.jobs: OrderedDict[str, GenerationRequest] = OrderedDict()
+        self.queued = 0
+        self._groups: OrderedDict[tuple[object, ...], list[GenerationRequest]] = OrderedDict()
+        self._wakeup = asyncio.Event()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="tti-generate")
+        self._lock = threading.Lock()
+
+    async def submit(self, payload: dict[str, object]) -> GenerationRequest | None:
+        if self.queued >= self.max_queue:
+            return None
+        # Validation reads checkpoint headers and the model index; keep it off the event loop.
+        loop = asyncio.get_running_loop()
+        request = await loop.run_in_executor(None, self._prepare, payload)
+        with self._lock:
+            if self.queued >= self.max_queue:
+                return None
+            self.jobs[request.id] = request
+            self._groups.setdefault(request.key, []).append(request)
+            self.queued += 1
+            self._forget_finished()
+        self._wakeup.set()
+        return request
+
+    def _prepare(self, payload: dict[str, object]) -> GenerationRequest:
+        args = job_args(self.base_args, payload)
+        output_format(args)
+        base_model = resolve_base_model(args.base_model)
+        loras = lora_specs(args)
+        check_lora_compatibility(base_model, loras)
+        check_sampling(args)
+        return GenerationRequest(
+            id=uuid.uuid4().hex,
+            args=args,
+            key=batch_key(args, base_model, loras),
+            loras=loras,
+            base_model=base_model,
+            arrived=time.monotonic(),
+        )
+
+    def _forget_finished(self) -> None:
+        while len(self.jobs) > MAX_FINISHED_JOBS:
+            oldest_id, oldest = next(iter(self.jobs.items()))
+            if oldest.status in {"queued", "running", "saving"}:
+                break
+            del self.jobs[oldest_id]
+
+    def cancel(self, request_id: str) -> GenerationRequest | None:
+        with self._lock:
+            request = self.jobs.get(request_id)
+            if request is None:
+                return None
+            if request.status == "queued":
+                group = [
+                    other for other in self._groups.get(request.key, []) if other is not request
+                ]
+                if group:
+                    self._groups[request.key] = group
+                else:
+                    self._groups.pop(request.key, None)
+                self.queued -= 1
+                request.status = "cancelled"
+            elif request.status == "running":
+                # The batch stops at the next step once every request in it is cancelled;
+                # otherwise this request's images are discarded when the batch finishes.
+                request.token.cancel()
+            # A "saving" request already has its images with the writer; it finishes as usual.
+        return request
+
+    def _next_batch(self, now: float) -> list[GenerationRequest] | None:
+        for key, group in self._groups.items():
+            if len(group) >= self.max_batch_size:
+                return self._take(key)
+        if not self._groups:
+            return None
+        key, group = min(self._groups.items(), key=lambda item: item[1][0].arrived)
+        if now - group[0].arrived >= self.max_wait:
+            return self._take(key)
+        return None
+
+    def _take(self, key: tuple[object, ...]) -> list[GenerationRequest]:
+        group = self._groups[key]
+        batch, rest = group[: self.max_batch_size], group[self.max_batch_size :]
+        if rest:
+            self._groups[key] = rest
+        else:
+            del self._groups[key]
+        return batch
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._lock:
+                batch = self._next_batch(time.monotonic())
+                if batch is not None:
+                    for request in batch:
+                        request.status = "running"
+                    self.queued -= len(batch)
+            if batch is None:
+                self._wakeup.clear()
+                timeout = None
+                if self._groups:
+                    oldest = min(group[0].arrived for group in self._groups.values())
+                    timeout = max(oldest + self.max_wait - time.monotonic(), 0.0)
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            try:
+                await loop.run_in_executor(self._executor, self._generate_batch, batch)
+            except GenerationCancelled:
+                with self._lock:
+                    for request in batch:
+                        request.status = "cancelled"
+            except Exception as exc:
+                with self._lock:
+                    for request in batch:
+                        request.status = "failed"
+                        request.error = str(exc)
+
+    def _generate_batch(self, batch: list[GenerationRequest]) -> None:
+        with tracing.trace_job(batch[0].id, self.base_args.trace_file) as trace:
+            writes = self._run_batch(batch)
+        stages = trace.record()["stages"]
+        for request, result, write in writes:
+            result["stages"] = stages
+            if "memory" in trace.annotations:
+                result["memory"] = trace.annotations["memory"]
+            # The request turns "done" once its images are on disk; the device is
+            # already free for the next batch by then.
+            write.add_done_callback(
+                lambda write, request=request, result=result: self._finish_request(
+                    request, result, write
+                )
+            )
+
+    def _finish_request(
+        self, request: GenerationRequest, result: dict[str, object], write: WriteBatch
+    ) -> None:
+        try:
+            paths = write.result()
+        except Exception as exc:
+            with self._lock:
+                request.error = f"writing images failed: {exc}"
+                request.status = "failed"
+            return
+        result["images"] = [str(path) for path in paths]
+        result["timings"]["save_s"] = round(write.seconds, 4)
+        with self._lock:
+            request.result = result
+            request.status = "done"
+
+    def _run_batch(
+        self, batch: list[GenerationRequest]
+    ) -> list[tuple[GenerationRequest, dict[str, object], WriteBatch]]:
+        start = time.perf_counter()
+        first = batch[0]
+        pipe, load_s, lora_s = self.cache.get(
+            first.base_model, self.dtype, self.device, first.loras
+        )
+
+        merged = argparse.Namespace(**vars(first.args))
+        merged.positive_prompts, merged.negative_prompts, merged.seeds = [], [], []
+        spans: list[tuple[GenerationRequest, int, int]] = []
+        for request in batch:
+            positive, negative = resolve_prompts(request.args, interactive=False)
+            if self.enhancer is not None:
+                positive, negative = enhance_prompts(
+                    request.args, self.enhancer, positive, negative
+                )
+            positives, negatives, seeds = expand_batch(request.args, positive, negative)
+            offset = len(merged.positive_prompts)
+            merged.positive_prompts.extend(positives)
+            merged.negative_prompts.extend(negatives)
+            merged.seeds.extend(seeds)
+            spans.append((request, offset, offset + len(positives)))
+        merged.batch_size = len(merged.positive_prompts)
+
+        names = [
+            f"{request.args.filename_prefix}_{request.id}_preview_{index:03d}"
+            for request, begin, end in spans
+            for index in range(end - begin)
+        ]
+        token = CancellationToken(lambda: all(request.token.cancelled for request in batch))
+        monitor = create_step_monitor(merged, "batch", token, names)
+        for request in batch:
+            request.monitor = monitor
+
+        generate_start = time.perf_counter()
+        images, seeds = generate(
+            pipe, merged, self.device, "", "", self.prompt_cache, monitor
+        )
+        generate_s = time.perf_counter() - generate_start
+
+        writes: list[tuple[GenerationRequest, dict[str, object], WriteBatch]] = []
+        for request, begin, end in spans:
+            with self._lock:
+                # Checked and switched together so a cancel cannot land between the two.
+                if request.token.cancelled:
+                    request.status = "cancelled"
+                    continue
+                request.status = "saving"
+            write = self.writer.submit(
+                images[begin:end],
+                Path(request.args.output_dir),
+                request.args.filename_prefix,
+                output_format(request.args),
+            )
+            result: dict[str, object] = {
+                "seeds": seeds[begin:end],
+                "batch_size": merged.batch_size,
+                "timings": {
+                    "pipeline_s": round(load_s, 4),
+                    "lora_s": round(lora_s, 4),
+                    "generate_s": round(generate_s, 4),
+                    "total_s": round(time.perf_counter() - start, 4),
+                },
+            }
+            writes.append((request, result, write))
+        return writes
+
+
+def job_status(request: GenerationRequest) -> dict[str, object]:
+    body: dict[str, object] = {"job_id": request.id, "status": request.status}
+    writer = request.monitor.on_preview if request.monitor is not None else None
+    if request.status == "running" and writer is not None and writer.latest:
+        marker = f"_{request.id}_preview_"
+        body["preview"] = {
+            "step": writer.latest["step"],
+            "images": [path for path in writer.latest["images"] if marker in Path(path).name],
+        }
+    if request.status == "done":
+        body.update(request.result)
+    if request.error:
+        body["error"] = request.error
+    return body
+
+
+async def write_response(
+    writer: asyncio.StreamWriter,
+    status: int,
+    body: dict[str, object] | str,
+    headers: dict[str, str] | None = None,
+) -> None:
+    if isinstance(body, str):
+        payload = body.encode("utf-8")
+        content_type = "text/plain; version=0.0.4; charset=utf-8"
+    else:
+        payload = json.dumps(body).encode("utf-8")
+        content_type = "application/json"
+    lines = [
+        f"HTTP/1.1 {status} {HTTP_REASONS.get(status, 'Unknown')}",
+        f"Content-Type: {content_type}",
+        f"Content-Length: {len(payload)}",
+        "Connection: close",
+    ]
+    for name, value in (headers or {}).items():
+        lines.append(f"{name}: {value}")
+    writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + payload)
+    await writer.drain()
+
+
+async def handle_connection(
+    batcher: MicroBatcher, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+) -> None:
+    try:
+        request_line = (await reader.readline()).decode("latin-1").strip()
+        if not request_line:
+            return
+        method, target, _ = (request_line.split(" ", 2) + ["", ""])[:3]
+        headers: dict[str, str] = {}
+        while True:
+            line = (await reader.readline()).decode("latin-1").strip()
+            if not line:
+                break
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        raw_length = headers.get("content-length", "0") or "0"
+        if not (raw_length.isascii() and raw_length.isdigit()):
+            # Negative, signed or non-numeric lengths would break readexactly.
+            await write_response(writer, 400, {"error": "Invalid Content-Length header"})
+            return
+        length = int(raw_length)
+        if length > MAX_BODY_BYTES:
+            await write_response(writer, 413, {"error": "Request body too large"})
+            return
+        body = await reader.readexactly(length) if length else b""
+        path = target.split("?", 1)[0].rstrip("/") or "/"
+
+        if path == "/health" and method == "GET":
+            await write_response(
+                writer,
+                200,
+                {"status": "ok", "queued": batcher.queued, "pipelines": batcher.cache.stats()},
+            )
+        elif path == "/metrics" and method == "GET":
+            await write_response(writer, 200, tracing.METRICS.render())
+        elif path == "/generate":
+            if method != "POST":
+                await write_response(writer, 405, {"error": "Use POST"})
+                return
+            try:
+                payload = json.loads(body or b"{}")
+                if not isinstance(payload, dict):
+                    raise ValueError("Request body must be a JSON object")
+                request = await batcher.submit(payload)
+            except (ValueError, RuntimeError) as exc:
+                await write_response(writer, 400, {"error": str(exc)})
+                return
+            if request is None:
+                await write_response(
+                    writer,
+                    429,
+                    {"error": "Queue is full, retry later", "queued": batcher.queued},
+                    {"Retry-After": str(max(1, int(batcher.max_wait) + 1))},
+                )
+                return
+            await write_response(
+                writer,
+                202,
+                {
+                    "job_id": request.id,
+                    "status": request.status,
+                    "status_url": f"/jobs/{request.id}",
+                },
+            )
+        elif path.startswith("/jobs/") and path.endswith("/cancel"):
+            if method != "POST":
+                await write_response(writer, 405, {"error": "Use POST"})
+                return
+            request = batcher.cancel(path[len("/jobs/") : -len("/cancel")])
+            if request is None:
+                await write_response(writer, 404, {"error": "Unknown job id"})
+            else:
+                await write_response(writer, 202, job_status(request))
+        elif path.startswith("/jobs/") and method == "GET":
+            request = batcher.jobs.get(path[len("/jobs/") :])
+            if request is None:
+                await write_response(writer, 404, {"error": "Unknown job id"})
+            else:
+                await write_response(writer, 200, job_status(request))
+        else:
+            await write_response(writer, 404, {"error": f"No route for {method} {path}"})
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    except Exception as exc:
+        await write_response(writer, 500, {"error": str(exc)})
+    finally:
+        writer.close()
+
+
+async def serve_http_async(args: argparse.Namespace) -> None:
+    base_model, loras, lora_repo_or_dir, lora_weight_name = preflight(args)
+    device, dtype = select_device(args.device)
+    print_configuration(
+        args, device, dtype, base_model, loras, lora_repo_or_dir, lora_weight_name
+    )
+    residency = create_residency_manager(args, device)
+    cache = PipelineCache(
+        max_bytes=parse_size(args.pipeline_cache_memory),
+        device=device,
+        model_cache=create_model_cache(args),
+        cpu_options=create_cpu_options(args),
+        residency=residency,
+    )
+    loop = asyncio.get_running_loop()
+    pipe, _, _ = await loop.run_in_executor(
+        None, cache.get, base_model, dtype, device, lora_specs(args)
+    )
+    enhancer = await loop.run_in_executor(None, create_prompt_enhancer, args, residency)
+    memory_plan = check_memory_budget(pipe, args, device)
+    if memory_plan is not None:
+        print(json.dumps({"event": "memory_plan", **memory_plan}))
+
+    batcher = MicroBatcher(
+        args,
+        device,
+        dtype,
+        cache,
+        max_batch_size=args.max_batch_size,
+        max_wait=args.max_wait_ms / 1000.0,
+        max_queue=args.max_queue,
+        enhancer=enhancer,
+    )
+    dispatcher = asyncio.create_task(batcher.run())
+    server = await asyncio.start_server(
+        lambda reader, writer: handle_connection(batcher, reader, writer), args.host, args.port
+    )
+    print(f"Serving text-to-image on http://{args.host}:{args.port}")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        dispatcher.cancel()
+
+
+def serve_http(args: argparse.Namespace) -> None:
+    try:
+        asyncio.run(serve_http_async(args))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,476 @@
+import json
+import os
+import re
+import threading
+import time
+import uuid
+from collections import deque
+from dataclasses import dataclass, field
+from pathlib import Path
+
+
+DEFAULT_VISIBILITY_TIMEOUT = 300.0
+DEFAULT_MAX_ATTEMPTS = 3
+
+
+@dataclass
+class Job:
+    id: str
+    payload: dict[str, object]
+    attempts: int = 0
+    receipt: str = ""
+    lease_expires: float = 0.0
+    enqueued_at: float = field(default_factory=time.time)
+
+
+def _safe_job_id(value: object) -> str:
+    text = re.sub(r"[^A-Za-z0-9_.-]", "_", str(value)).strip("._")
+    return text or uuid.uuid4().hex
+
+
+class MemoryQueue:
+    """
+    In-process stand-in for the SQS Text-to-Image step queue.
+
+    Received jobs stay invisible until they are acknowledged or their visibility
+    timeout lapses, after which they are delivered again. Jobs that fail more than
+    max_attempts times are moved to a dead-letter list, and cancelled jobs to the
+    `cancelled` list.
+    """
+
+    def __init__(
+        self,
+        visibility_timeout: float = DEFAULT_VISIBILITY_TIMEOUT,
+        max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+    ):
+        self.visibility_timeout = visibility_timeout
+        self.max_attempts = max_attempts
+        self.dead_letters: list[Job] = []
+        self.cancelled: list[Job] = []
+        self._cancel_requests: set[str] = set()
+        self._pending: deque[Job] = deque()
+        self._inflight: dict[str, Job] = {}
+        self._lock = threading.Lock()
+
+    def put(self, payload: dict[str, object], job_id: str | None = None) -> str:
+        job = Job(id=_safe_job_id(job_id) if job_id else uuid.uuid4().hex, payload=payload)
+        with self._lock:
+            self._pending.append(job)
+        return job.id
+
+    def _requeue_expired(self, now: float) -> None:
+        for receipt, job in list(self._inflight.items()):
+            if job.lease_expires <= now:
+                del self._inflight[receipt]
+                self._pending.appendleft(job)
+
+    def receive(self, max_jobs: int = 1) -> list[Job]:
+        now = time.time()
+        jobs: list[Job] = []
+        with self._lock:
+            self._requeue_expired(now)
+            while self._pending and len(jobs) < max_jobs:
+                job = self._pending.popleft()
+                if job.id in self._cancel_requests:
+                    self._cancel_requests.discard(job.id)
+                    self.cancelled.append(job)
+                    continue
+                job.attempts += 1
+                job.receipt = uuid.uuid4().hex
+                job.lease_expires = now + self.visibility_timeout
+                self._inflight[job.receipt] = job
+                jobs.append(job)
+        return jobs
+
+    def extend(self, job: Job, timeout: float | None = None) -> bool:
+        with self._lock:
+            if job.receipt not in self._inflight:
+                return False
+            job.lease_expires = time.time() + (
+                self.visibility_timeout if timeout is None else timeout
+            )
+        return True
+
+    def ack(self, job: Job, result: dict[str, object] | None = None) -> bool:
+        with self._lock:
+            return self._inflight.pop(job.receipt, None) is not None
+
+    def nack(self, job: Job, error: str | None = None) -> bool:
+        with self._lock:
+            if self._inflight.pop(job.receipt, None) is None:
+                return False
+            if job.attempts >= self.max_attempts:
+                if error:
+                    job.payload = {**job.payload, "_error": error}
+                self.dead_letters.append(job)
+            else:
+                self._pending.append(job)
+        return True
+
+    def release(self, job: Job) -> bool:
+        with self._lock:
+            if self._inflight.pop(job.receipt, None) is None:
+                return False
+            job.attempts = max(job.attempts - 1, 0)
+            self._pending.appendleft(job)
+        return True
+
+    def cancel(self, job_id: str) -> str:
+        with self._lock:
+            for job in self._pending:
+                if job.id == job_id:
+                    self._pending.remove(job)
+                    self.cancelled.append(job)
+                    return "cancelled"
+            if any(job.id == job_id for job in self._inflight.values()):
+                self._cancel_requests.add(job_id)
+                return "cancelling"
+        return "unknown"
+
+    def is_cancelled(self, job_id: str) -> bool:
+        with self._lock:
+            return job_id in self._cancel_requests
+
+    def discard(self, job: Job, reason: str | None = None) -> bool:
+        with self._lock:
+            if self._inflight.pop(job.receipt, None) is None:
+                return False
+            self._cancel_requests.discard(job.id)
+            self.cancelled.append(job)
+        return True
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._pending) + len(self._inflight)
+
+
+class SpoolQueue:
+    """
+    Directory-backed job spool shared by any number of local worker processes.
+
+    Layout under the spool root:
+        pending/<id>.json           waiting to be received
+        inflight/<id>@<receipt>.json leased; the file mtime is the lease start
+        done/<id>.json              acknowledged, with the job result attached
+        failed/<id>.json            exceeded max_attempts
+        cancelled/<id>.json         cancelled before or during generation
+        cancelling/<id>             cancel requested for a leased job
+
+    Leases are taken with an atomic rename, so two workers never own the same job.
+    When `source` is a JSONL file (such as requests.jsonl), each line is ingested
+    as one job and lines appended later are picked up on the next receive.
+    """
+
+    STATES = ("pending", "inflight", "done", "failed", "cancelled", "cancelling")
+
+    def __init__(
+        self,
+        root: str | Path,
+        source: str | Path | None = None,
+        visibility_timeout: float = DEFAULT_VISIBILITY_TIMEOUT,
+        max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+    ):
+        self.root = Path(root)
+        self.source = Path(source) if source else None
+        self.visibility_timeout = visibility_timeout
+        self.max_attempts = max_attempts
+        for state in self.STATES:
+            (self.root / state).mkdir(parents=True, exist_ok=True)
+        self._ingest_state = self.root / "ingest.json"
+
+    def _path(self, state: str, job_id: str, receipt: str | None = None) -> Path:
+        name = f"{job_id}@{receipt}.json" if receipt else f"{job_id}.json"
+        return self.root / state / name
+
+    def _known(self, job_id: str) -> bool:
+        finished = ("pending", "done", "failed", "cancelled")
+        if any(self._path(state, job_id).exists() for state in finished):
+            return True
+        return any((self.root / "inflight").glob(f"{job_id}@*.json"))
+
+    def _write(self, path: Path, data: dict[str, object]) -> None:
+        tmp_path = path.with_name(f".{path.name}.{uuid.uuid4().hex}.tmp")
+        with tmp_path.open("w", encoding="utf-8") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+
+    def put(self, payload: dict[str, object], job_id: str | None = None) -> str:
+        safe_id = _safe_job_id(job_id) if job_id else uuid.uuid4().hex
+        if not self._known(safe_id):
+            record = {"id": safe_id, "payload": payload, "attempts": 0, "enqueued_at": time.time()}
+            self._write(self._path("pending", safe_id), record)
+        return safe_id
+
+    def ingest(self) -> int:
+        if self.source is None or not self.source.is_file():
+            return 0
+        offset = 0
+        line_no = 0
+        if self._ingest_state.is_file():
+            try:
+                with self._ingest_state.open("r", encoding="utf-8") as f:
+                    state = json.load(f)
+                offset = int(state.get("offset", 0))
+                line_no = int(state.get("line", 0))
+            except Exception:
+                offset, line_no = 0, 0
+        if self.source.stat().st_size <= offset:
+            return 0
+
+        added = 0
+        with self.source.open("rb") as f:
+            f.seek(offset)
+            for raw in f:
+                text = raw.decode("utf-8").strip()
+                try:
+                    payload = json.loads(text) if text else None
+                except Exception:
+                    if not raw.endswith(b"\n"):
+                        # The writer is still appending this line; pick it up next time.
+                        break
+                    payload = None
+                    print(f"Skipping malformed job on line {line_no + 1} of {self.source}")
+                offset += len(raw)
+                line_no += 1
+                if not isinstance(payload, dict):
+                    continue
+                raw_id = payload.get("request_id", payload.get("id"))
+                job_id = _safe_job_id(raw_id) if raw_id else f"{self.source.stem}-{line_no:06d}"
+                if not self._known(job_id):
+                    self.put(payload, job_id)
+                    added += 1
+        self._write(self._ingest_state, {"offset": offset, "line": line_no})
+        return added
+
+    def _requeue_expired(self, now: float) -> None:
+        for path in (self.root / "inflight").glob("*@*.json"):
+            try:
+                expired = path.stat().st_mtime + self.visibility_timeout <= now
+            except FileNotFoundError:
+                continue
+            if not expired:
+                continue
+            job_id = path.name.split("@", 1)[0]
+            try:
+                os.rename(path, self._path("pending", job_id))
+            except FileNotFoundError:
+                continue
+
+    def receive(self, max_jobs: int = 1) -> list[Job]:
+        self.ingest()
+        now = time.time()
+        self._requeue_expired(now)
+        pending: list[tuple[float, Path]] = []
+        for path in (self.root / "pending").glob("*.json"):
+            try:
+                pending.append((path.stat().st_mtime, path))
+            except FileNotFoundError:
+                # Leased by another worker between the listing and the stat.
+                continue
+        pending.sort()
+        jobs: list[Job] = []
+        for _, path in pending:
+            if len(jobs) >= max_jobs:
+                break
+            job_id = path.stem
+            receipt = uuid.uuid4().hex
+            leased = self._path("inflight", job_id, receipt)
+            try:
+                os.rename(path, leased)
+                # The rename keeps the pending mtime; restart the clock so a job that
+                # waited longer than the timeout is not requeued by a sibling at once.
+                os.utime(leased)
+                with leased.open("r", encoding="utf-8") as f:
+                    record = json.load(f)
+            except FileNotFoundError:
+                # Lease lost to another worker's requeue before it was read.
+                continue
+            record["attempts"] = int(record.get("attempts", 0)) + 1
+            self._write(leased, record)
+            job = Job(
+                id=job_id,
+                payload=record.get("payload", {}),
+                attempts=record["attempts"],
+                receipt=receipt,
+                lease_expires=time.time() + self.visibility_timeout,
+                enqueued_at=float(record.get("enqueued_at", now)),
+            )
+            if self.is_cancelled(job_id):
+                # Cancelled while its lease had lapsed; never hand it to a worker.
+                self.discard(job, "cancelled")
+                continue
+            jobs.append(job)
+        return jobs
+
+    def extend(self, job: Job, timeout: float | None = None) -> bool:
+        leased = self._path("inflight", job.id, job.receipt)
+        try:
+            os.utime(leased)
+        except FileNotFoundError:
+            return False
+        job.lease_expires = time.time() + (
+            self.visibility_timeout if timeout is None else timeout
+        )
+        return True
+
+    def _finish(self, job: Job, state: str, extra: dict[str, object]) -> bool:
+        leased = self._path("inflight", job.id, job.receipt)
+        try:
+            with leased.open("r", encoding="utf-8") as f:
+                record = json.load(f)
+        except FileNotFoundError:
+            return False
+        record.update(extra)
+        self._write(leased, record)
+        try:
+            os.rename(leased, self._path(state, job.id))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def ack(self, job: Job, result: dict[str, object] | None = None) -> bool:
+        return self._finish(job, "done", {"result": result or {}, "finished_at": time.time()})
+
+    def nack(self, job: Job, error: str | None = None) -> bool:
+        if job.attempts >= self.max_attempts:
+            return self._finish(job, "failed", {"error": error, "finished_at": time.time()})
+        return self._finish(job, "pending", {"last_error": error})
+
+    def release(self, job: Job) -> bool:
+        return self._finish(job, "pending", {"attempts": max(job.attempts - 1, 0)})
+
+    def _cancel_marker(self, job_id: str) -> Path:
+        return self.root / "cancelling" / job_id
+
+    def cancel(self, job_id: str) -> str:
+        self.ingest()
+        job_id = _safe_job_id(job_id)
+        try:
+            os.rename(self._path("pending", job_id), self._path("cancelled", job_id))
+            return "cancelled"
+        except FileNotFoundError:
+            pass
+        if any((self.root / "inflight").glob(f"{job_id}@*.json")):
+            self._cancel_marker(job_id).touch()
+            return "cancelling"
+        for state in ("done", "failed", "cancelled"):
+            if self._path(state, job_id).exists():
+                return state
+        return "unknown"
+
+    def is_cancelled(self, job_id: str) -> bool:
+        return self._cancel_marker(job_id).exists()
+
+    def discard(self, job: Job, reason: str | None = None) -> bool:
+        finished = self._finish(
+            job, "cancelled", {"reason": reason, "finished_at": time.time()}
+        )
+        self._cancel_marker(job.id).unlink(missing_ok=True)
+        return finished
+
+    def records(self, state: str) -> list[dict[str, object]]:
+        found: list[dict[str, object]] = []
+        for path in (self.root / state).glob("*.json"):
+            try:
+                with path.open("r", encoding="utf-8") as f:
+                    found.append(json.load(f))
+            except (OSError, ValueError):
+                # Moved to another state (or still being written) while listing.
+                continue
+        return found
+
+    def __len__(self) -> int:
+        self.ingest()
+        return sum(
+            1 for state in ("pending", "inflight") for _ in (self.root / state).glob("*.json")
+        )
+
+
+class LeaseKeeper:
+    """
+    Keeps the leases of held jobs alive from a background thread.
+
+    Every held job (the one generating, prefetched ones, and ones whose images are
+    still being written) is extended every third of the queue's visibility timeout,
+    so a render slower than the timeout is not redelivered while it runs. Jobs whose
+    lease was already lost are dropped and reported.
+    """
+
+    def __init__(self, queue: MemoryQueue | SpoolQueue, interval: float | None = None):
+        self.queue = queue
+        self.interval = queue.visibility_timeout / 3 if interval is None else interval
+        self._jobs: dict[str, Job] = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="lease-keeper", daemon=True)
+        self._thread.start()
+
+    def hold(self, job: Job) -> None:
+        with self._lock:
+            self._jobs[job.receipt] = job
+
+    def drop(self, job: Job) -> None:
+        with self._lock:
+            self._jobs.pop(job.receipt, None)
+
+    def renew(self) -> list[Job]:
+        """Extends every held lease; returns (and stops holding) the ones that were lost."""
+        with self._lock:
+            jobs = list(self._jobs.values())
+        lost: list[Job] = []
+        for job in jobs:
+            if self.queue.extend(job):
+                continue
+            with self._lock:
+                # A job dropped meanwhile was acknowledged, not lost.
+                if self._jobs.pop(job.receipt, None) is not None:
+                    lost.append(job)
+        return lost
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            for job in self.renew():
+                print(json.dumps({"event": "lease_lost", "job_id": job.id}))
+
+    def close(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+
+def open_queue(
+    kind: str,
+    path: str | None,
+    visibility_timeout: float = DEFAULT_VISIBILITY_TIMEOUT,
+    max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+) -> MemoryQueue | SpoolQueue:
+    if kind == "memory":
+        queue = MemoryQueue(visibility_timeout=visibility_timeout, max_attempts=max_attempts)
+        if path:
+            source = Path(path)
+            if not source.is_file():
+                raise RuntimeError(f"Job file '{path}' not found")
+            with source.open("r", encoding="utf-8") as f:
+                for line_no, line in enumerate(f, start=1):
+                    if not line.strip():
+                        continue
+                    payload = json.loads(line)
+                    if isinstance(payload, dict):
+                        raw_id = payload.get("request_id", payload.get("id"))
+                        queue.put(payload, str(raw_id) if raw_id else f"{source.stem}-{line_no:06d}")
+        return queue
+
+    if kind == "spool":
+        if not path:
+            raise RuntimeError("--queue-path is required for the spool queue")
+        target = Path(path)
+        if target.suffix == ".jsonl":
+            root = target.with_name(f"{target.stem}.spool")
+            return SpoolQueue(
+                root,
+                source=target,
+                visibility_timeout=visibility_timeout,
+                max_attempts=max_attempts,
+            )
+        return SpoolQueue(target, visibility_timeout=visibility_timeout, max_attempts=max_attempts)
+
+    raise RuntimeError(f"Unknown queue backend '{kind}'")
@@ -1,34 +1,63 @@
 import argparse
+import gc
+import hashlib
 import json
 import os
-import time
+import random
+import re
+from dataclasses import asdict
 from pathlib import Path
+from typing import TYPE_CHECKING, Callable
 
-import torch
-from diffusers import DPMSolverMultistepScheduler, StableDiffusionXLPipeline
+import tracing
+
+# torch and diffusers take seconds to import, so they are imported inside the
+# functions that need them. Argument parsing, config loading and model/LoRA path
+# resolution run (and fail) before either is loaded.
+if TYPE_CHECKING:
+    import torch
+    from diffusers import StableDiffusionXLImg2ImgPipeline, StableDiffusionXLPipeline
+
+    from cpu_inference import CPUOptions
+    from llm_prompt_enhancer import LLMPromptEnhancer
+    from model_cache import ModelCache
+    from model_registry import ModelRegistry
+    from output_writer import OutputFormat, OutputWriter
+    from previews import CancellationToken, StepMonitor
+    from prompt_cache import PromptEmbeddingCache
+    from residency import ResidencyManager
+    from result_cache import ResultCache
 
 
 ROOT_DIR = Path(__file__).resolve().parent
 MODELS_DIR = ROOT_DIR / "models"
 CHECKPOINTS_DIR = MODELS_DIR / "checkpoints"
 OUTPUTS_DIR = ROOT_DIR / "outputs"
+TEXT_SERVICE_DIR = ROOT_DIR.parent / "text-to-text-service"
 
 
 def load_config(config_path: str | None) -> dict[str, object]:
+    # An explicit --config must load; the implicit pipeline.json keeps the old lenient
+    # behaviour (ignored when unusable) but now says so instead of failing silently.
     if config_path:
         path = Path(config_path)
+        if not path.is_file():
+            raise RuntimeError(f"Config file '{config_path}' not found")
     else:
         path = ROOT_DIR / "pipeline.json"
-    if not path.is_file():
-        return {}
+        if not path.is_file():
+            return {}
     try:
         with path.open("r", encoding="utf-8") as f:
             data = json.load(f)
-        if isinstance(data, dict):
-            return data
-    except Exception:
+        if not isinstance(data, dict):
+            raise ValueError("it must contain a JSON object")
+    except Exception as exc:
+        if config_path:
+            raise RuntimeError(f"Config file '{path}' is not valid: {exc}")
+        print(f"Warning: ignoring '{path}', it is not a valid config: {exc}")
         return {}
-    return {}
+    return data
 
 
 def apply_config(args: argparse.Namespace, config: dict[str, object]) -> None:
@@ -44,13 +73,19 @@ def apply_config(args: argparse.Namespace, config: dict[str, object]) -> None:
         "seed": "seed",
         "output_dir": "output_dir",
         "filename_prefix": "filename_prefix",
+        "image_format": "image_format",
+        "max_memory": "max_memory",
         "positive_prompt": "positive_prompt",
         "negative_prompt": "negative_prompt",
+        "clip_skip": "clip_skip",
+        "sampler_name": "sampler_name",
+        "scheduler": "scheduler",
+        "scheduler_preset": "scheduler_preset",
     }
     for key, attr in mapping.items():
         if key in config:
             value = config[key]
-            if attr in {"height", "width", "steps"} and value is not None:
+            if attr in {"height", "width", "steps", "clip_skip"} and value is not None:
                 try:
                     value = int(value)
                 except Exception:
@@ -69,6 +104,34 @@ def apply_config(args: argparse.Namespace, config: dict[str, object]) -> None:
     if "loras" in config:
         value = config["loras"]
         setattr(args, "loras", value)
+    cpu_block = config.get("cpu")
+    if isinstance(cpu_block, dict):
+        for key in (
+            "mode",
+            "threads",
+            "interop_threads",
+            "bf16",
+            "channels_last",
+            "attention_slicing",
+            "quantize_text_encoders",
+        ):
+            if key in cpu_block:
+                setattr(args, f"cpu_{key}", cpu_block[key])
+    if "batch_size" in config:
+        try:
+            args.batch_size = int(config["batch_size"])
+        except Exception:
+            pass
+    for key in ("positive_prompts", "negative_prompts"):
+        value = config.get(key)
+        if isinstance(value, list) and all(isinstance(item, str) for item in value):
+            setattr(args, key, value)
+    raw_seeds = config.get("seeds")
+    if isinstance(raw_seeds, list):
+        try:
+            args.seeds = [int(item) for item in raw_seeds]
+        except Exception:
+            pass
 
     prompt_block = config.get("prompt")
     if isinstance(prompt_block, dict):
@@ -96,11 +159,9 @@ def apply_config(args: argparse.Namespace, config: dict[str, object]) -> None:
                 pass
         if b is not None:
             try:
-                batch_size = int(b)
-                if batch_size != 1:
-                    raise RuntimeError("Only batch_size=1 is supported")
+                args.batch_size = int(b)
             except Exception:
-                raise
+                pass
 
     samplers_block = config.get("ksamplers")
     if isinstance(samplers_block, list) and samplers_block:
@@ -120,6 +181,9 @@ def apply_config(args: argparse.Namespace, config: dict[str, object]) -> None:
             raw_cfg = base_sampler.get("cfg")
             raw_seed = base_sampler.get("noise_seed", base_sampler.get("seed"))
             raw_model = base_sampler.get("model")
+            for key in ("sampler_name", "scheduler"):
+                if isinstance(base_sampler.get(key), str):
+                    setattr(args, key, base_sampler[key])
             if raw_cfg is not None:
                 try:
                     args.guidance_scale = float(raw_cfg)
@@ -186,7 +250,9 @@ def apply_comfy_nodes(args: argparse.Namespace, config: dict[str, object]) -> No
         setattr(args, "negative_prompt", negative_prompt)
 
 
-def select_device(preferred: str | None = None) -> tuple[str, torch.dtype]:
+def select_device(preferred: str | None = None) -> tuple[str, "torch.dtype"]:
+    import torch
+
     if preferred and preferred != "auto":
         if preferred == "cuda" and not torch.cuda.is_available():
             raise RuntimeError("CUDA requested but not available")
@@ -239,12 +305,16 @@ def resolve_base_model(base_model_arg: str | None) -> str:
     if resolved_direct:
         return resolved_direct
 
-    candidate_file = CHECKPOINTS_DIR / base_model_arg
-    candidate_dir = CHECKPOINTS_DIR / base_model_arg
-    resolved_candidate = resolve_path(candidate_file) or resolve_path(candidate_dir)
+    candidate = CHECKPOINTS_DIR / base_model_arg
+    resolved_candidate = resolve_path(candidate)
     if resolved_candidate:
         return resolved_candidate
 
+    # Stems and suffix-less relative paths come from the index.
+    info = model_registry().lookup("checkpoint", base_model_arg)
+    if info is not None:
+        return info.path
+
     raise RuntimeError(
         f"Base model '{base_model_arg}' not found as a local file or directory. "
         "Remote downloads are disabled. Place the model under models/checkpoints/ "
@@ -260,16 +330,15 @@ def resolve_lora_values(lora_value: str, weight_value: str | None) -> tuple[str,
         root_candidate = ROOT_DIR / path
         if root_candidate.is_file():
             return str(root_candidate.parent), root_candidate.name
-        loras_candidate = MODELS_DIR / "loras" / path.name
-        if loras_candidate.is_file():
-            return str(loras_candidate.parent), loras_candidate.name
+    for candidate in (MODELS_DIR / "loras" / lora_value, MODELS_DIR / "loras" / path.name):
+        if candidate.suffix == ".safetensors" and candidate.is_file():
+            return str(candidate.parent), candidate.name
+    # Stems, relative paths without suffix and trigger names come from the index.
+    info = model_registry().lookup("lora", lora_value, path.name)
+    if info is not None:
+        return str(Path(info.path).parent), Path(info.path).name
+    if path.suffix == ".safetensors":
         raise RuntimeError(f"LoRA file '{lora_value}' not found")
-    candidate = MODELS_DIR / "loras" / lora_value
-    if candidate.is_file():
-        return str(candidate.parent), candidate.name
-    candidate_with_suffix = candidate.with_suffix(".safetensors")
-    if candidate_with_suffix.is_file():
-        return str(candidate_with_suffix.parent), candidate_with_suffix.name
     if weight_value is None or not weight_value.strip():
         raise RuntimeError(
             "LoRA weight name must be provided when using a repo or directory"
@@ -304,36 +373,82 @@ def resolve_lora(
     return None, None
 
 
-def resolve_lora_list(entries: list[object]) -> list[tuple[str, str]]:
-    resolved: list[tuple[str, str]] = []
+def resolve_lora_list(entries: list[object]) -> list[tuple[str, str, float]]:
+    resolved: list[tuple[str, str, float]] = []
     for item in entries:
         if isinstance(item, str):
             repo_or_dir, weight_name = resolve_lora_values(item, None)
-            resolved.append((repo_or_dir, weight_name))
+            resolved.append((repo_or_dir, weight_name, 1.0))
         elif isinstance(item, dict):
             if "path" in item or "weight" in item or "name" in item:
                 raw_lora = item.get("path")
                 raw_weight = None
+                raw_scale = item.get("weight", 1.0)
             else:
                 raw_lora = item.get("lora")
                 raw_weight = item.get("lora_weight")
+                raw_scale = item.get("strength", 1.0)
             if not isinstance(raw_lora, str) or not raw_lora.strip():
                 raise RuntimeError("Each LoRA entry must have a non-empty path")
+            try:
+                scale = float(raw_scale if raw_scale is not None else 1.0)
+            except Exception:
+                raise RuntimeError(f"LoRA weight for '{raw_lora}' must be a number")
             repo_or_dir, weight_name = resolve_lora_values(raw_lora, raw_weight)
-            resolved.append((repo_or_dir, weight_name))
+            resolved.append((repo_or_dir, weight_name, scale))
         else:
             raise RuntimeError("Each LoRA entry must be a string or an object")
     return resolved
 
 
-def build_pipeline(
-    base_model: str,
-    device: str,
-    dtype: torch.dtype,
-    lora_repo_or_dir: str | None,
-    lora_weight_name: str | None,
-    loras: list[tuple[str, str]] | None = None,
-) -> StableDiffusionXLPipeline:
+def model_registry() -> "ModelRegistry":
+    from model_registry import get_registry
+
+    return get_registry(MODELS_DIR)
+
+
+def check_lora_compatibility(base_model: str, loras: list[tuple[str, str, float]]) -> None:
+    """Fails on a LoRA trained for another architecture, from the safetensors headers alone."""
+    registry = model_registry()
+    for repo_or_dir, weight_name, _ in loras:
+        weight_path = Path(repo_or_dir) / weight_name
+        if weight_path.is_file():
+            registry.check_lora(base_model, weight_path)
+
+
+def lora_adapter_name(repo_or_dir: str, weight_name: str) -> str:
+    stem = re.sub(r"[^A-Za-z0-9_]", "_", Path(weight_name).stem) or "lora"
+    digest = hashlib.sha1(f"{repo_or_dir}::{weight_name}".encode("utf-8")).hexdigest()[:8]
+    return f"{stem}_{digest}"
+
+
+def load_lora_adapters(
+    pipe: "StableDiffusionXLPipeline", loras: list[tuple[str, str, float]]
+) -> list[str]:
+    loaded = {name for adapters in pipe.get_list_adapters().values() for name in adapters}
+    names: list[str] = []
+    for repo_or_dir, weight_name, _ in loras:
+        name = lora_adapter_name(repo_or_dir, weight_name)
+        if name not in loaded:
+            pipe.load_lora_weights(repo_or_dir, weight_name=weight_name, adapter_name=name)
+            loaded.add(name)
+        names.append(name)
+    return names
+
+
+def finish_base_pipeline(pipe: "StableDiffusionXLPipeline", base_model: str) -> None:
+    from schedulers import apply_scheduler
+
+    apply_scheduler(pipe, None, None)
+    # Lets later sampler stages recognise when they can reuse this checkpoint's UNet.
+    pipe.asset_base_model = str(base_model)
+
+
+def read_base_pipeline(base_model: str, dtype: "torch.dtype") -> "StableDiffusionXLPipeline":
+    """Loads the checkpoint as published, before any scheduler swap."""
+    import torch
+    from diffusers import StableDiffusionXLPipeline
+
     kwargs: dict[str, object] = {
         "torch_dtype": dtype,
         "use_safetensors": True,
@@ -342,39 +457,114 @@ def build_pipeline(
         kwargs["variant"] = "fp16"
 
     base_path = Path(base_model)
-    if base_path.is_file():
-        pipe = StableDiffusionXLPipeline.from_single_file(str(base_path), **kwargs)
-    elif base_path.is_dir():
-        pipe = StableDiffusionXLPipeline.from_pretrained(str(base_path), **kwargs)
-    else:
-        raise RuntimeError(
-            f"Base model path '{base_model}' does not exist. Remote downloads are disabled."
-        )
+    with tracing.stage("load_checkpoint"):
+        if base_path.is_file():
+            pipe = StableDiffusionXLPipeline.from_single_file(str(base_path), **kwargs)
+        elif base_path.is_dir():
+            pipe = StableDiffusionXLPipeline.from_pretrained(str(base_path), **kwargs)
+        else:
+            raise RuntimeError(
+                f"Base model path '{base_model}' does not exist. Remote downloads are disabled."
+            )
+    return pipe
 
-    if loras:
-        for repo_or_dir, weight_name in loras:
-            pipe.load_lora_weights(repo_or_dir, weight_name=weight_name)
-        pipe.fuse_lora()
-    elif lora_repo_or_dir and lora_weight_name:
-        pipe.load_lora_weights(lora_repo_or_dir, weight_name=lora_weight_name)
-        pipe.fuse_lora()
 
-    pipe.scheduler = DPMSolverMultistepScheduler.from_config(pipe.scheduler.config)
+def load_base_pipeline(
+    base_model: str,
+    dtype: "torch.dtype",
+    model_cache: "ModelCache | None" = None,
+) -> "StableDiffusionXLPipeline":
+    if model_cache is not None:
+        with tracing.stage("load_checkpoint"):
+            pipe = model_cache.load(base_model, dtype, [])
+        if pipe is not None:
+            finish_base_pipeline(pipe, base_model)
+            return pipe
 
-    if device == "mps":
-        pipe.enable_model_cpu_offload()
-    else:
-        pipe.to(device)
-        if device == "cuda":
-            try:
-                pipe.enable_xformers_memory_efficient_attention()
-            except Exception:
-                pass
+    pipe = read_base_pipeline(base_model, dtype)
+    if model_cache is not None and Path(base_model).is_file():
+        # Stored before the scheduler swap so the entry keeps the checkpoint's own scheduler.
+        with tracing.stage("model_cache_store"):
+            model_cache.store(pipe, base_model, dtype, [])
+    finish_base_pipeline(pipe, base_model)
+    return pipe
+
+
+def place_pipeline(
+    pipe: "StableDiffusionXLPipeline",
+    device: str,
+    cpu_options: "CPUOptions | None" = None,
+    residency: "ResidencyManager | None" = None,
+) -> None:
+    with tracing.stage("to_device"):
+        if residency is not None:
+            if device == "cpu" and cpu_options is not None:
+                from cpu_inference import optimize_pipeline
+
+                optimize_pipeline(pipe, cpu_options)
+            # Components move to the device on first use and out again when the budget needs room.
+            residency.manage_pipeline(pipe)
+        elif device == "mps":
+            pipe.enable_model_cpu_offload()
+        else:
+            pipe.to(device)
+            if device == "cuda":
+                try:
+                    pipe.enable_xformers_memory_efficient_attention()
+                except Exception:
+                    pass
+            elif device == "cpu" and cpu_options is not None:
+                from cpu_inference import optimize_pipeline
+
+                optimize_pipeline(pipe, cpu_options)
+
+
+def build_pipeline(
+    base_model: str,
+    device: str,
+    dtype: "torch.dtype",
+    lora_repo_or_dir: str | None,
+    lora_weight_name: str | None,
+    loras: list[tuple[str, str, float]] | None = None,
+    model_cache: "ModelCache | None" = None,
+    cpu_options: "CPUOptions | None" = None,
+    residency: "ResidencyManager | None" = None,
+) -> "StableDiffusionXLPipeline":
+    if not loras and lora_repo_or_dir and lora_weight_name:
+        loras = [(lora_repo_or_dir, lora_weight_name, 1.0)]
+    loras = loras or []
+    if model_cache is not None and not loras and not Path(base_model).is_file():
+        # Already in diffusers format with nothing to fuse; a cached copy loads no faster.
+        model_cache = None
+
+    pipe = None
+    if model_cache is not None:
+        with tracing.stage("load_checkpoint"):
+            pipe = model_cache.load(base_model, dtype, loras)
+        if pipe is not None:
+            print(f"Loaded pre-converted pipeline from {model_cache.root}")
+
+    if pipe is None:
+        pipe = read_base_pipeline(base_model, dtype)
+        if loras:
+            with tracing.stage("lora"):
+                names = load_lora_adapters(pipe, loras)
+                pipe.set_adapters(names, adapter_weights=[scale for _, _, scale in loras])
+                pipe.fuse_lora()
+        if model_cache is not None:
+            with tracing.stage("model_cache_store"):
+                if loras:
+                    # The fused weights stay in place; only the adapter layers are dropped
+                    # so the saved components are plain diffusers modules.
+                    pipe.unload_lora_weights()
+                model_cache.store(pipe, base_model, dtype, loras)
 
+    finish_base_pipeline(pipe, base_model)
+    place_pipeline(pipe, device, cpu_options, residency)
     return pipe
 
 
-def parse_args() -> argparse.Namespace:
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
     parser = argparse.ArgumentParser(
         description="Asset Creator AI Core - Text to Image (SDXL pipeline)"
     )
@@ -414,6 +604,53 @@ def parse_args() -> argparse.Namespace:
         default="auto",
         help="Execution device. Defaults to 'auto' (prefers CUDA, then MPS, then CPU).",
     )
+    parser.add_argument(
+        "--cpu-mode",
+        type=str,
+        choices=["default", "optimized"],
+        default=os.getenv("ASSET_TTI_CPU_MODE", "default"),
+        help=(
+            "CPU inference tuning. 'optimized' enables bf16 autocast (if the CPU supports it), "
+            "channels-last weights and attention slicing; the --cpu-* flags override single knobs."
+        ),
+    )
+    parser.add_argument(
+        "--cpu-threads",
+        type=int,
+        default=None,
+        help="Intra-op threads for CPU inference (default: torch's choice, usually the core count).",
+    )
+    parser.add_argument(
+        "--cpu-interop-threads",
+        type=int,
+        default=None,
+        help="Inter-op threads for CPU inference.",
+    )
+    parser.add_argument(
+        "--cpu-bf16",
+        type=str,
+        choices=["auto", "on", "off"],
+        default=None,
+        help="bfloat16 autocast on CPU; 'auto' uses it only with native bf16 support.",
+    )
+    parser.add_argument(
+        "--cpu-channels-last",
+        action=argparse.BooleanOptionalAction,
+        default=None,
+        help="Store UNet/VAE weights channels-last on CPU.",
+    )
+    parser.add_argument(
+        "--cpu-attention-slicing",
+        action=argparse.BooleanOptionalAction,
+        default=None,
+        help="Compute attention in slices on CPU to cap peak memory.",
+    )
+    parser.add_argument(
+        "--cpu-quantize-text-encoders",
+        action=argparse.BooleanOptionalAction,
+        default=None,
+        help="Dynamically quantize the CLIP text encoders to int8 on CPU.",
+    )
     parser.add_argument(
         "--height",
         type=int,
@@ -429,14 +666,42 @@ def parse_args() -> argparse.Namespace:
     parser.add_argument(
         "--steps",
         type=int,
-        default=int(os.getenv("ASSET_TTI_STEPS", "4")),
-        help="Number of diffusion steps. SDXL-Lightning recommends 4 or 8.",
+        default=None,
+        help=(
+            "Number of diffusion steps (default: the --scheduler-preset's, else "
+            "ASSET_TTI_STEPS or 4). SDXL-Lightning recommends 4 or 8."
+        ),
     )
     parser.add_argument(
         "--guidance-scale",
         type=float,
-        default=float(os.getenv("ASSET_TTI_GUIDANCE", "0.0")),
-        help="Classifier-free guidance scale. 0.0 is common for SDXL-Lightning.",
+        default=None,
+        help=(
+            "Classifier-free guidance scale (default: the --scheduler-preset's, else "
+            "ASSET_TTI_GUIDANCE or 0.0). 0.0 is common for SDXL-Lightning."
+        ),
+    )
+    parser.add_argument(
+        "--sampler",
+        dest="sampler_name",
+        type=str,
+        default=None,
+        help="ComfyUI sampler name, e.g. euler, euler_ancestral, dpmpp_2m, dpmpp_2m_sde, lcm.",
+    )
+    parser.add_argument(
+        "--scheduler",
+        type=str,
+        default=None,
+        help="ComfyUI sigma schedule: normal, karras, exponential, beta, sgm_uniform, simple.",
+    )
+    parser.add_argument(
+        "--scheduler-preset",
+        type=str,
+        default=os.getenv("ASSET_TTI_SCHEDULER_PRESET"),
+        help=(
+            "Sampler, schedule, steps and guidance that go together: quality, balanced, fast, "
+            "lightning, lightning-8, turbo or lcm. Explicit flags and config values win."
+        ),
     )
     parser.add_argument(
         "--seed",
@@ -444,6 +709,71 @@ def parse_args() -> argparse.Namespace:
         default=None,
         help="Random seed for reproducible generations.",
     )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=int(os.getenv("ASSET_TTI_BATCH_SIZE", "1")),
+        help=(
+            "Images per run. Large batches are split automatically to fit available memory."
+        ),
+    )
+    parser.add_argument(
+        "--seeds",
+        type=int,
+        nargs="+",
+        default=None,
+        help="Explicit per-image seeds. Defaults to --seed, --seed+1, ... for batches.",
+    )
+    parser.add_argument(
+        "--clip-skip",
+        type=int,
+        default=None,
+        help="Number of final CLIP layers to skip when encoding the positive prompt.",
+    )
+    parser.add_argument(
+        "--prompt-cache-size",
+        type=int,
+        default=int(os.getenv("ASSET_TTI_PROMPT_CACHE_SIZE", "256")),
+        help="Prompt embeddings kept in memory. Set to 0 to encode prompts on every call.",
+    )
+    parser.add_argument(
+        "--prompt-cache-dir",
+        type=str,
+        default=os.getenv("ASSET_TTI_PROMPT_CACHE_DIR"),
+        help="Optional directory for an on-disk tier of the prompt embedding cache.",
+    )
+    parser.add_argument(
+        "--model-cache-dir",
+        type=str,
+        default=os.getenv("ASSET_TTI_MODEL_CACHE_DIR"),
+        help=(
+            "Opt-in directory of pre-converted, LoRA-fused pipelines reused across cold "
+            "starts (e.g. models/cache). The first load hashes the checkpoint and writes a "
+            "full diffusers copy of it there."
+        ),
+    )
+    parser.add_argument(
+        "--model-cache-size",
+        type=str,
+        default=os.getenv("ASSET_TTI_MODEL_CACHE_SIZE", "40GB"),
+        help="Disk budget for --model-cache-dir; least recently used entries are deleted beyond it.",
+    )
+    parser.add_argument(
+        "--result-cache-dir",
+        type=str,
+        default=os.getenv("ASSET_TTI_RESULT_CACHE_DIR"),
+        help=(
+            "Opt-in store of generated images keyed by the fully resolved request; an "
+            "identical request with an explicit seed returns the stored images instead of "
+            "generating. Requests with a random seed always bypass it."
+        ),
+    )
+    parser.add_argument(
+        "--result-cache-size",
+        type=str,
+        default=os.getenv("ASSET_TTI_RESULT_CACHE_SIZE", "10GB"),
+        help="Disk budget for --result-cache-dir; least recently used entries are deleted beyond it.",
+    )
     parser.add_argument(
         "--output-dir",
         type=str,
@@ -456,73 +786,471 @@ def parse_args() -> argparse.Namespace:
         default="asset",
         help="Prefix for the generated image filename.",
     )
+    parser.add_argument(
+        "--image-format",
+        type=str,
+        choices=["png", "webp"],
+        default=os.getenv("ASSET_TTI_IMAGE_FORMAT", "png"),
+        help="Encoding for generated images.",
+    )
+    parser.add_argument(
+        "--png-compress-level",
+        type=int,
+        default=6,
+        help="PNG zlib level from 0 (fastest, largest) to 9 (slowest, smallest).",
+    )
+    parser.add_argument(
+        "--image-quality",
+        type=int,
+        default=90,
+        help="Lossy WebP quality (0-100). With --webp-lossless it trades encode time for size instead.",
+    )
+    parser.add_argument(
+        "--webp-lossless",
+        action="store_true",
+        help="Encode WebP images losslessly.",
+    )
+    parser.add_argument(
+        "--writer-threads",
+        type=int,
+        default=int(os.getenv("ASSET_TTI_WRITER_THREADS", "2")),
+        help="Threads encoding and writing images while the device generates the next ones.",
+    )
+    parser.add_argument(
+        "--atomic-writes",
+        action="store_true",
+        help="Write each image to a temporary file and move it into place only once complete.",
+    )
+    parser.add_argument(
+        "--fsync-outputs",
+        action="store_true",
+        help="fsync every image and its directory before the job counts as done.",
+    )
     parser.add_argument(
         "--config",
         type=str,
         default=None,
         help="Optional JSON config file. If omitted, tries pipeline.json in this folder.",
     )
-    return parser.parse_args()
+    parser.add_argument(
+        "--workflow",
+        type=str,
+        default=None,
+        help=(
+            "Run a ComfyUI workflow (API or UI JSON) node by node instead of the config's "
+            "single generation."
+        ),
+    )
+    parser.add_argument(
+        "--workflow-cache-size",
+        type=int,
+        default=64,
+        help="Node outputs kept between workflow jobs in worker mode (LRU entries).",
+    )
+    parser.add_argument(
+        "--workflow-cache-memory",
+        type=str,
+        default=os.getenv("ASSET_TTI_WORKFLOW_CACHE_MEMORY", "2GB"),
+        help=(
+            "Memory budget for the latents, embeddings and images kept between workflow "
+            "jobs (e.g. 2GB, or 'none' for no limit)."
+        ),
+    )
+    parser.add_argument(
+        "--draft",
+        type=int,
+        default=0,
+        metavar="N",
+        help=(
+            "Render N candidate seeds at reduced resolution and steps for review, recording "
+            "each seed and its latents so an approved one can be finalized with --finalize."
+        ),
+    )
+    parser.add_argument(
+        "--draft-scale",
+        type=float,
+        default=float(os.getenv("ASSET_TTI_DRAFT_SCALE", "0.5")),
+        help="Draft resolution as a fraction of --height/--width (rounded to multiples of 64).",
+    )
+    parser.add_argument(
+        "--draft-steps",
+        type=int,
+        default=None,
+        help="Denoising steps per draft (default: --steps up to 8, else a third of it, at least 8).",
+    )
+    parser.add_argument(
+        "--draft-dir",
+        type=str,
+        default=None,
+        help="Where draft sessions are written. Defaults to <output-dir>/drafts.",
+    )
+    parser.add_argument(
+        "--finalize",
+        type=str,
+        default=None,
+        metavar="DRAFT_DIR",
+        help="Render the --pick candidates of a draft session at full resolution and steps.",
+    )
+    parser.add_argument(
+        "--pick",
+        type=int,
+        nargs="+",
+        default=None,
+        help="Indices of the approved draft candidates to finalize.",
+    )
+    parser.add_argument(
+        "--finalize-mode",
+        type=str,
+        choices=["upscale", "rerender"],
+        default="upscale",
+        help=(
+            "'upscale' enlarges the draft's latents and partially re-denoises them, keeping its "
+            "composition; 'rerender' renders the same seed from scratch at full size."
+        ),
+    )
+    parser.add_argument(
+        "--finalize-strength",
+        type=float,
+        default=0.55,
+        help="Share of the full steps re-run on the upscaled draft latents (0-1).",
+    )
+    parser.add_argument(
+        "--serve",
+        action="store_true",
+        help="Run as a long-lived worker that keeps the pipeline loaded and consumes jobs from a queue.",
+    )
+    parser.add_argument(
+        "--pool",
+        type=int,
+        default=0,
+        metavar="N",
+        help=(
+            "Drain --queue-path with N worker processes, each pinned to a device or CPU core set, "
+            "and write a manifest of all job results."
+        ),
+    )
+    parser.add_argument(
+        "--pool-devices",
+        type=str,
+        default=os.getenv("ASSET_TTI_POOL_DEVICES", "auto"),
+        help="'auto', 'cpu', 'mps', 'cuda' (all GPUs) or a list such as 'cuda:0,cuda:1'.",
+    )
+    parser.add_argument(
+        "--pool-manifest",
+        type=str,
+        default=None,
+        help="Where --pool writes its manifest. Defaults to <spool>/manifest.json.",
+    )
+    parser.add_argument(
+        "--queue",
+        type=str,
+        choices=["spool", "memory"],
+        default=os.getenv("ASSET_TTI_QUEUE", "spool"),
+        help="Worker queue backend: a local directory/JSONL spool or an in-memory SQS stand-in.",
+    )
+    parser.add_argument(
+        "--queue-path",
+        type=str,
+        default=os.getenv("ASSET_TTI_QUEUE_PATH"),
+        help=(
+            "Spool directory or JSONL job file (one JSON job per line, e.g. requests.jsonl). "
+            "The memory queue is seeded from this file when given."
+        ),
+    )
+    parser.add_argument(
+        "--prefetch",
+        type=int,
+        default=int(os.getenv("ASSET_TTI_PREFETCH", "2")),
+        help="Number of jobs the worker leases ahead of the one it is generating.",
+    )
+    parser.add_argument(
+        "--visibility-timeout",
+        type=float,
+        default=float(os.getenv("ASSET_TTI_VISIBILITY_TIMEOUT", "300")),
+        help="Seconds a leased job stays hidden from other workers before it is redelivered.",
+    )
+    parser.add_argument(
+        "--max-attempts",
+        type=int,
+        default=3,
+        help="Deliveries before a failing job is moved to the dead-letter/failed state.",
+    )
+    parser.add_argument(
+        "--max-memory",
+        type=str,
+        default=os.getenv("ASSET_TTI_MAX_MEMORY"),
+        help=(
+            "Peak memory budget per generation (e.g. 10GB): device memory on CUDA/MPS, process "
+            "RSS on CPU. Picks sliced/tiled VAE decode, attention slicing and batch splitting "
+            "to stay under it."
+        ),
+    )
+    parser.add_argument(
+        "--residency-budget",
+        type=str,
+        default=os.getenv("ASSET_TTI_RESIDENCY_BUDGET"),
+        help=(
+            "Device memory for resident model components (e.g. 8GB). Text encoders, UNet, VAE "
+            "and the --enhance-prompt LLM move to the device when used and idle ones are "
+            "evicted, instead of keeping everything loaded (or, on MPS, offloading everything)."
+        ),
+    )
+    parser.add_argument(
+        "--residency-host-budget",
+        type=str,
+        default=os.getenv("ASSET_TTI_RESIDENCY_HOST_BUDGET"),
+        help="RAM for components evicted from the device; beyond it they spill to --residency-dir.",
+    )
+    parser.add_argument(
+        "--residency-dir",
+        type=str,
+        default=os.getenv("ASSET_TTI_RESIDENCY_DIR"),
+        help="Directory for spilled component weights, memory-mapped back in when needed.",
+    )
+    parser.add_argument(
+        "--enhance-prompt",
+        action="store_true",
+        help="Rewrite the positive/negative prompts with the text-to-text service's LLM first.",
+    )
+    parser.add_argument(
+        "--enhance-style",
+        type=str,
+        default="cinematic",
+        help="Style passed to the prompt enhancer.",
+    )
+    parser.add_argument(
+        "--enhancer-model",
+        type=str,
+        default=os.getenv("ASSET_TTI_ENHANCER_MODEL", "TinyLlama/TinyLlama-1.1B-Chat-v1.0"),
+        help="Model id or local directory of the prompt-enhancer LLM.",
+    )
+    parser.add_argument(
+        "--pipeline-cache-memory",
+        type=str,
+        default=os.getenv("ASSET_TTI_PIPELINE_CACHE_MEMORY"),
+        help=(
+            "Memory budget for pipelines kept loaded in worker mode (e.g. 20GB). "
+            "Defaults to 90%% of the memory available on the device at startup."
+        ),
+    )
+    parser.add_argument(
+        "--poll-interval",
+        type=float,
+        default=1.0,
+        help="Seconds to wait between polls when the queue is empty.",
+    )
+    parser.add_argument(
+        "--exit-when-idle",
+        action="store_true",
+        help="Stop the worker once the queue has been drained.",
+    )
+    parser.add_argument(
+        "--http",
+        action="store_true",
+        help="Serve generation requests over HTTP with dynamic micro-batching.",
+    )
+    parser.add_argument(
+        "--host",
+        type=str,
+        default=os.getenv("ASSET_TTI_HOST", "127.0.0.1"),
+        help="Address the HTTP service binds to.",
+    )
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=int(os.getenv("ASSET_TTI_PORT", "8000")),
+        help="Port the HTTP service listens on.",
+    )
+    parser.add_argument(
+        "--max-batch-size",
+        type=int,
+        default=int(os.getenv("ASSET_TTI_MAX_BATCH_SIZE", "4")),
+        help="Most compatible HTTP requests merged into one pipeline call.",
+    )
+    parser.add_argument(
+        "--max-wait-ms",
+        type=float,
+        default=float(os.getenv("ASSET_TTI_MAX_WAIT_MS", "50")),
+        help="How long the oldest HTTP request may wait for batch partners.",
+    )
+    parser.add_argument(
+        "--max-queue",
+        type=int,
+        default=int(os.getenv("ASSET_TTI_MAX_QUEUE", "64")),
+        help="Queued HTTP requests accepted before new ones get 429 Too Many Requests.",
+    )
+    parser.add_argument(
+        "--preview-every",
+        type=int,
+        default=int(os.getenv("ASSET_TTI_PREVIEW_EVERY", "0")),
+        help="Write a low-resolution latent preview every N denoising steps (0 disables).",
+    )
+    parser.add_argument(
+        "--preview-dir",
+        type=str,
+        default=None,
+        help="Directory for step previews. Defaults to <output-dir>/previews.",
+    )
+    parser.add_argument(
+        "--trace-file",
+        type=str,
+        default=os.getenv("ASSET_TTI_TRACE_FILE"),
+        help="Append one JSON line per job with per-stage wall time and peak memory.",
+    )
+    parser.add_argument(
+        "--metrics-file",
+        type=str,
+        default=os.getenv("ASSET_TTI_METRICS_FILE"),
+        help="Rewrite this file with Prometheus text metrics after every job (textfile collector).",
+    )
+    parser.add_argument(
+        "--cancel",
+        type=str,
+        default=None,
+        metavar="JOB_ID",
+        help="Cancel a worker job in --queue-path: drop it if pending, stop it at the next step if running.",
+    )
+    return parser.parse_args(argv)
 
 
-def run(args: argparse.Namespace) -> None:
-    config = load_config(getattr(args, "config", None))
-    if config:
-        apply_config(args, config)
-        apply_comfy_nodes(args, config)
-
-    OUTPUTS_DIR.mkdir(parents=True, exist_ok=True)
-    out_dir = Path(args.output_dir)
-    out_dir.mkdir(parents=True, exist_ok=True)
-
-    device, dtype = select_device(args.device)
-    base_model = resolve_base_model(args.base_model)
-    loras: list[tuple[str, str]] | None = None
+def prepare_args(args: argparse.Namespace) -> None:
+    if getattr(args, "config_applied", False):
+        return
+    with tracing.stage("config"):
+        config = load_config(getattr(args, "config", None))
+        if config:
+            apply_config(args, config)
+            apply_comfy_nodes(args, config)
+        apply_sampling_defaults(args)
+    args.config_applied = True
+
+
+def apply_sampling_defaults(args: argparse.Namespace) -> None:
+    """Fills sampler, schedule, steps and guidance left unset from the preset, then the env."""
+    preset_name = getattr(args, "scheduler_preset", None)
+    if preset_name:
+        from schedulers import get_preset
+
+        preset = get_preset(preset_name)
+        for attr in ("sampler_name", "scheduler", "steps", "guidance_scale"):
+            if getattr(args, attr, None) is None:
+                setattr(args, attr, getattr(preset, attr))
+    if args.steps is None:
+        args.steps = int(os.getenv("ASSET_TTI_STEPS", "4"))
+    if args.guidance_scale is None:
+        args.guidance_scale = float(os.getenv("ASSET_TTI_GUIDANCE", "0.0"))
+
+
+def preflight(
+    args: argparse.Namespace,
+) -> tuple[str, list[tuple[str, str, float]] | None, str | None, str | None]:
+    # Everything that can reject a run without torch: config, checkpoint and LoRA paths.
+    prepare_args(args)
+    with tracing.stage("resolve_model"):
+        base_model = resolve_base_model(args.base_model)
+        for sampler_stage in resolve_sampler_stages(args):
+            if sampler_stage["model"]:
+                resolve_base_model(sampler_stage["model"])
+    check_sampling(args)
+    loras, lora_repo_or_dir, lora_weight_name = resolve_loras(args)
+    lora_list = combine_loras(loras, lora_repo_or_dir, lora_weight_name)
+    if lora_list:
+        check_lora_compatibility(base_model, lora_list)
+    output_format(args)
+    create_cpu_options(args)
+    parse_size(getattr(args, "max_memory", None))
+    parse_size(getattr(args, "result_cache_size", None))
+    parse_size(getattr(args, "residency_budget", None))
+    parse_size(getattr(args, "residency_host_budget", None))
+    return base_model, loras, lora_repo_or_dir, lora_weight_name
+
+
+def check_sampling(args: argparse.Namespace) -> None:
+    from schedulers import DEFAULT_SAMPLER, DEFAULT_SCHEDULE, check_scheduler
+
+    check_scheduler(
+        getattr(args, "sampler_name", None) or DEFAULT_SAMPLER,
+        getattr(args, "scheduler", None) or DEFAULT_SCHEDULE,
+    )
+    for stage in resolve_sampler_stages(args):
+        check_scheduler(stage["sampler_name"], stage["scheduler"])
+
+
+def resolve_loras(
+    args: argparse.Namespace,
+) -> tuple[list[tuple[str, str, float]] | None, str | None, str | None]:
     if hasattr(args, "loras") and getattr(args, "loras") is not None:
         raw_loras = getattr(args, "loras")
         if not isinstance(raw_loras, list):
             raise RuntimeError("Config field 'loras' must be a list")
-        loras = resolve_lora_list(raw_loras)
-        lora_repo_or_dir, lora_weight_name = None, None
-    else:
-        lora_repo_or_dir, lora_weight_name = resolve_lora(args.lora, args.lora_weight)
+        return resolve_lora_list(raw_loras), None, None
+    lora_repo_or_dir, lora_weight_name = resolve_lora(args.lora, args.lora_weight)
+    return None, lora_repo_or_dir, lora_weight_name
+
+
+def combine_loras(
+    loras: list[tuple[str, str, float]] | None,
+    lora_repo_or_dir: str | None,
+    lora_weight_name: str | None,
+) -> list[tuple[str, str, float]]:
+    # A `loras` list from the config wins; otherwise --lora/--lora-weight is one LoRA at 1.0.
+    if loras:
+        return loras
+    if lora_repo_or_dir and lora_weight_name:
+        return [(lora_repo_or_dir, lora_weight_name, 1.0)]
+    return []
+
+
+def lora_specs(args: argparse.Namespace) -> list[tuple[str, str, float]]:
+    return combine_loras(*resolve_loras(args))
+
+
+def print_configuration(
+    args: argparse.Namespace,
+    device: str,
+    dtype: "torch.dtype",
+    base_model: str,
+    loras: list[tuple[str, str, float]] | None,
+    lora_repo_or_dir: str | None,
+    lora_weight_name: str | None,
+) -> None:
+    from schedulers import DEFAULT_SAMPLER, DEFAULT_SCHEDULE
 
     print("Pipeline configuration:")
     print(f"  Device: {device} ({dtype})")
+    if device == "cpu":
+        print(f"  CPU options: {create_cpu_options(args)}")
     print(f"  Base model path: {base_model}")
     if loras:
         print("  LoRAs:")
-        for repo_or_dir, weight_name in loras:
-            print(f"    - {repo_or_dir} :: {weight_name}")
+        for repo_or_dir, weight_name, scale in loras:
+            print(f"    - {repo_or_dir} :: {weight_name} (weight {scale})")
     elif lora_repo_or_dir and lora_weight_name:
         print(f"  LoRA path: {lora_repo_or_dir}")
         print(f"  LoRA weight file: {lora_weight_name}")
     else:
         print("  LoRA: disabled")
     print(f"  Height x Width: {args.height} x {args.width}")
+    print(f"  Batch size: {getattr(args, 'batch_size', 1)}")
     print(f"  Steps: {args.steps}")
     print(f"  Guidance scale: {args.guidance_scale}")
+    sampler_name = getattr(args, "sampler_name", None) or DEFAULT_SAMPLER
+    print(f"  Sampler: {sampler_name} ({getattr(args, 'scheduler', None) or DEFAULT_SCHEDULE})")
     if args.seed is not None:
         print(f"  Seed: {args.seed}")
     print(f"  Output directory: {args.output_dir}")
     print(f"  Filename prefix: {args.filename_prefix}")
 
-    pipe = build_pipeline(
-        base_model=base_model,
-        device=device,
-        dtype=dtype,
-        lora_repo_or_dir=lora_repo_or_dir,
-        lora_weight_name=lora_weight_name,
-        loras=loras,
-    )
 
+def resolve_prompts(args: argparse.Namespace, interactive: bool = True) -> tuple[str, str]:
     positive_attr = getattr(args, "positive_prompt", None)
     if isinstance(positive_attr, str):
         positive = positive_attr.strip()
     else:
         positive = ""
     if not positive:
-        positive = input("Positive prompt (describe your asset): ").strip()
+        if interactive:
+            positive = input("Positive prompt (describe your asset): ").strip()
         if not positive:
             positive = (
                 "High quality game asset, concept art, detailed, sharp focus, 4k, "
@@ -535,38 +1263,772 @@ def run(args: argparse.Namespace) -> None:
     else:
         negative = ""
     if not negative:
-        negative = input("Negative prompt (press Enter for defaults): ").strip()
+        if interactive:
+            negative = input("Negative prompt (press Enter for defaults): ").strip()
         if not negative:
             negative = "low quality, blurry, distorted, extra limbs, bad anatomy, watermark, text"
 
-    generator_device = device if device in {"cuda", "cpu"} else "cpu"
-    generator = torch.Generator(generator_device)
-    if args.seed is not None:
-        generator = generator.manual_seed(args.seed)
+    return positive, negative
+
+
+def parse_size(value: str | int | None) -> int | None:
+    if value is None:
+        return None
+    if isinstance(value, int):
+        return value
+    text = value.strip().upper().replace(" ", "")
+    if not text or text in {"NONE", "OFF"}:
+        return None
+    units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+    match = re.fullmatch(r"(\d+(?:\.\d+)?)([KMGT]?)I?B?", text)
+    if not match:
+        raise RuntimeError(f"Invalid size '{value}'. Use values like 512MB or 12GB.")
+    number, unit = match.groups()
+    return int(float(number) * units.get(unit, 1))
+
+
+def available_memory_bytes(device: str) -> int | None:
+    import torch
+
+    if device == "cuda" and torch.cuda.is_available():
+        free, _ = torch.cuda.mem_get_info()
+        return int(free)
+    if device == "mps" and torch.backends.mps.is_available():
+        try:
+            return int(torch.mps.recommended_max_memory() - torch.mps.driver_allocated_memory())
+        except Exception:
+            return None
+    try:
+        with open("/proc/meminfo", "r", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return int(os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE"))
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def max_batch_size(
+    device: str,
+    dtype: "torch.dtype",
+    height: int,
+    width: int,
+    guidance_scale: float,
+    requested: int,
+) -> int:
+    available = available_memory_bytes(device)
+    if available is None:
+        return requested
+    # Rough SDXL UNet activation footprint: ~1.5 GiB per 1024x1024 fp16 sample,
+    # doubled when classifier-free guidance runs the negative branch alongside.
+    import torch
+
+    per_image = 1.5 * (1 << 30) * (height * width) / (1024 * 1024)
+    per_image *= torch.finfo(dtype).bits / 16
+    if guidance_scale > 1.0:
+        per_image *= 2
+    fits = int(available * 0.8 // per_image)
+    return max(1, min(requested, fits))
+
+
+def check_memory_budget(
+    pipe: "StableDiffusionXLPipeline", args: argparse.Namespace, device: str
+) -> dict[str, object] | None:
+    """Load-time check of --max-memory against the configured request shape."""
+    budget = parse_size(getattr(args, "max_memory", None))
+    if not budget:
+        return None
+    from memory_budget import plan_memory
+
+    plan = plan_memory(
+        pipe,
+        device,
+        budget,
+        args.height,
+        args.width,
+        args.guidance_scale,
+        getattr(args, "batch_size", None) or 1,
+        available_memory_bytes(device),
+    )
+    if plan.weight_bytes >= budget:
+        raise RuntimeError(
+            f"--max-memory {args.max_memory} is smaller than the resident model weights "
+            f"({plan.weight_bytes / (1 << 30):.2f} GiB)"
+        )
+    return plan.as_dict()
+
+
+def expand_batch(
+    args: argparse.Namespace, positive: str, negative: str
+) -> tuple[list[str], list[str], list[int]]:
+    positives = getattr(args, "positive_prompts", None) or [positive]
+    negatives = getattr(args, "negative_prompts", None) or [negative]
+    seeds = getattr(args, "seeds", None) or []
+    count = max(getattr(args, "batch_size", None) or 1, len(positives), len(seeds))
+
+    if len(positives) not in {1, count}:
+        raise RuntimeError("positive_prompts must have one entry or one per image")
+    if len(negatives) not in {1, count}:
+        raise RuntimeError("negative_prompts must have one entry or one per image")
+    if len(positives) == 1:
+        positives = positives * count
+    if len(negatives) == 1:
+        negatives = negatives * count
+
+    if not seeds:
+        if args.seed is not None:
+            seeds = [args.seed + index for index in range(count)]
+        else:
+            seeds = [random.randrange(2**32) for _ in range(count)]
+    elif len(seeds) < count:
+        seeds = seeds + [seeds[-1] + index for index in range(1, count - len(seeds) + 1)]
+    return positives, negatives, seeds
+
 
-    result = pipe(
-        prompt=positive,
-        negative_prompt=negative,
+def resolve_sampler_stages(args: argparse.Namespace) -> list[dict[str, object]]:
+    from schedulers import DEFAULT_SAMPLER, DEFAULT_SCHEDULE
+
+    raw_samplers = getattr(args, "ksamplers", None)
+    if not isinstance(raw_samplers, list):
+        return []
+
+    stages: list[dict[str, object]] = []
+    for sampler in raw_samplers:
+        if not isinstance(sampler, dict):
+            continue
+        try:
+            start = int(sampler.get("start_at_step", 0) or 0)
+            end = int(sampler.get("end_at_step", args.steps) or args.steps)
+            raw_cfg = sampler.get("cfg")
+            cfg = float(raw_cfg) if raw_cfg is not None else args.guidance_scale
+        except Exception:
+            raise RuntimeError(f"Invalid ksampler entry: {sampler}")
+        model = sampler.get("model")
+        stages.append(
+            {
+                "name": sampler.get("name", f"stage{len(stages)}"),
+                "model": model if isinstance(model, str) and model.strip() else None,
+                "start": start,
+                "end": end,
+                "cfg": cfg,
+                "sampler_name": str(
+                    sampler.get("sampler_name")
+                    or getattr(args, "sampler_name", None)
+                    or DEFAULT_SAMPLER
+                ),
+                "scheduler": str(
+                    sampler.get("scheduler") or getattr(args, "scheduler", None) or DEFAULT_SCHEDULE
+                ),
+            }
+        )
+    if not stages:
+        return []
+
+    # Each stage hands off where the next one starts, so "base 0-50" followed by
+    # "refiner from 25" runs the base for steps 0-25 and the refiner for 25-50.
+    stages.sort(key=lambda stage: stage["start"])
+    total = max(stage["end"] for stage in stages)
+    chain: list[dict[str, object]] = []
+    for index, stage in enumerate(stages):
+        if index + 1 < len(stages):
+            stage["end"] = min(stage["end"], stages[index + 1]["start"])
+        if stage["end"] <= stage["start"]:
+            continue
+        stage["denoising_start"] = stage["start"] / total if stage["start"] > 0 else None
+        stage["denoising_end"] = stage["end"] / total if stage["end"] < total else None
+        chain.append(stage)
+    return chain
+
+
+def stage_pipeline(
+    pipe: "StableDiffusionXLPipeline", model: str | None
+) -> tuple["StableDiffusionXLImg2ImgPipeline", bool]:
+    from diffusers import StableDiffusionXLImg2ImgPipeline
+
+    base_path = getattr(pipe, "asset_base_model", None)
+    model_path = resolve_base_model(model) if model else base_path
+    if model_path is None or base_path is None or Path(model_path).resolve() == Path(base_path).resolve():
+        # Same checkpoint: wrap the already-loaded components, UNet included. The
+        # wrapper swaps schedulers from the checkpoint's config, not the current one.
+        shared = StableDiffusionXLImg2ImgPipeline(**pipe.components)
+        shared.asset_scheduler_config = getattr(pipe, "asset_scheduler_config", None)
+        shared.asset_schedulers = getattr(pipe, "asset_schedulers", {})
+        shared.asset_scheduler_key = getattr(pipe, "asset_scheduler_key", None)
+        return shared, True
+
+    stage_pipes = getattr(pipe, "asset_stage_pipes", None)
+    if stage_pipes is None:
+        stage_pipes = {}
+        pipe.asset_stage_pipes = stage_pipes
+    key = str(Path(model_path).resolve())
+    if key not in stage_pipes:
+        kwargs: dict[str, object] = {
+            "torch_dtype": pipe.unet.dtype,
+            "use_safetensors": True,
+            "vae": pipe.vae,
+        }
+        if Path(model_path).is_file():
+            refiner = StableDiffusionXLImg2ImgPipeline.from_single_file(model_path, **kwargs)
+        else:
+            refiner = StableDiffusionXLImg2ImgPipeline.from_pretrained(model_path, **kwargs)
+        cpu_options = getattr(pipe, "asset_cpu_options", None)
+        residency = getattr(pipe, "asset_residency", None)
+        if residency is None:
+            refiner.to(pipe.device)
+        if cpu_options is not None:
+            from cpu_inference import optimize_pipeline
+
+            optimize_pipeline(refiner, cpu_options)
+        if residency is not None:
+            residency.manage_pipeline(refiner, prefix=Path(model_path).stem)
+        stage_pipes[key] = refiner
+    return stage_pipes[key], False
+
+
+def run_sampler_chain(
+    pipe: "StableDiffusionXLPipeline",
+    stages: list[dict[str, object]],
+    args: argparse.Namespace,
+    prompt_kwargs: dict[str, object],
+    text_kwargs: dict[str, object],
+    generators: list["torch.Generator"],
+    step_kwargs: dict[str, object],
+    output_type: str = "pil",
+) -> list[object]:
+    from schedulers import apply_scheduler
+
+    first = stages[0]
+    apply_scheduler(pipe, first["sampler_name"], first["scheduler"])
+    latents = pipe(
+        **prompt_kwargs,
+        **step_kwargs,
         num_inference_steps=args.steps,
-        guidance_scale=args.guidance_scale,
+        guidance_scale=first["cfg"],
         height=args.height,
         width=args.width,
-        generator=generator,
+        denoising_end=first["denoising_end"],
+        generator=generators,
+        output_type="latent",
+    ).images
+
+    for index, stage in enumerate(stages[1:], start=1):
+        last = index == len(stages) - 1
+        stage_pipe, shared = stage_pipeline(pipe, stage["model"])
+        apply_scheduler(stage_pipe, stage["sampler_name"], stage["scheduler"])
+        tracing.instrument_pipeline(stage_pipe)
+        # Latents go straight into the next stage; no VAE decode/encode in between.
+        latents = stage_pipe(
+            **(prompt_kwargs if shared else text_kwargs),
+            **step_kwargs,
+            image=latents,
+            num_inference_steps=args.steps,
+            guidance_scale=stage["cfg"],
+            denoising_start=stage["denoising_start"],
+            denoising_end=stage["denoising_end"],
+            generator=generators,
+            output_type=output_type if last else "latent",
+        ).images
+    return list(latents)
+
+
+def generate(
+    pipe: "StableDiffusionXLPipeline",
+    args: argparse.Namespace,
+    device: str,
+    positive: str,
+    negative: str,
+    prompt_cache: "PromptEmbeddingCache | None" = None,
+    monitor: "StepMonitor | None" = None,
+    on_images: "Callable[[int, list[object], int], None] | None" = None,
+    output_type: str = "pil",
+) -> tuple[list[object], list[int]]:
+    """
+    Runs the batch in memory-sized chunks and returns the images with their seeds.
+
+    With `output_type="latent"` the denoised latents are returned instead of
+    decoded images, one `[4, h/8, w/8]` tensor per image.
+    """
+    import torch
+    from cpu_inference import autocast
+    from schedulers import apply_scheduler
+
+    positives, negatives, seeds = expand_batch(args, positive, negative)
+    generator_device = device if device in {"cuda", "cpu"} else "cpu"
+    stages = resolve_sampler_stages(args)
+    guidance = max([args.guidance_scale] + [stage["cfg"] for stage in stages])
+
+    budget = parse_size(getattr(args, "max_memory", None))
+    plan = None
+    restore_vae_slicing = False
+    if budget:
+        from memory_budget import apply_memory_plan, plan_memory
+
+        plan = plan_memory(
+            pipe,
+            device,
+            budget,
+            args.height,
+            args.width,
+            guidance,
+            len(positives),
+            available_memory_bytes(device),
+        )
+        if not plan.fits:
+            print(
+                f"Warning: even the leanest settings are estimated at "
+                f"{plan.estimated_peak_bytes / (1 << 30):.2f} GiB, over the "
+                f"{budget / (1 << 30):.2f} GiB --max-memory budget"
+            )
+        apply_memory_plan(pipe, plan)
+        chunk_size = plan.chunk_size
+    else:
+        chunk_size = max_batch_size(
+            device,
+            pipe.unet.dtype,
+            args.height,
+            args.width,
+            args.guidance_scale,
+            len(positives),
+        )
+        if chunk_size > 1 and not getattr(pipe.vae, "use_slicing", False):
+            # Decode one image at a time so the VAE peak does not scale with the batch;
+            # switched off again afterwards so later single-image runs decode at full speed.
+            pipe.enable_vae_slicing()
+            restore_vae_slicing = True
+    tracing.instrument_pipeline(pipe)
+    step_kwargs: dict[str, object] = {}
+    if monitor is not None:
+        step_kwargs = {
+            "callback_on_step_end": monitor,
+            "callback_on_step_end_tensor_inputs": ["latents"],
+        }
+
+    images: list[object] = []
+    try:
+        for start in range(0, len(positives), chunk_size):
+            end = start + chunk_size
+            if monitor is not None:
+                monitor.begin(start)
+            generators = [
+                torch.Generator(generator_device).manual_seed(seed) for seed in seeds[start:end]
+            ]
+            clip_skip = getattr(args, "clip_skip", None)
+            text_kwargs: dict[str, object] = {
+                "prompt": positives[start:end],
+                "negative_prompt": negatives[start:end],
+                "clip_skip": clip_skip,
+            }
+            if prompt_cache is not None:
+                with autocast(pipe):
+                    prompt_kwargs: dict[str, object] = prompt_cache.encode_batch(
+                        pipe,
+                        positives[start:end],
+                        negatives[start:end] if guidance > 1.0 else None,
+                        clip_skip,
+                    )
+            else:
+                prompt_kwargs = text_kwargs
+
+            with tracing.stage("denoise"), autocast(pipe):
+                if len(stages) > 1:
+                    chunk = run_sampler_chain(
+                        pipe,
+                        stages,
+                        args,
+                        prompt_kwargs,
+                        text_kwargs,
+                        generators,
+                        step_kwargs,
+                        output_type,
+                    )
+                else:
+                    if stages:
+                        apply_scheduler(pipe, stages[0]["sampler_name"], stages[0]["scheduler"])
+                    else:
+                        apply_scheduler(
+                            pipe, getattr(args, "sampler_name", None), getattr(args, "scheduler", None)
+                        )
+                    chunk = pipe(
+                        **prompt_kwargs,
+                        **step_kwargs,
+                        num_inference_steps=args.steps,
+                        guidance_scale=args.guidance_scale,
+                        height=args.height,
+                        width=args.width,
+                        generator=generators,
+                        output_type=output_type,
+                    ).images
+            images.extend(chunk)
+            if on_images is not None:
+                # Lets the caller start encoding this chunk while the next one denoises.
+                on_images(start, chunk, len(positives))
+        if plan is not None:
+            from memory_budget import report_memory
+
+            report_memory(plan, device)
+    except Exception:
+        # A cancelled or failed run leaves activations and partial latents behind;
+        # drop them now rather than when the next job happens to allocate.
+        images.clear()
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        elif torch.backends.mps.is_available():
+            torch.mps.empty_cache()
+        raise
+    finally:
+        if restore_vae_slicing:
+            pipe.disable_vae_slicing()
+    return images, seeds
+
+
+def create_prompt_cache(args: argparse.Namespace) -> "PromptEmbeddingCache | None":
+    if args.prompt_cache_size <= 0 and not args.prompt_cache_dir:
+        return None
+    from prompt_cache import PromptEmbeddingCache
+
+    return PromptEmbeddingCache(
+        max_entries=max(args.prompt_cache_size, 1), cache_dir=args.prompt_cache_dir
     )
-    image = result.images[0]
 
-    timestamp = int(time.time())
-    filename = f"{args.filename_prefix}_{timestamp}.png"
-    output_path = out_dir / filename
-    image.save(output_path)
 
-    print(f"Image saved to {output_path}")
+def create_model_cache(args: argparse.Namespace) -> "ModelCache | None":
+    cache_dir = args.model_cache_dir
+    if not cache_dir or cache_dir.lower() in {"none", "off", "disable"}:
+        return None
+    from model_cache import ModelCache
+
+    return ModelCache(
+        cache_dir, max_bytes=parse_size(args.model_cache_size), registry=model_registry()
+    )
 
 
-def main() -> None:
-    args = parse_args()
+def create_residency_manager(
+    args: argparse.Namespace, device: str
+) -> "ResidencyManager | None":
+    budget = parse_size(getattr(args, "residency_budget", None))
+    if not budget:
+        return None
+    from residency import ResidencyManager
+
+    return ResidencyManager(
+        device,
+        budget,
+        host_budget_bytes=parse_size(getattr(args, "residency_host_budget", None)),
+        offload_dir=getattr(args, "residency_dir", None),
+    )
+
+
+def create_prompt_enhancer(
+    args: argparse.Namespace, residency: "ResidencyManager | None" = None
+) -> "LLMPromptEnhancer | None":
+    """
+    Loads the text-to-text service's LLM in this process for `--enhance-prompt`.
+
+    With a residency manager the LLM shares its device budget with the SDXL
+    components, so it is paged out while the UNet runs instead of holding memory.
+    """
+    if not getattr(args, "enhance_prompt", False):
+        return None
+    import sys
+
+    if str(TEXT_SERVICE_DIR) not in sys.path:
+        sys.path.insert(0, str(TEXT_SERVICE_DIR))
+    from llm_prompt_enhancer import LLMPromptEnhancer
+
+    with tracing.stage("enhancer_load"):
+        return LLMPromptEnhancer(model_id=args.enhancer_model, residency=residency)
+
+
+def merge_negative(negative: str, enhanced: str) -> str:
+    return f"{negative}, {enhanced}" if negative and enhanced else negative or enhanced
+
+
+def enhance_prompts(
+    args: argparse.Namespace,
+    enhancer: "LLMPromptEnhancer",
+    positive: str,
+    negative: str,
+) -> tuple[str, str]:
+    """Rewrites the prompts with `enhancer`, keeping each original negative prompt."""
+    ideas = getattr(args, "positive_prompts", None) or [positive]
+    with tracing.stage("enhance_prompt"):
+        results = enhancer.enhance_prompts(ideas, style=args.enhance_style, seed=args.seed)
+    if getattr(args, "positive_prompts", None):
+        negatives = getattr(args, "negative_prompts", None) or [negative]
+        if len(negatives) == 1:
+            negatives = negatives * len(results)
+        args.positive_prompts = [result["positive"] for result in results]
+        args.negative_prompts = [
+            merge_negative(original, result["negative"])
+            for original, result in zip(negatives, results)
+        ]
+    positive = results[0]["positive"]
+    negative = merge_negative(negative, results[0]["negative"])
+    print(f"Enhanced prompt: {positive}")
+    print(f"Enhanced negative prompt: {negative}")
+    return positive, negative
+
+
+def create_result_cache(args: argparse.Namespace) -> "ResultCache | None":
+    cache_dir = getattr(args, "result_cache_dir", None)
+    if not cache_dir or cache_dir.lower() in {"none", "off", "disable"}:
+        return None
+    from result_cache import ResultCache
+
+    return ResultCache(cache_dir, max_bytes=parse_size(args.result_cache_size))
+
+
+def result_request(
+    args: argparse.Namespace,
+    base_model: str,
+    loras: list[tuple[str, str, float]],
+    positive: str,
+    negative: str,
+    device: str,
+    dtype: "torch.dtype",
+) -> dict[str, object] | None:
+    """
+    Everything that determines the generated pixels, for the result cache key.
+
+    Returns None when any seed would be drawn at random: such a request is not
+    reproducible, so it is neither served from nor stored in the cache.
+    """
+    if args.seed is None and not getattr(args, "seeds", None):
+        return None
+    # Content hashes, memoised in the model registry, so a changed file is a new key.
+    source_digest = model_registry().source_digest
+
+    positives, negatives, seeds = expand_batch(args, positive, negative)
+    cpu = None
+    if device == "cpu":
+        # Thread counts do not change the output; pool workers each get their own.
+        cpu = {
+            name: value
+            for name, value in asdict(create_cpu_options(args)).items()
+            if name not in {"threads", "interop_threads"}
+        }
+    return {
+        "base_model": source_digest(base_model),
+        "loras": [
+            [source_digest(str(Path(repo_or_dir) / weight_name)), float(scale)]
+            for repo_or_dir, weight_name, scale in loras
+        ],
+        "positives": positives,
+        "negatives": negatives,
+        "seeds": seeds,
+        "steps": args.steps,
+        "guidance_scale": args.guidance_scale,
+        "sampler_name": getattr(args, "sampler_name", None),
+        "scheduler": getattr(args, "scheduler", None),
+        "height": args.height,
+        "width": args.width,
+        "clip_skip": getattr(args, "clip_skip", None),
+        "samplers": [
+            {**stage, "model": source_digest(stage["model"]) if stage["model"] else None}
+            for stage in resolve_sampler_stages(args)
+        ],
+        "device": device,
+        "dtype": str(dtype),
+        "cpu": cpu,
+        # Attention slicing and VAE tiling chosen under a budget change the output slightly.
+        "max_memory": parse_size(getattr(args, "max_memory", None)),
+        "output_format": asdict(output_format(args)),
+    }
+
+
+def create_step_monitor(
+    args: argparse.Namespace,
+    prefix: str,
+    token: "CancellationToken | None" = None,
+    names: list[str] | None = None,
+) -> "StepMonitor | None":
+    if token is None and args.preview_every <= 0:
+        return None
+    from previews import PreviewWriter, StepMonitor
+
+    writer = None
+    if args.preview_every > 0:
+        preview_dir = Path(args.preview_dir or Path(args.output_dir) / "previews")
+        writer = PreviewWriter(preview_dir, prefix=f"{prefix}_preview", names=names)
+    return StepMonitor(token=token, preview_every=args.preview_every, on_preview=writer)
+
+
+def create_cpu_options(args: argparse.Namespace) -> "CPUOptions":
+    from cpu_inference import cpu_options
+
+    return cpu_options(
+        args.cpu_mode,
+        threads=args.cpu_threads,
+        interop_threads=args.cpu_interop_threads,
+        bf16=args.cpu_bf16,
+        channels_last=args.cpu_channels_last,
+        attention_slicing=args.cpu_attention_slicing,
+        quantize_text_encoders=args.cpu_quantize_text_encoders,
+    )
+
+
+def create_output_writer(args: argparse.Namespace) -> "OutputWriter":
+    from output_writer import OutputWriter
+
+    return OutputWriter(
+        workers=args.writer_threads,
+        atomic=args.atomic_writes,
+        fsync=args.fsync_outputs,
+    )
+
+
+def output_format(args: argparse.Namespace) -> "OutputFormat":
+    from output_writer import IMAGE_FORMATS, OutputFormat
+
+    extension = str(args.image_format).lower()
+    if extension not in IMAGE_FORMATS:
+        raise RuntimeError(
+            f"Unsupported image_format {args.image_format!r}; expected one of {', '.join(IMAGE_FORMATS)}"
+        )
+    return OutputFormat(
+        extension=extension,
+        compress_level=min(max(int(args.png_compress_level), 0), 9),
+        quality=min(max(int(args.image_quality), 0), 100),
+        lossless=bool(args.webp_lossless),
+    )
+
+
+def run(args: argparse.Namespace) -> None:
+    with tracing.trace_job(trace_file=args.trace_file) as trace:
+        base_model, loras, lora_repo_or_dir, lora_weight_name = preflight(args)
+
+        OUTPUTS_DIR.mkdir(parents=True, exist_ok=True)
+        out_dir = Path(args.output_dir)
+        out_dir.mkdir(parents=True, exist_ok=True)
+
+        device, dtype = select_device(args.device)
+
+        print_configuration(
+            args, device, dtype, base_model, loras, lora_repo_or_dir, lora_weight_name
+        )
+
+        # Prompts are resolved before loading so a result cache hit skips the model entirely.
+        positive, negative = resolve_prompts(args)
+        residency = create_residency_manager(args, device)
+        enhancer = create_prompt_enhancer(args, residency)
+        if enhancer is not None:
+            positive, negative = enhance_prompts(args, enhancer, positive, negative)
+        result_cache = create_result_cache(args)
+        request = None
+        cache_key = None
+        cached = None
+        if result_cache is not None:
+            lora_list = combine_loras(loras, lora_repo_or_dir, lora_weight_name)
+            request = result_request(args, base_model, lora_list, positive, negative, device, dtype)
+            if request is None:
+                print("Result cache bypassed: the seed is random")
+            else:
+                cache_key = result_cache.key(request)
+                with tracing.stage("result_cache"):
+                    cached = result_cache.lookup(cache_key)
+                trace.annotate("result_cache", {"key": cache_key, "hit": cached is not None})
+
+        if cached is not None:
+            for output_path, seed in zip(cached["images"], cached["seeds"]):
+                print(f"Image reused from result cache: {output_path} (seed {seed})")
+        else:
+            pipe = build_pipeline(
+                base_model=base_model,
+                device=device,
+                dtype=dtype,
+                lora_repo_or_dir=lora_repo_or_dir,
+                lora_weight_name=lora_weight_name,
+                loras=loras,
+                model_cache=create_model_cache(args),
+                cpu_options=create_cpu_options(args),
+                residency=residency,
+            )
+
+            prompt_cache = create_prompt_cache(args)
+            monitor = create_step_monitor(args, args.filename_prefix)
+            writer = create_output_writer(args)
+            image_format = output_format(args)
+            batches = []
+
+            def write_chunk(start: int, chunk: list[object], total: int) -> None:
+                batches.append(
+                    writer.submit(chunk, out_dir, args.filename_prefix, image_format, start, total)
+                )
+
+            try:
+                _, seeds = generate(
+                    pipe, args, device, positive, negative, prompt_cache, monitor, write_chunk
+                )
+                with tracing.stage("save"):
+                    paths = [path for batch in batches for path in batch.result()]
+            finally:
+                writer.close()
+            if cache_key is not None:
+                with tracing.stage("result_cache"):
+                    result_cache.store(cache_key, paths, seeds, request)
+            for output_path, seed in zip(paths, seeds):
+                print(f"Image saved to {output_path} (seed {seed})")
+        if residency is not None:
+            residency.report()
+    print(json.dumps(trace.record()))
+    if args.metrics_file:
+        tracing.METRICS.write(args.metrics_file)
+
+
+def dispatch(args: argparse.Namespace) -> None:
+    if args.cancel:
+        from job_queue import open_queue
+
+        queue = open_queue(args.queue, args.queue_path)
+        state = queue.cancel(args.cancel)
+        print(f"Job {args.cancel}: {state}")
+        return
+    if args.http or args.serve or args.pool:
+        # The worker modules import torch; reject bad input before paying for it.
+        preflight(args)
+    if args.pool:
+        from pool import run_pool
+
+        manifest = run_pool(args)
+        summary = manifest["summary"]
+        if summary["failed"] or summary["unfinished"]:
+            raise SystemExit(1)
+        return
+    if args.http:
+        from http_server import serve_http
+
+        serve_http(args)
+        return
+    if args.serve:
+        from worker import serve
+
+        serve(args)
+        return
+    if args.workflow:
+        from workflow import run_workflow
+
+        run_workflow(args)
+        return
+    if args.finalize:
+        from drafts import run_finalize
+
+        run_finalize(args)
+        return
+    if args.draft:
+        from drafts import run_drafts
+
+        run_drafts(args)
+        return
     run(args)
 
 
+def main() -> None:
+    dispatch(parse_args())
+
+
 if __name__ == "__main__":
     main()
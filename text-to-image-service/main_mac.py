@@ -1,13 +1,13 @@
 import argparse
 
-from main import parse_args, run
+from main import dispatch, parse_args
 
 
 def main() -> None:
     args = parse_args()
     if args.device == "auto":
         args.device = "mps"
-    run(args)
+    dispatch(args)
 
 
 if __name__ == "__main__":
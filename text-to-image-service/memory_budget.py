@@ -0,0 +1,209 @@
+import json
+from dataclasses import asdict, dataclass
+from typing import TYPE_CHECKING
+
+import tracing
+
+if TYPE_CHECKING:
+    import torch
+    from diffusers import StableDiffusionXLPipeline
+
+
+GIB = 1 << 30
+# Rough SDXL working-set sizes per 1024x1024 image. The UNet figure is the existing
+# fp16 activation estimate; ATTENTION_SHARE of it is attention scores, which slicing
+# one head at a time almost removes. The VAE decoder runs in fp32 (SDXL's VAE is
+# upcast) and its up-blocks dominate the whole pipeline's peak at high resolution.
+UNET_BYTES_PER_MEGAPIXEL = 1.5 * GIB
+ATTENTION_SHARE = 0.4
+SLICED_ATTENTION_KEEP = 0.1
+VAE_BYTES_PER_MEGAPIXEL = 3.0 * GIB
+# Tiles are decoded at 512x512 with 25% overlap and blended.
+VAE_TILE_SIZE = 512
+VAE_TILE_MEGAPIXELS = (VAE_TILE_SIZE * VAE_TILE_SIZE) / (1024 * 1024) * 1.25
+# Headroom for allocator fragmentation and small buffers the estimate ignores.
+SAFETY_MARGIN = 0.9
+
+VAE_MODES = ("full", "sliced", "tiled")
+
+
+@dataclass(frozen=True)
+class MemoryPlan:
+    """How one generation call is shaped to stay under a memory budget."""
+
+    budget_bytes: int
+    weight_bytes: int
+    chunk_size: int
+    attention_slicing: bool
+    vae_mode: str
+    estimated_peak_bytes: int
+    fits: bool
+
+    def as_dict(self) -> dict[str, object]:
+        return asdict(self)
+
+
+def megapixels(height: int, width: int) -> float:
+    return (height * width) / (1024 * 1024)
+
+
+def resident_weight_bytes(pipe: "StableDiffusionXLPipeline", device: str) -> int:
+    import torch
+
+    sizes = []
+    for component in pipe.components.values():
+        if isinstance(component, torch.nn.Module):
+            sizes.append(
+                sum(
+                    tensor.numel() * tensor.element_size()
+                    for tensor in list(component.parameters()) + list(component.buffers())
+                )
+            )
+    if not sizes:
+        return 0
+    residency = getattr(pipe, "asset_residency", None)
+    if residency is not None:
+        return min(sum(sizes), residency.budget_bytes)
+    # With model CPU offload (MPS) only the component that is running is resident.
+    return max(sizes) if device == "mps" else sum(sizes)
+
+
+def unet_bytes(
+    height: int, width: int, dtype: "torch.dtype", guidance_scale: float, attention_slicing: bool
+) -> float:
+    import torch
+
+    per_image = UNET_BYTES_PER_MEGAPIXEL * megapixels(height, width)
+    per_image *= torch.finfo(dtype).bits / 16
+    if guidance_scale > 1.0:
+        per_image *= 2
+    if attention_slicing:
+        per_image *= 1.0 - ATTENTION_SHARE * (1.0 - SLICED_ATTENTION_KEEP)
+    return per_image
+
+
+def vae_bytes(height: int, width: int, count: int, mode: str) -> float:
+    # The decoded images themselves (fp32 RGB) are held for the whole chunk.
+    outputs = count * height * width * 3 * 4
+    if mode == "tiled":
+        return VAE_BYTES_PER_MEGAPIXEL * min(VAE_TILE_MEGAPIXELS, megapixels(height, width)) + outputs
+    if mode == "sliced":
+        return VAE_BYTES_PER_MEGAPIXEL * megapixels(height, width) + outputs
+    return VAE_BYTES_PER_MEGAPIXEL * megapixels(height, width) * count + outputs
+
+
+def plan_memory(
+    pipe: "StableDiffusionXLPipeline",
+    device: str,
+    budget_bytes: int,
+    height: int,
+    width: int,
+    guidance_scale: float,
+    requested: int,
+    available_bytes: int | None = None,
+) -> MemoryPlan:
+    """
+    Picks the fastest configuration whose estimated peak fits the budget.
+
+    Options are tried from cheapest to most expensive: sliced, then tiled VAE
+    decode (small slowdowns at decode time only), then attention slicing (slows
+    every step), then splitting the batch into smaller pipeline calls. The UNet
+    and the VAE run one after the other, so the peak is the larger of the two on
+    top of the resident weights.
+    """
+    requested = max(requested, 1)
+    weights = resident_weight_bytes(pipe, device)
+    working = budget_bytes * SAFETY_MARGIN - weights
+    if available_bytes is not None:
+        working = min(working, available_bytes * SAFETY_MARGIN)
+    dtype = pipe.unet.dtype
+
+    def estimate(chunk: int, slicing: bool, vae_mode: str) -> float:
+        denoise = chunk * unet_bytes(height, width, dtype, guidance_scale, slicing)
+        return max(denoise, vae_bytes(height, width, chunk, vae_mode))
+
+    for chunk in range(requested, 0, -1):
+        for slicing in (False, True):
+            for vae_mode in VAE_MODES:
+                if vae_mode == "sliced" and chunk == 1:
+                    continue
+                peak = estimate(chunk, slicing, vae_mode)
+                if peak <= working:
+                    return MemoryPlan(
+                        budget_bytes=budget_bytes,
+                        weight_bytes=weights,
+                        chunk_size=chunk,
+                        attention_slicing=slicing,
+                        vae_mode=vae_mode,
+                        estimated_peak_bytes=int(weights + peak),
+                        fits=True,
+                    )
+    # Nothing fits: run the leanest configuration and let the caller warn.
+    return MemoryPlan(
+        budget_bytes=budget_bytes,
+        weight_bytes=weights,
+        chunk_size=1,
+        attention_slicing=True,
+        vae_mode="tiled",
+        estimated_peak_bytes=int(weights + estimate(1, True, "tiled")),
+        fits=False,
+    )
+
+
+def apply_memory_plan(pipe: "StableDiffusionXLPipeline", plan: MemoryPlan) -> None:
+    previous = getattr(pipe, "asset_memory_plan", None)
+    if plan.attention_slicing:
+        pipe.enable_attention_slicing(1)
+    elif previous is not None and previous.attention_slicing:
+        cpu_options = getattr(pipe, "asset_cpu_options", None)
+        if cpu_options is not None and cpu_options.attention_slicing:
+            pipe.enable_attention_slicing()
+        else:
+            pipe.disable_attention_slicing()
+
+    if plan.vae_mode == "tiled":
+        vae = pipe.vae
+        if hasattr(vae, "tile_sample_min_size"):
+            # SDXL's VAE only tiles above its 1024px sample size by default.
+            vae.tile_sample_min_size = VAE_TILE_SIZE
+            vae.tile_latent_min_size = VAE_TILE_SIZE // 8
+        pipe.enable_vae_tiling()
+    else:
+        pipe.disable_vae_tiling()
+    if plan.vae_mode == "sliced":
+        pipe.enable_vae_slicing()
+    else:
+        pipe.disable_vae_slicing()
+    pipe.asset_memory_plan = plan
+
+
+def measured_peak_bytes(device: str) -> int | None:
+    """The highest memory use seen so far in this job (accelerator peak, or process RSS on CPU)."""
+    if device == "cpu":
+        return tracing.max_rss_bytes()
+    trace = tracing.active_trace()
+    peaks = []
+    if trace is not None:
+        peaks = [
+            int(entry["accelerator_peak_bytes"])
+            for entry in trace.stages.values()
+            if entry.get("accelerator_peak_bytes")
+        ]
+    current = tracing.accelerator_peak_bytes()
+    if current is not None:
+        peaks.append(current)
+    return max(peaks) if peaks else None
+
+
+def report_memory(plan: MemoryPlan, device: str) -> dict[str, object]:
+    peak = measured_peak_bytes(device)
+    report = {
+        **plan.as_dict(),
+        "peak_bytes": peak,
+        "within_budget": peak is None or peak <= plan.budget_bytes,
+    }
+    trace = tracing.active_trace()
+    if trace is not None:
+        trace.annotate("memory", report)
+    print(json.dumps({"event": "memory", **report}))
+    return report
@@ -0,0 +1,168 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+import uuid
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import torch
+    from diffusers import StableDiffusionXLPipeline
+
+    from model_registry import ModelRegistry
+
+
+META_NAME = "asset_cache.json"
+
+
+def directory_size(path: Path) -> int:
+    return sum(p.stat().st_size for p in path.rglob("*") if p.is_file())
+
+
+class ModelCache:
+    """
+    Disk cache of SDXL pipelines already converted to diffusers format.
+
+    An entry is the output of `save_pretrained` for a pipeline that was loaded from
+    a checkpoint, cast to the target dtype and had its LoRAs fused, so a later cold
+    start skips single-file conversion and LoRA fusing and just memory-maps the
+    safetensors shards. Entries are keyed by the content hashes of the checkpoint
+    and LoRA files, the LoRA scales, the dtype and the diffusers version. The
+    hashes come from the model registry, which keeps them by (path, size, mtime)
+    so unchanged multi-GB checkpoints are hashed once. When the cache grows past
+    `max_bytes`, the least recently used entries are deleted.
+    """
+
+    def __init__(
+        self,
+        root: str | Path,
+        max_bytes: int | None = None,
+        registry: "ModelRegistry | None" = None,
+    ):
+        if registry is None:
+            from model_registry import DEFAULT_MODELS_DIR, get_registry
+
+            registry = get_registry(DEFAULT_MODELS_DIR)
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self.registry = registry
+        self.hits = 0
+        self.misses = 0
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def key(
+        self,
+        base_model: str,
+        dtype: "torch.dtype",
+        loras: list[tuple[str, str, float]],
+    ) -> str:
+        import diffusers
+
+        parts: list[object] = [
+            "sdxl",
+            diffusers.__version__,
+            str(dtype),
+            self.registry.source_digest(base_model),
+        ]
+        for repo_or_dir, weight_name, scale in loras:
+            weight_path = Path(repo_or_dir) / weight_name
+            source = str(weight_path) if weight_path.is_file() else f"{repo_or_dir}::{weight_name}"
+            parts.append([self.registry.source_digest(source), float(scale)])
+        return hashlib.sha256(json.dumps(parts).encode("utf-8")).hexdigest()[:32]
+
+    def load(
+        self,
+        base_model: str,
+        dtype: "torch.dtype",
+        loras: list[tuple[str, str, float]],
+    ) -> "StableDiffusionXLPipeline | None":
+        from diffusers import StableDiffusionXLPipeline
+
+        entry = self.root / self.key(base_model, dtype, loras)
+        if not (entry / META_NAME).is_file():
+            self.misses += 1
+            return None
+        try:
+            # from_pretrained memory-maps the safetensors shards rather than copying them.
+            pipe = StableDiffusionXLPipeline.from_pretrained(
+                str(entry), torch_dtype=dtype, use_safetensors=True
+            )
+        except Exception as exc:
+            print(f"Model cache entry {entry.name} is unreadable ({exc}); rebuilding it")
+            shutil.rmtree(entry, ignore_errors=True)
+            self.misses += 1
+            return None
+        os.utime(entry / META_NAME)
+        self.hits += 1
+        return pipe
+
+    def store(
+        self,
+        pipe: "StableDiffusionXLPipeline",
+        base_model: str,
+        dtype: "torch.dtype",
+        loras: list[tuple[str, str, float]],
+    ) -> Path | None:
+        key = self.key(base_model, dtype, loras)
+        entry = self.root / key
+        if (entry / META_NAME).is_file():
+            return entry
+        tmp_entry = self.root / f".{key}.{uuid.uuid4().hex}.tmp"
+        try:
+            pipe.save_pretrained(str(tmp_entry), safe_serialization=True)
+            size = directory_size(tmp_entry)
+            meta = {
+                "base_model": base_model,
+                "loras": [list(lora) for lora in loras],
+                "dtype": str(dtype),
+                "bytes": size,
+                "created_at": time.time(),
+            }
+            with (tmp_entry / META_NAME).open("w", encoding="utf-8") as f:
+                json.dump(meta, f, indent=2)
+            self._evict(size)
+            os.rename(tmp_entry, entry)
+        except OSError as exc:
+            # A full disk or a racing writer must not fail the generation itself.
+            print(f"Could not store model cache entry {key}: {exc}")
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+            return None
+        return entry
+
+    def entries(self) -> list[tuple[Path, int, float]]:
+        found: list[tuple[Path, int, float]] = []
+        for meta_path in self.root.glob(f"*/{META_NAME}"):
+            if meta_path.parent.name.startswith("."):
+                # In-progress stores; they are not entries until renamed into place.
+                continue
+            try:
+                with meta_path.open("r", encoding="utf-8") as f:
+                    size = int(json.load(f).get("bytes", 0))
+                found.append((meta_path.parent, size, meta_path.stat().st_mtime))
+            except (OSError, ValueError):
+                continue
+        return found
+
+    def _evict(self, incoming: int) -> None:
+        if self.max_bytes is None:
+            return
+        entries = sorted(self.entries(), key=lambda item: item[2])
+        total = sum(size for _, size, _ in entries) + incoming
+        for path, size, _ in entries:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+            print(f"Evicted model cache entry {path.name}")
+
+    def stats(self) -> dict[str, object]:
+        entries = self.entries()
+        return {
+            "entries": len(entries),
+            "bytes": sum(size for _, size, _ in entries),
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
@@ -0,0 +1,414 @@
+import argparse
+import hashlib
+import json
+import os
+import re
+import struct
+import threading
+import uuid
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+
+
+DEFAULT_MODELS_DIR = Path(__file__).resolve().parent / "models"
+INDEX_NAME = "registry.json"
+INDEX_VERSION = 1
+HASH_CHUNK_BYTES = 8 << 20
+# A safetensors header is a JSON object; anything larger is not a real header.
+MAX_HEADER_BYTES = 100 << 20
+MODEL_KINDS = ("checkpoint", "lora")
+KIND_DIRS = {"checkpoint": "checkpoints", "lora": "loras"}
+
+# Width of the cross-attention keys (the text embedding size) per architecture.
+CONTEXT_DIMS = {768: "sd1", 1024: "sd2", 1280: "sdxl-refiner", 2048: "sdxl"}
+CROSS_ATTENTION_KEY = re.compile(r"attn2[._]to_k[._]")
+LORA_DOWN_KEY = re.compile(r"(lora_down|lora_A|lora\.down)\.weight$")
+# Embedded metadata worth keeping in the index; training tag dumps can be megabytes.
+METADATA_KEYS = (
+    "ss_output_name",
+    "ss_base_model_version",
+    "ss_network_dim",
+    "ss_network_alpha",
+    "modelspec.architecture",
+    "modelspec.title",
+    "modelspec.trigger_phrase",
+)
+
+
+@dataclass
+class ModelInfo:
+    """What the registry knows about one model file or diffusers directory."""
+
+    path: str
+    kind: str
+    size: int
+    mtime_ns: int
+    architecture: str = "unknown"
+    context_dim: int | None = None
+    tensors: int = 0
+    dtypes: list[str] = field(default_factory=list)
+    rank: int | None = None
+    trigger: str | None = None
+    metadata: dict[str, str] = field(default_factory=dict)
+    sha256: str | None = None
+
+    @property
+    def name(self) -> str:
+        return Path(self.path).name
+
+
+def read_safetensors_header(path: str | Path) -> dict[str, object]:
+    """Reads only the JSON header of a safetensors file; no tensor data is touched."""
+    with open(path, "rb") as f:
+        prefix = f.read(8)
+        if len(prefix) != 8:
+            raise RuntimeError(f"'{path}' is too short to be a safetensors file")
+        (length,) = struct.unpack("<Q", prefix)
+        if length > MAX_HEADER_BYTES:
+            raise RuntimeError(f"'{path}' has an implausible safetensors header ({length} bytes)")
+        raw = f.read(length)
+    try:
+        header = json.loads(raw)
+    except ValueError as exc:
+        raise RuntimeError(f"'{path}' has an unreadable safetensors header: {exc}")
+    if not isinstance(header, dict):
+        raise RuntimeError(f"'{path}' has an unreadable safetensors header")
+    return header
+
+
+def architecture_for(context_dim: int | None) -> str:
+    return CONTEXT_DIMS.get(context_dim, "unknown") if context_dim else "unknown"
+
+
+def describe_header(info: ModelInfo, header: dict[str, object]) -> None:
+    metadata = header.get("__metadata__") or {}
+    tensors = {name: value for name, value in header.items() if name != "__metadata__"}
+    info.tensors = len(tensors)
+    info.dtypes = sorted({str(value.get("dtype")) for value in tensors.values() if isinstance(value, dict)})
+    info.metadata = {
+        key: str(metadata[key])[:256] for key in METADATA_KEYS if isinstance(metadata, dict) and key in metadata
+    }
+
+    for name, value in tensors.items():
+        if not isinstance(value, dict) or not CROSS_ATTENTION_KEY.search(name):
+            continue
+        shape = value.get("shape") or []
+        if info.kind == "lora":
+            # The down projection of to_k maps the text embedding to the rank.
+            if LORA_DOWN_KEY.search(name) and len(shape) >= 2:
+                info.rank = int(shape[0])
+                info.context_dim = int(shape[1])
+                break
+        elif name.endswith("weight") and len(shape) == 2:
+            info.context_dim = int(shape[1])
+            break
+    info.architecture = architecture_for(info.context_dim)
+
+    if info.architecture == "unknown":
+        version = (info.metadata.get("ss_base_model_version") or info.metadata.get("modelspec.architecture") or "").lower()
+        names = tensors.keys()
+        if "xl" in version or any(name.startswith(("lora_te2_", "text_encoder_2.")) for name in names):
+            info.architecture = "sdxl"
+        elif "v2" in version:
+            info.architecture = "sd2"
+        elif "v1" in version:
+            info.architecture = "sd1"
+    if info.kind == "lora":
+        info.trigger = info.metadata.get("modelspec.trigger_phrase") or info.metadata.get("ss_output_name")
+
+
+def describe_directory(info: ModelInfo, path: Path) -> None:
+    """Diffusers-format pipelines: read the small JSON configs instead of the weights."""
+    try:
+        with (path / "unet" / "config.json").open("r", encoding="utf-8") as f:
+            unet_config = json.load(f)
+        context_dim = unet_config.get("cross_attention_dim")
+        info.context_dim = int(context_dim) if isinstance(context_dim, int) else None
+    except (OSError, ValueError):
+        info.context_dim = None
+    info.architecture = architecture_for(info.context_dim)
+
+
+def file_sha256(path: Path) -> str:
+    digest = hashlib.sha256()
+    with path.open("rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_BYTES), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ModelRegistry:
+    """
+    Index of the checkpoints and LoRAs under `models/`.
+
+    A scan lists `models/checkpoints` and `models/loras` once and reads only the
+    safetensors JSON headers (a few KB per file): tensor count, dtypes, the
+    cross-attention width that identifies SD1/SD2/SDXL/refiner, the LoRA rank
+    and embedded metadata such as the trigger phrase. The index is persisted
+    next to the models and refreshed incrementally: an entry is re-read only
+    when its size or mtime changed. Content hashes are computed on demand (or by
+    `python model_registry.py --hash`) and kept until the file changes. This is
+    the only content-hash memo: the model and result caches key on it too,
+    including the files inside diffusers directories and models outside
+    `models/`. Lookups by path, file name, stem or LoRA trigger name are
+    dictionary hits.
+    """
+
+    def __init__(self, models_dir: str | Path, index_path: str | Path | None = None):
+        self.models_dir = Path(models_dir)
+        self.index_path = Path(index_path) if index_path else self.models_dir / INDEX_NAME
+        self._entries: dict[str, ModelInfo] = {}
+        self._names: dict[tuple[str, str], ModelInfo] = {}
+        # Content hashes of files that are not index entries, by resolved path.
+        self._hashes: dict[str, dict[str, object]] = {}
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._load()
+        self.refresh()
+
+    def _load(self) -> None:
+        try:
+            with self.index_path.open("r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if not isinstance(data, dict) or data.get("version") != INDEX_VERSION:
+            return
+        for raw in data.get("models", []):
+            try:
+                info = ModelInfo(**raw)
+            except TypeError:
+                continue
+            self._entries[info.path] = info
+        hashes = data.get("hashes")
+        if isinstance(hashes, dict):
+            self._hashes = {key: value for key, value in hashes.items() if isinstance(value, dict)}
+
+    def save(self) -> None:
+        if not self._dirty or not self.index_path.parent.is_dir():
+            return
+        data = {
+            "version": INDEX_VERSION,
+            "models": [asdict(info) for info in sorted(self._entries.values(), key=lambda info: info.path)],
+            "hashes": dict(sorted(self._hashes.items())),
+        }
+        tmp_path = self.index_path.with_name(f".{self.index_path.name}.{uuid.uuid4().hex}.tmp")
+        try:
+            with tmp_path.open("w", encoding="utf-8") as f:
+                json.dump(data, f, indent=2)
+            os.replace(tmp_path, self.index_path)
+            self._dirty = False
+        except OSError as exc:
+            # A read-only models volume still gets an in-memory index.
+            tmp_path.unlink(missing_ok=True)
+            print(f"Could not write model registry index {self.index_path}: {exc}")
+
+    def _candidates(self, kind: str) -> list[Path]:
+        root = self.models_dir / KIND_DIRS[kind]
+        found: list[Path] = []
+        for dirpath, dirnames, filenames in os.walk(root):
+            if kind == "checkpoint" and "model_index.json" in filenames and Path(dirpath) != root:
+                # A diffusers pipeline: one entry for the directory, not for its shards.
+                found.append(Path(dirpath))
+                dirnames[:] = []
+                continue
+            dirnames[:] = [name for name in dirnames if not name.startswith(".")]
+            found.extend(
+                Path(dirpath) / name
+                for name in filenames
+                if name.endswith(".safetensors") and not name.startswith(".")
+            )
+        return found
+
+    def _describe(self, path: Path, kind: str) -> ModelInfo | None:
+        try:
+            stat_path = path / "model_index.json" if path.is_dir() else path
+            stat = stat_path.stat()
+        except OSError:
+            return None
+        key = str(path.resolve())
+        known = self._entries.get(key)
+        if known is not None and known.size == stat.st_size and known.mtime_ns == stat.st_mtime_ns:
+            return known
+        info = ModelInfo(path=key, kind=kind, size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+        try:
+            if path.is_dir():
+                describe_directory(info, path)
+            else:
+                describe_header(info, read_safetensors_header(path))
+        except (OSError, RuntimeError) as exc:
+            print(f"Model registry could not read {path}: {exc}")
+        self._entries[key] = info
+        self._dirty = True
+        return info
+
+    def refresh(self) -> None:
+        with self._lock:
+            seen: set[str] = set()
+            for kind in MODEL_KINDS:
+                for path in self._candidates(kind):
+                    info = self._describe(path, kind)
+                    if info is not None:
+                        seen.add(info.path)
+            root = str(self.models_dir.resolve())
+            for key in list(self._entries):
+                inside = key.startswith(root + os.sep)
+                if (inside and key not in seen) or (not inside and not Path(key).exists()):
+                    del self._entries[key]
+                    self._dirty = True
+            for key in [key for key in self._hashes if not Path(key).is_file()]:
+                del self._hashes[key]
+                self._dirty = True
+            self._index_names()
+            self.save()
+
+    def _index_names(self) -> None:
+        names: dict[tuple[str, str], ModelInfo] = {}
+        for info in sorted(self._entries.values(), key=lambda info: info.path):
+            path = Path(info.path)
+            keys = [path.name, path.stem, info.path]
+            root = self.models_dir.resolve() / KIND_DIRS[info.kind]
+            if root in path.parents:
+                relative = path.relative_to(root)
+                keys.extend([str(relative), str(relative.with_suffix(""))])
+            if info.trigger:
+                keys.append(info.trigger)
+            for key in keys:
+                # The first (shortest path) wins when two files share a name.
+                names.setdefault((info.kind, key), info)
+        self._names = names
+
+    def find(self, kind: str, name: str) -> ModelInfo | None:
+        """Looks up a model by file name, stem, path relative to its folder, or trigger name."""
+        return self._names.get((kind, name))
+
+    def lookup(self, kind: str, *names: str) -> ModelInfo | None:
+        """
+        The first of `names` the index knows, rescanning once on a miss so files
+        added since the last scan (e.g. while a worker is running) resolve too.
+        """
+        for attempt in range(2):
+            if attempt:
+                self.refresh()
+            for name in names:
+                info = self.find(kind, name)
+                if info is not None:
+                    return info
+        return None
+
+    def info(self, path: str | Path, kind: str = "checkpoint") -> ModelInfo | None:
+        """The entry for any local path, adding paths outside `models/` on first use."""
+        path = Path(path)
+        key = str(path.resolve())
+        with self._lock:
+            info = self._entries.get(key)
+            if info is not None and info.kind == kind:
+                return info
+            info = self._describe(path, kind)
+            if info is not None:
+                self._index_names()
+                self.save()
+            return info
+
+    def digest(self, path: str | Path, kind: str = "checkpoint") -> str | None:
+        info = self.info(path, kind)
+        if info is None or Path(info.path).is_dir():
+            return None
+        return self.file_digest(info.path)
+
+    def file_digest(self, path: str | Path) -> str:
+        """SHA-256 of any file, persisted in the index until its size or mtime changes."""
+        path = Path(path).resolve()
+        stat = path.stat()
+        key = str(path)
+        current = (stat.st_size, stat.st_mtime_ns)
+        with self._lock:
+            info = self._entries.get(key)
+            if info is not None and (info.size, info.mtime_ns) == current and info.sha256:
+                return info.sha256
+            known = self._hashes.get(key)
+            if known and (known.get("size"), known.get("mtime_ns")) == current:
+                return str(known["sha256"])
+
+        value = file_sha256(path)
+        with self._lock:
+            info = self._entries.get(key)
+            if info is not None and (info.size, info.mtime_ns) == current:
+                info.sha256 = value
+            else:
+                self._hashes[key] = {"size": current[0], "mtime_ns": current[1], "sha256": value}
+            self._dirty = True
+            self.save()
+        return value
+
+    def source_digest(self, source: str) -> str:
+        """
+        Content identity of a model source for cache keys: the hash of a file, or of
+        every file in a diffusers directory. Hub ids cannot be hashed locally and
+        are keyed on the id itself.
+        """
+        path = Path(source)
+        if path.is_file():
+            return self.file_digest(path)
+        if path.is_dir():
+            digest = hashlib.sha256()
+            for child in sorted(p for p in path.rglob("*") if p.is_file()):
+                relative = child.relative_to(path)
+                if any(part.startswith(".") for part in relative.parts):
+                    continue
+                digest.update(str(relative).encode("utf-8"))
+                digest.update(self.file_digest(child).encode("utf-8"))
+            return digest.hexdigest()
+        return f"ref:{source}"
+
+    def check_lora(self, base_model: str, lora_path: str | Path) -> None:
+        """Rejects a LoRA trained for another architecture before any weights are loaded."""
+        base = self.info(base_model, "checkpoint")
+        lora = self.info(lora_path, "lora")
+        if base is None or lora is None:
+            return
+        if "unknown" in {base.architecture, lora.architecture}:
+            return
+        if base.architecture != lora.architecture:
+            raise RuntimeError(
+                f"LoRA '{lora.name}' is a {lora.architecture} LoRA but base model "
+                f"'{base.name}' is {base.architecture}; they cannot be combined"
+            )
+
+    def models(self, kind: str | None = None) -> list[ModelInfo]:
+        return sorted(
+            (info for info in self._entries.values() if kind is None or info.kind == kind),
+            key=lambda info: info.path,
+        )
+
+
+_registries: dict[str, ModelRegistry] = {}
+_registries_lock = threading.Lock()
+
+
+def get_registry(models_dir: str | Path) -> ModelRegistry:
+    """The process-wide registry for `models_dir`, scanned on first use."""
+    key = str(Path(models_dir).resolve())
+    with _registries_lock:
+        registry = _registries.get(key)
+        if registry is None:
+            registry = ModelRegistry(models_dir)
+            _registries[key] = registry
+        return registry
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Scan models/ and print the model registry index.")
+    parser.add_argument("--models-dir", default=str(DEFAULT_MODELS_DIR))
+    parser.add_argument("--hash", action="store_true", help="Also compute missing content hashes.")
+    args = parser.parse_args()
+
+    registry = get_registry(args.models_dir)
+    for info in registry.models():
+        if args.hash and Path(info.path).is_file():
+            registry.digest(info.path, info.kind)
+        print(json.dumps(asdict(info)))
+
+
+if __name__ == "__main__":
+    main()
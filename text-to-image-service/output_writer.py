@@ -0,0 +1,225 @@
+import itertools
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, Iterator
+
+
+IMAGE_FORMATS = ("png", "webp")
+
+
+@dataclass(frozen=True)
+class OutputFormat:
+    """How images are encoded: PNG with a zlib level, or WebP lossless/lossy."""
+
+    extension: str = "png"
+    compress_level: int = 6
+    quality: int = 90
+    lossless: bool = False
+
+    def save_kwargs(self) -> dict[str, object]:
+        if self.extension == "webp":
+            return {"format": "WEBP", "lossless": self.lossless, "quality": self.quality}
+        return {"format": "PNG", "compress_level": self.compress_level}
+
+
+class WriteBatch:
+    """
+    The images of one `OutputWriter.submit` call.
+
+    `result()` blocks until every image is on disk and returns the paths in
+    submission order; `add_done_callback` runs once all writes have finished (on a
+    writer thread, or immediately if they already have).
+    """
+
+    def __init__(self, count: int):
+        self.futures: list[Future] = []
+        self.seconds = 0.0
+        self._remaining = count
+        self._callbacks: list[Callable[["WriteBatch"], None]] = []
+        self._lock = threading.Lock()
+
+    def _add(self, future: Future) -> None:
+        self.futures.append(future)
+        future.add_done_callback(self._on_write_done)
+
+    def _on_write_done(self, _: Future) -> None:
+        with self._lock:
+            self._remaining -= 1
+            if self._remaining > 0:
+                return
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    def done(self) -> bool:
+        with self._lock:
+            return self._remaining <= 0
+
+    def add_done_callback(self, callback: Callable[["WriteBatch"], None]) -> None:
+        with self._lock:
+            if self._remaining > 0:
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def result(self, timeout: float | None = None) -> list[Path]:
+        return [future.result(timeout) for future in self.futures]
+
+
+class OutputWriter:
+    """
+    Encodes and writes generated images on a thread pool.
+
+    PNG/WebP encoding is CPU work that used to sit between one pipeline call and
+    the next; submitting it here lets the device start the next job while the
+    previous images are compressed. Names follow `{prefix}_{timestamp}[_{index}]`
+    and are claimed with an exclusive create (or hard link), so two images
+    finishing in the same second, in this or another process, get `_1`, `_2`
+    suffixes instead of overwriting each other. With `atomic` the image is written
+    to a hidden temporary file and only linked into place once complete; `fsync`
+    additionally flushes the file and its directory before the write counts as
+    done. At most `max_pending` images are queued; beyond that `submit` blocks so a
+    slow disk cannot grow memory without bound.
+    """
+
+    def __init__(
+        self,
+        workers: int = 2,
+        atomic: bool = False,
+        fsync: bool = False,
+        max_pending: int = 32,
+    ):
+        self.atomic = atomic
+        self.fsync = fsync
+        self._executor = ThreadPoolExecutor(
+            max_workers=max(workers, 1), thread_name_prefix="output-writer"
+        )
+        self._slots = threading.BoundedSemaphore(max(max_pending, 1))
+
+    def submit(
+        self,
+        images: list[object],
+        out_dir: Path,
+        filename_prefix: str,
+        output_format: OutputFormat = OutputFormat(),
+        start: int = 0,
+        total: int | None = None,
+    ) -> WriteBatch:
+        total = len(images) if total is None else total
+        timestamp = int(time.time())
+        batch = WriteBatch(len(images))
+        for offset, image in enumerate(images):
+            if total == 1:
+                stem = f"{filename_prefix}_{timestamp}"
+            else:
+                stem = f"{filename_prefix}_{timestamp}_{start + offset:03d}"
+            self._slots.acquire()
+            try:
+                future = self._executor.submit(
+                    self._write, batch, image, Path(out_dir), stem, output_format
+                )
+            except BaseException:
+                self._slots.release()
+                raise
+            batch._add(future)
+        return batch
+
+    def close(self, wait: bool = True) -> None:
+        self._executor.shutdown(wait=wait)
+
+    def _write(
+        self,
+        batch: WriteBatch,
+        image: object,
+        out_dir: Path,
+        stem: str,
+        output_format: OutputFormat,
+    ) -> Path:
+        start = time.perf_counter()
+        try:
+            out_dir.mkdir(parents=True, exist_ok=True)
+            suffix = f".{output_format.extension}"
+            if self.atomic:
+                tmp_path = out_dir / f".{stem}.{uuid.uuid4().hex}.tmp"
+                try:
+                    with tmp_path.open("wb") as f:
+                        self._encode(image, f, output_format)
+                    path = self._claim(tmp_path, candidate_paths(out_dir, stem, suffix))
+                finally:
+                    tmp_path.unlink(missing_ok=True)
+            else:
+                path = self._write_exclusive(image, candidate_paths(out_dir, stem, suffix), output_format)
+            if self.fsync:
+                fsync_directory(out_dir)
+            return path
+        finally:
+            with batch._lock:
+                batch.seconds += time.perf_counter() - start
+            self._slots.release()
+
+    def _encode(self, image: object, f, output_format: OutputFormat) -> None:
+        image.save(f, **output_format.save_kwargs())
+        if self.fsync:
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _write_exclusive(
+        self, image: object, candidates: Iterator[Path], output_format: OutputFormat
+    ) -> Path:
+        for path in candidates:
+            try:
+                f = path.open("xb")
+            except FileExistsError:
+                continue
+            try:
+                with f:
+                    self._encode(image, f, output_format)
+            except BaseException:
+                path.unlink(missing_ok=True)
+                raise
+            return path
+        raise RuntimeError("unreachable")
+
+    def _claim(self, tmp_path: Path, candidates: Iterator[Path]) -> Path:
+        for path in candidates:
+            try:
+                # link() fails if the name is taken, so the complete file appears
+                # under a fresh name in one step.
+                os.link(tmp_path, path)
+                return path
+            except FileExistsError:
+                continue
+            except OSError:
+                # No hard links on this filesystem: reserve the name, then replace it.
+                try:
+                    os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                except FileExistsError:
+                    continue
+                os.replace(tmp_path, path)
+                return path
+        raise RuntimeError("unreachable")
+
+
+def candidate_paths(out_dir: Path, stem: str, suffix: str) -> Iterator[Path]:
+    yield out_dir / f"{stem}{suffix}"
+    for attempt in itertools.count(1):
+        yield out_dir / f"{stem}_{attempt}{suffix}"
+
+
+def fsync_directory(path: Path) -> None:
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        # Some platforms/filesystems do not support fsync on directories.
+        pass
+    finally:
+        os.close(fd)
@@ -0,0 +1,230 @@
+import gc
+import math
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+import torch
+from diffusers import StableDiffusionXLPipeline
+
+import tracing
+from main import (
+    available_memory_bytes,
+    lora_adapter_name,
+    load_base_pipeline,
+    load_lora_adapters,
+    place_pipeline,
+)
+from model_registry import read_safetensors_header
+
+if TYPE_CHECKING:
+    from cpu_inference import CPUOptions
+    from model_cache import ModelCache
+    from residency import ResidencyManager
+
+
+MAX_LOADED_ADAPTERS = 8
+# Integer and bool tensors keep their stored width; floating ones take the load dtype.
+INTEGER_DTYPE_BYTES = {"I64": 8, "I32": 4, "I16": 2, "I8": 1, "U8": 1, "BOOL": 1}
+
+
+def pipeline_memory_bytes(pipe: StableDiffusionXLPipeline) -> int:
+    total = 0
+    for component in pipe.components.values():
+        if isinstance(component, torch.nn.Module):
+            for tensor in list(component.parameters()) + list(component.buffers()):
+                total += tensor.numel() * tensor.element_size()
+    return total
+
+
+def loaded_tensor_bytes(path: Path, dtype: torch.dtype) -> int:
+    """Bytes the file's tensors take once loaded, with floating tensors cast to dtype."""
+    try:
+        header = read_safetensors_header(path)
+    except (OSError, RuntimeError):
+        return path.stat().st_size
+    target = torch.empty((), dtype=dtype).element_size()
+    total = 0
+    for name, value in header.items():
+        if name == "__metadata__" or not isinstance(value, dict):
+            continue
+        stored = str(value.get("dtype"))
+        size = INTEGER_DTYPE_BYTES.get(stored, target)
+        total += math.prod(value.get("shape") or []) * size
+    return total
+
+
+def estimate_model_bytes(base_model: str, dtype: torch.dtype) -> int:
+    """
+    Estimates pipeline_memory_bytes before loading, so eviction compares like with like.
+
+    The file size alone overstates an fp32 checkpoint loaded in fp16 by 2x. In a
+    diffusers directory, precision variants of the same weights (model.fp16.safetensors
+    next to model.safetensors) are counted once.
+    """
+    path = Path(base_model)
+    if path.is_file():
+        return loaded_tensor_bytes(path, dtype)
+    if path.is_dir():
+        weights: dict[tuple[Path, str], int] = {}
+        for file in path.rglob("*.safetensors"):
+            slot = (file.parent, file.name.split(".", 1)[0])
+            weights[slot] = max(weights.get(slot, 0), loaded_tensor_bytes(file, dtype))
+        return sum(weights.values())
+    return 0
+
+
+class PipelineCache:
+    """
+    LRU cache of loaded SDXL pipelines keyed by (base model, dtype, device).
+
+    LoRAs are attached as named adapters rather than fused into the weights, so a
+    request can switch, re-weight or drop LoRAs with set_adapters/disable_lora
+    instead of reloading the checkpoint. Pipelines are evicted least recently used
+    first whenever loading another one would exceed the memory budget. With a
+    residency manager, components of the cached pipelines are paged on and off the
+    device under its budget, and an evicted pipeline is unregistered from it.
+
+    A pipeline's size is re-measured after its adapters change, since LoRA layers add
+    weights of their own. get() holds a lock, so the HTTP server's loader threads
+    never load or evict concurrently.
+    """
+
+    def __init__(
+        self,
+        max_bytes: int | None = None,
+        device: str | None = None,
+        model_cache: "ModelCache | None" = None,
+        cpu_options: "CPUOptions | None" = None,
+        residency: "ResidencyManager | None" = None,
+    ):
+        if max_bytes is None and device is not None:
+            available = available_memory_bytes(device)
+            max_bytes = int(available * 0.9) if available else None
+        self.max_bytes = max_bytes
+        self.model_cache = model_cache
+        self.cpu_options = cpu_options
+        self.residency = residency
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: OrderedDict[tuple[str, str, str], StableDiffusionXLPipeline] = (
+            OrderedDict()
+        )
+        self._sizes: dict[tuple[str, str, str], int] = {}
+        self._adapters: dict[tuple[str, str, str], OrderedDict[str, None]] = {}
+        self._active: dict[tuple[str, str, str], tuple[tuple[str, float], ...]] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(base_model: str, dtype: torch.dtype, device: str) -> tuple[str, str, str]:
+        return (str(Path(base_model).resolve()), str(dtype), device)
+
+    def total_bytes(self) -> int:
+        return sum(self._sizes.values())
+
+    def _evict(self, needed: int, keep: tuple[str, str, str] | None = None) -> None:
+        if self.max_bytes is None or self.total_bytes() + needed <= self.max_bytes:
+            return
+        while self.total_bytes() + needed > self.max_bytes:
+            victims = [key for key in self._entries if key != keep]
+            if not victims:
+                break
+            key = victims[0]
+            pipe = self._entries.pop(key)
+            if self.residency is not None:
+                self.residency.release_pipeline(pipe)
+            self._sizes.pop(key, None)
+            self._adapters.pop(key, None)
+            self._active.pop(key, None)
+            self.evictions += 1
+            print(f"Evicted pipeline {key[0]} ({key[1]}, {key[2]}) from cache")
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def get(
+        self,
+        base_model: str,
+        dtype: torch.dtype,
+        device: str,
+        loras: list[tuple[str, str, float]] | None = None,
+    ) -> tuple[StableDiffusionXLPipeline, float, float]:
+        with self._lock:
+            return self._get(base_model, dtype, device, loras or [])
+
+    def _get(
+        self,
+        base_model: str,
+        dtype: torch.dtype,
+        device: str,
+        loras: list[tuple[str, str, float]],
+    ) -> tuple[StableDiffusionXLPipeline, float, float]:
+        key = self.key(base_model, dtype, device)
+        pipe = self._entries.get(key)
+        load_s = 0.0
+        if pipe is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+        else:
+            self.misses += 1
+            start = time.perf_counter()
+            self._evict(estimate_model_bytes(base_model, dtype))
+            pipe = load_base_pipeline(base_model, dtype, self.model_cache)
+            place_pipeline(pipe, device, self.cpu_options, self.residency)
+            self._entries[key] = pipe
+            self._sizes[key] = pipeline_memory_bytes(pipe)
+            self._adapters[key] = OrderedDict()
+            self._active[key] = ()
+            load_s = time.perf_counter() - start
+        lora_s = self._apply_loras(pipe, key, loras)
+        return pipe, load_s, lora_s
+
+    def _apply_loras(
+        self,
+        pipe: StableDiffusionXLPipeline,
+        key: tuple[str, str, str],
+        loras: list[tuple[str, str, float]],
+    ) -> float:
+        wanted = tuple(
+            (lora_adapter_name(repo_or_dir, weight_name), scale)
+            for repo_or_dir, weight_name, scale in loras
+        )
+        if self._active.get(key) == wanted:
+            return 0.0
+
+        start = time.perf_counter()
+        loaded = self._adapters.setdefault(key, OrderedDict())
+        with tracing.stage("lora"):
+            if wanted:
+                names = load_lora_adapters(pipe, loras)
+                for name in names:
+                    loaded[name] = None
+                    loaded.move_to_end(name)
+                stale = [name for name in loaded if name not in names]
+                while len(loaded) > MAX_LOADED_ADAPTERS and stale:
+                    name = stale.pop(0)
+                    pipe.delete_adapters(name)
+                    del loaded[name]
+                pipe.enable_lora()
+                pipe.set_adapters(names, adapter_weights=[scale for _, scale in wanted])
+            elif loaded:
+                pipe.disable_lora()
+        self._sizes[key] = pipeline_memory_bytes(pipe)
+        self._evict(0, keep=key)
+        self._active[key] = wanted
+        # Read by PromptEmbeddingCache so encoder outputs are keyed on the LoRA mix.
+        pipe.asset_lora_state = wanted
+        return time.perf_counter() - start
+
+    def stats(self) -> dict[str, object]:
+        return {
+            "entries": len(self._entries),
+            "bytes": self.total_bytes(),
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
@@ -0,0 +1,230 @@
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+from multiprocessing import get_context
+from pathlib import Path
+
+from job_queue import SpoolQueue, open_queue
+
+
+def available_cores() -> list[int]:
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def cuda_device_ids() -> list[str]:
+    visible = os.getenv("CUDA_VISIBLE_DEVICES")
+    if visible is not None:
+        return [item.strip() for item in visible.split(",") if item.strip()]
+    if shutil.which("nvidia-smi") is None:
+        return []
+    # nvidia-smi avoids importing torch (and creating a CUDA context) in the parent.
+    result = subprocess.run(["nvidia-smi", "-L"], capture_output=True, text=True)
+    if result.returncode != 0:
+        return []
+    lines = [line for line in result.stdout.splitlines() if line.startswith("GPU ")]
+    return [str(index) for index in range(len(lines))]
+
+
+def split_cores(cores: list[int], parts: int) -> list[list[int]]:
+    parts = max(1, min(parts, len(cores)))
+    size, extra = divmod(len(cores), parts)
+    groups: list[list[int]] = []
+    start = 0
+    for index in range(parts):
+        end = start + size + (1 if index < extra else 0)
+        groups.append(cores[start:end])
+        start = end
+    return groups
+
+
+def plan_workers(workers: int, devices: str, device: str) -> list[dict[str, object]]:
+    """
+    Assigns each pool worker a device or a disjoint set of CPU cores.
+
+    GPUs are dealt round-robin, so more workers than GPUs share them evenly. CPU
+    workers get contiguous, non-overlapping core sets and as many torch threads as
+    cores, so N workers never run more threads than the machine has cores.
+    """
+    spec = (devices or "auto").strip().lower()
+    if spec == "auto":
+        if device in {"auto", "cuda"} and cuda_device_ids():
+            spec = "cuda"
+        elif device in {"auto", "mps"} and sys.platform == "darwin":
+            spec = "mps"
+        else:
+            spec = "cpu"
+
+    if spec == "cpu":
+        groups = split_cores(available_cores(), workers)
+        if len(groups) < workers:
+            print(f"Only {len(groups)} cores available; starting {len(groups)} CPU workers")
+        return [{"device": "cpu", "cpu_cores": group} for group in groups]
+    if spec == "mps":
+        if workers > 1:
+            print("MPS is a single shared device; pool workers will contend for it")
+        return [{"device": "mps"} for _ in range(workers)]
+
+    if spec == "cuda":
+        gpus = cuda_device_ids()
+    else:
+        gpus = [item.split(":", 1)[-1] for item in spec.split(",") if item.strip()]
+    if not gpus:
+        raise RuntimeError("No CUDA devices found for the pool; use --pool-devices cpu")
+    return [{"device": "cuda", "gpu": gpus[index % len(gpus)]} for index in range(workers)]
+
+
+def pool_worker(index: int, assignment: dict[str, object], values: dict[str, object]) -> None:
+    # Runs in a freshly spawned interpreter: pin the process and size the thread pools
+    # before torch is imported, so the OpenMP/MKL pools are created to match.
+    if assignment["device"] == "cuda":
+        os.environ["CUDA_VISIBLE_DEVICES"] = str(assignment["gpu"])
+    cores = assignment.get("cpu_cores")
+    if cores:
+        if hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, set(cores))
+        for name in ("OMP_NUM_THREADS", "MKL_NUM_THREADS"):
+            os.environ[name] = str(len(cores))
+
+    args = argparse.Namespace(**values)
+    args.device = str(assignment["device"])
+    if cores and not args.cpu_threads:
+        args.cpu_threads = len(cores)
+    if getattr(args, "residency_dir", None):
+        # Spill files are per process; workers must not overwrite each other's.
+        args.residency_dir = str(Path(args.residency_dir) / f"worker-{index}")
+
+    from worker import serve
+
+    print(
+        json.dumps(
+            {"event": "pool_worker_started", "worker": index, "pid": os.getpid(), **assignment}
+        )
+    )
+    serve(args)
+
+
+def job_entry(
+    state: str, record: dict[str, object], workers_by_pid: dict[int, int]
+) -> dict[str, object]:
+    result = dict(record.get("result") or {})
+    entry: dict[str, object] = {
+        "id": record.get("id"),
+        "status": state,
+        "attempts": record.get("attempts"),
+        "worker": workers_by_pid.get(result.get("worker_pid")),
+    }
+    for key in ("images", "seeds", "timings", "queue_wait_s"):
+        if key in result:
+            entry[key] = result[key]
+    error = record.get("error") or record.get("reason") or record.get("last_error")
+    if error:
+        entry["error"] = error
+    return entry
+
+
+def write_manifest(path: Path, manifest: dict[str, object]) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    with tmp_path.open("w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def run_pool(args: argparse.Namespace) -> dict[str, object]:
+    """
+    Runs `--pool N` worker processes over one shared spool until it is drained.
+
+    Every worker is an ordinary `--serve` worker with prefetch disabled, so idle
+    workers take the next pending job themselves (work stealing through the
+    spool's atomic leases) and a slow job never holds others hostage. Jobs left by
+    a crashed worker are redelivered to the survivors once their lease expires.
+    When all workers have exited, every job finished during the run is written to
+    one manifest.
+    """
+    queue = open_queue(
+        "spool",
+        args.queue_path,
+        visibility_timeout=args.visibility_timeout,
+        max_attempts=args.max_attempts,
+    )
+    if not isinstance(queue, SpoolQueue):
+        raise RuntimeError("--pool needs a spool queue")
+    # Ingest the job file once here so workers do not race to spool the same lines.
+    queue.ingest()
+    started = time.time()
+
+    assignments = plan_workers(args.pool, args.pool_devices, args.device)
+    values = dict(vars(args))
+    values.update(
+        {
+            "queue": "spool",
+            "prefetch": 0,
+            "exit_when_idle": True,
+            "pool": 0,
+            # A job file would be re-ingested by every worker; hand them the spool root.
+            "queue_path": str(queue.root),
+        }
+    )
+
+    spawn = get_context("spawn")
+    processes = []
+    for index, assignment in enumerate(assignments):
+        process = spawn.Process(
+            target=pool_worker, args=(index, assignment, values), name=f"tti-pool-{index}"
+        )
+        process.start()
+        processes.append((index, assignment, process))
+    try:
+        for _, _, process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        for _, _, process in processes:
+            process.terminate()
+        for _, _, process in processes:
+            process.join()
+
+    workers_by_pid = {process.pid: index for index, _, process in processes}
+    jobs: list[dict[str, object]] = []
+    for state in ("done", "failed", "cancelled"):
+        for record in queue.records(state):
+            if float(record.get("finished_at", 0.0)) >= started:
+                jobs.append(job_entry(state, record, workers_by_pid))
+    for state in ("pending", "inflight"):
+        for record in queue.records(state):
+            jobs.append(job_entry("unfinished", record, workers_by_pid))
+    jobs.sort(key=lambda entry: str(entry["id"]))
+
+    elapsed = time.time() - started
+    summary: dict[str, object] = {
+        state: sum(1 for job in jobs if job["status"] == state)
+        for state in ("done", "failed", "cancelled", "unfinished")
+    }
+    images = sum(len(job.get("images", [])) for job in jobs)
+    summary["images"] = images
+    summary["images_per_minute"] = round(images * 60.0 / elapsed, 3) if elapsed > 0 else 0.0
+    manifest = {
+        "started_at": round(started, 3),
+        "elapsed_s": round(elapsed, 3),
+        "workers": [
+            {
+                "worker": index,
+                "pid": process.pid,
+                "exit_code": process.exitcode,
+                "jobs": sum(1 for job in jobs if job["worker"] == index),
+                **assignment,
+            }
+            for index, assignment, process in processes
+        ],
+        "summary": summary,
+        "jobs": jobs,
+    }
+    manifest_path = Path(args.pool_manifest) if args.pool_manifest else queue.root / "manifest.json"
+    write_manifest(manifest_path, manifest)
+    print(json.dumps({"event": "pool_done", "manifest": str(manifest_path), **summary}))
+    return manifest
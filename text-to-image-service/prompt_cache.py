@@ -0,0 +1,193 @@
+import hashlib
+import threading
+import weakref
+from collections import OrderedDict
+from pathlib import Path
+
+import torch
+from diffusers import StableDiffusionXLPipeline
+from safetensors.torch import load_file, save_file
+
+
+DEFAULT_MAX_ENTRIES = 256
+
+
+def encoder_fingerprint(pipe: StableDiffusionXLPipeline) -> str:
+    """
+    Identifies the text encoders independent of process and object identity.
+
+    The checksum of the last attention projection changes when a LoRA is fused
+    into the encoders, so fused and unfused variants of a checkpoint never share
+    cache entries.
+    """
+    parts: list[str] = []
+    for encoder in (pipe.text_encoder, pipe.text_encoder_2):
+        if encoder is None:
+            parts.append("none")
+            continue
+        name = getattr(encoder.config, "_name_or_path", "") or type(encoder).__name__
+        weight = encoder.text_model.encoder.layers[-1].self_attn.q_proj.weight
+        if callable(weight):
+            # Dynamically quantized Linear (CPU int8 mode) packs its weight behind a method.
+            weight = weight().dequantize()
+        with torch.no_grad():
+            checksum = float(weight[:8].double().sum().item())
+        parts.append(f"{name}:{encoder.dtype}:{checksum:.10e}")
+    return "|".join(parts)
+
+
+class PromptEmbeddingCache:
+    """
+    Caches SDXL text-encoder outputs per prompt string.
+
+    Entries hold `prompt_embeds` and `pooled_prompt_embeds` on the CPU and are keyed
+    by (text, encoder fingerprint, clip skip, active LoRA state). The in-memory tier
+    is an LRU bounded by `max_entries`; when `cache_dir` is set, entries are also
+    written as safetensors files and reloaded on a memory miss.
+    """
+
+    def __init__(self, max_entries: int = DEFAULT_MAX_ENTRIES, cache_dir: str | Path | None = None):
+        self.max_entries = max_entries
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+        if self.cache_dir is not None:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[str, tuple[torch.Tensor, torch.Tensor]] = OrderedDict()
+        self._fingerprints: weakref.WeakKeyDictionary[StableDiffusionXLPipeline, str] = (
+            weakref.WeakKeyDictionary()
+        )
+        self._lock = threading.Lock()
+
+    def _fingerprint(self, pipe: StableDiffusionXLPipeline) -> str:
+        fused = getattr(pipe, "num_fused_loras", 0)
+        cached = self._fingerprints.get(pipe)
+        if cached is None or not cached.startswith(f"{fused}#"):
+            cached = f"{fused}#{encoder_fingerprint(pipe)}"
+            self._fingerprints[pipe] = cached
+        return cached
+
+    def _key(
+        self,
+        pipe: StableDiffusionXLPipeline,
+        text: str,
+        clip_skip: int | None,
+    ) -> str:
+        lora_state = getattr(pipe, "asset_lora_state", ())
+        # Embeddings computed under CPU bf16 autocast differ from fp32 ones.
+        autocast_dtype = getattr(pipe, "asset_autocast_dtype", None)
+        raw = "\x1f".join(
+            [
+                text,
+                self._fingerprint(pipe),
+                str(clip_skip),
+                repr(tuple(lora_state)),
+                str(autocast_dtype),
+            ]
+        )
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _remember(self, key: str, value: tuple[torch.Tensor, torch.Tensor]) -> None:
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _lookup(self, key: str) -> tuple[torch.Tensor, torch.Tensor] | None:
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+        if self.cache_dir is not None:
+            path = self.cache_dir / f"{key}.safetensors"
+            if path.is_file():
+                try:
+                    tensors = load_file(str(path))
+                    value = (tensors["prompt_embeds"], tensors["pooled_prompt_embeds"])
+                except Exception:
+                    return None
+                self._remember(key, value)
+                with self._lock:
+                    self.disk_hits += 1
+                return value
+        return None
+
+    def encode(
+        self,
+        pipe: StableDiffusionXLPipeline,
+        text: str,
+        clip_skip: int | None = None,
+    ) -> tuple[torch.Tensor, torch.Tensor]:
+        key = self._key(pipe, text, clip_skip)
+        value = self._lookup(key)
+        if value is None:
+            with self._lock:
+                self.misses += 1
+            with torch.no_grad():
+                prompt_embeds, _, pooled_prompt_embeds, _ = pipe.encode_prompt(
+                    prompt=text,
+                    device=pipe._execution_device,
+                    num_images_per_prompt=1,
+                    do_classifier_free_guidance=False,
+                    clip_skip=clip_skip,
+                )
+            value = (prompt_embeds.detach().cpu(), pooled_prompt_embeds.detach().cpu())
+            self._remember(key, value)
+            if self.cache_dir is not None:
+                save_file(
+                    {
+                        "prompt_embeds": value[0].contiguous(),
+                        "pooled_prompt_embeds": value[1].contiguous(),
+                    },
+                    str(self.cache_dir / f"{key}.safetensors"),
+                )
+        device = pipe._execution_device
+        return value[0].to(device), value[1].to(device)
+
+    def encode_batch(
+        self,
+        pipe: StableDiffusionXLPipeline,
+        positives: list[str],
+        negatives: list[str] | None,
+        clip_skip: int | None = None,
+    ) -> dict[str, torch.Tensor]:
+        embeds: dict[str, list[torch.Tensor]] = {
+            "prompt_embeds": [],
+            "pooled_prompt_embeds": [],
+            "negative_prompt_embeds": [],
+            "negative_pooled_prompt_embeds": [],
+        }
+        for text in positives:
+            prompt_embeds, pooled = self.encode(pipe, text, clip_skip)
+            embeds["prompt_embeds"].append(prompt_embeds)
+            embeds["pooled_prompt_embeds"].append(pooled)
+        zero_negative = getattr(pipe.config, "force_zeros_for_empty_prompt", False)
+        for index, text in enumerate(negatives or []):
+            if not text and zero_negative:
+                embeds["negative_prompt_embeds"].append(
+                    torch.zeros_like(embeds["prompt_embeds"][index])
+                )
+                embeds["negative_pooled_prompt_embeds"].append(
+                    torch.zeros_like(embeds["pooled_prompt_embeds"][index])
+                )
+                continue
+            # Diffusers always encodes negatives from the penultimate layer.
+            prompt_embeds, pooled = self.encode(pipe, text, None)
+            embeds["negative_prompt_embeds"].append(prompt_embeds)
+            embeds["negative_pooled_prompt_embeds"].append(pooled)
+        return {name: torch.cat(values) for name, values in embeds.items() if values}
+
+    def stats(self) -> dict[str, object]:
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+            }
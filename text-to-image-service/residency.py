@@ -0,0 +1,327 @@
+import json
+import threading
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+import tracing
+
+if TYPE_CHECKING:
+    import torch
+    from diffusers import StableDiffusionXLPipeline
+
+
+# SDXL components managed for a pipeline; tokenizers and the scheduler hold no weights.
+PIPELINE_COMPONENTS = ("text_encoder", "text_encoder_2", "unet", "vae")
+
+
+@dataclass
+class Component:
+    """One registered module: where its weights live now and what moving them has cost."""
+
+    name: str
+    module: "torch.nn.Module"
+    size_bytes: int
+    location: str
+    pinned: bool = False
+    last_used: float = 0.0
+    loads: int = 0
+    evictions: int = 0
+    spills: int = 0
+    load_s: float = 0.0
+    evict_s: float = 0.0
+    spill_path: Path | None = None
+    aliases: dict[str, str] = field(default_factory=dict)
+
+    def as_dict(self) -> dict[str, object]:
+        return {
+            "size_bytes": self.size_bytes,
+            "location": self.location,
+            "pinned": self.pinned,
+            "loads": self.loads,
+            "evictions": self.evictions,
+            "spills": self.spills,
+            "load_s": round(self.load_s, 4),
+            "evict_s": round(self.evict_s, 4),
+        }
+
+
+def module_tensors(module: "torch.nn.Module") -> tuple[dict[str, "torch.Tensor"], dict[str, str]]:
+    """Every parameter and buffer by name, with tied names mapped to the one stored copy."""
+    tensors: dict[str, "torch.Tensor"] = {}
+    aliases: dict[str, str] = {}
+    seen: dict[int, str] = {}
+    named = list(module.named_parameters(remove_duplicate=False)) + list(
+        module.named_buffers(remove_duplicate=False)
+    )
+    for name, tensor in named:
+        if tensor is None:
+            continue
+        if id(tensor) in seen:
+            aliases[name] = seen[id(tensor)]
+            continue
+        seen[id(tensor)] = name
+        tensors[name] = tensor
+    return tensors, aliases
+
+
+def assign_tensors(
+    module: "torch.nn.Module", tensors: dict[str, "torch.Tensor"], aliases: dict[str, str]
+) -> None:
+    import torch
+
+    assigned: dict[str, "torch.Tensor"] = {}
+    for name in list(tensors) + list(aliases):
+        source = aliases.get(name, name)
+        owner_name, _, leaf = name.rpartition(".")
+        owner = module.get_submodule(owner_name) if owner_name else module
+        if leaf in owner._parameters:
+            if source not in assigned:
+                assigned[source] = torch.nn.Parameter(tensors[source], requires_grad=False)
+            owner._parameters[leaf] = assigned[source]
+        else:
+            owner._buffers[leaf] = assigned.get(source, tensors[source])
+
+
+def is_quantized(module: "torch.nn.Module") -> bool:
+    # Dynamically quantized layers keep packed weights outside parameters/buffers
+    # and only run on CPU, so they can neither be moved nor spilled.
+    return any(
+        type(child).__module__.startswith("torch.ao.nn.quantized") for child in module.modules()
+    )
+
+
+def residency_hook(manager: "ResidencyManager", name: str) -> object:
+    from accelerate.hooks import ModelHook
+    from accelerate.utils import send_to_device
+
+    class ResidencyHook(ModelHook):
+        # diffusers reads `execution_device` from module hooks to decide where to put
+        # latents and prompt embeddings, and runs the hook before VAE encode/decode
+        # as well as forward.
+        def __init__(self):
+            super().__init__()
+            self.execution_device = manager.device
+
+        def pre_forward(self, module, *args, **kwargs):
+            manager.acquire(name)
+            return send_to_device(args, manager.device), send_to_device(kwargs, manager.device)
+
+    return ResidencyHook()
+
+
+class ResidencyManager:
+    """
+    Pages model components on and off the accelerator under a memory budget.
+
+    Components (the SDXL text encoders, UNet and VAE, the prompt-enhancer LLM) are
+    registered once and then moved to the device by a pre-forward hook the first
+    time they run. When loading one would exceed `budget_bytes`, the least recently
+    used components are evicted: to host RAM while `host_budget_bytes` allows, and
+    beyond that (or when the device is the CPU itself) spilled to safetensors files
+    under `offload_dir`, which are written once and memory-mapped back on demand.
+    Every load and eviction is timed and counted per component.
+    """
+
+    def __init__(
+        self,
+        device: str,
+        budget_bytes: int,
+        host_budget_bytes: int | None = None,
+        offload_dir: str | Path | None = None,
+    ):
+        self.device = device
+        self.budget_bytes = budget_bytes
+        self.host_budget_bytes = host_budget_bytes
+        self.offload_dir = Path(offload_dir) if offload_dir else None
+        if self.offload_dir is not None:
+            self.offload_dir.mkdir(parents=True, exist_ok=True)
+        self.components: dict[str, Component] = {}
+        self._modules: dict[int, str] = {}
+        self._lock = threading.RLock()
+        self._warned = False
+
+    def register(self, name: str, module: "torch.nn.Module") -> str:
+        from accelerate.hooks import add_hook_to_module
+
+        with self._lock:
+            if id(module) in self._modules:
+                # Pipelines wrapping the same modules (img2img stages) share one entry.
+                return self._modules[id(module)]
+            base, index = name, 2
+            while name in self.components:
+                # Another loaded pipeline already uses this name (e.g. two checkpoints).
+                name = f"{base}#{index}"
+                index += 1
+            tensors, _ = module_tensors(module)
+            size = sum(tensor.numel() * tensor.element_size() for tensor in tensors.values())
+            first = next(iter(tensors.values()), None)
+            # On CPU, host RAM is the device: there is no separate "host" tier.
+            on_device = self.device == "cpu" or (
+                first is not None and first.device.type == self.device
+            )
+            component = Component(
+                name=name,
+                module=module,
+                size_bytes=size,
+                location="device" if on_device else "host",
+                pinned=is_quantized(module),
+            )
+            self.components[name] = component
+            self._modules[id(module)] = name
+            add_hook_to_module(module, residency_hook(self, name))
+            if component.location == "device":
+                self._make_room(0, keep=name)
+            return name
+
+    def manage_pipeline(self, pipe: "StableDiffusionXLPipeline", prefix: str = "sdxl") -> None:
+        import torch
+
+        for attr in PIPELINE_COMPONENTS:
+            module = getattr(pipe, attr, None)
+            if isinstance(module, torch.nn.Module):
+                self.register(f"{prefix}.{attr}", module)
+        pipe.asset_residency = self
+
+    def unregister(self, name: str) -> None:
+        """Forgets a component, removing its hook and any spill file."""
+        from accelerate.hooks import remove_hook_from_module
+
+        with self._lock:
+            component = self.components.pop(name, None)
+            if component is None:
+                return
+            self._modules.pop(id(component.module), None)
+            remove_hook_from_module(component.module)
+            if component.spill_path is not None:
+                component.spill_path.unlink(missing_ok=True)
+
+    def release_pipeline(self, pipe: "StableDiffusionXLPipeline") -> None:
+        """Unregisters a pipeline's components and its refiners, e.g. when it is unloaded."""
+        import torch
+
+        pipes = [pipe, *getattr(pipe, "asset_stage_pipes", {}).values()]
+        for owner in pipes:
+            for attr in PIPELINE_COMPONENTS:
+                module = getattr(owner, attr, None)
+                if isinstance(module, torch.nn.Module) and id(module) in self._modules:
+                    self.unregister(self._modules[id(module)])
+
+    def device_bytes(self) -> int:
+        return sum(c.size_bytes for c in self.components.values() if c.location == "device")
+
+    def host_bytes(self) -> int:
+        return sum(c.size_bytes for c in self.components.values() if c.location == "host")
+
+    def acquire(self, name: str) -> None:
+        """Makes `name` resident on the device, evicting idle components if needed."""
+        with self._lock:
+            component = self.components[name]
+            component.last_used = time.monotonic()
+            if component.location == "device":
+                return
+            self._make_room(component.size_bytes, keep=name)
+            start = time.perf_counter()
+            with tracing.stage("residency_load"):
+                if component.location == "disk":
+                    self._load_spilled(component)
+                else:
+                    component.module.to(self.device)
+            component.location = "device"
+            component.loads += 1
+            component.load_s += time.perf_counter() - start
+
+    def _make_room(self, incoming: int, keep: str) -> None:
+        resident = self.device_bytes() + incoming
+        candidates = sorted(
+            (
+                c
+                for c in self.components.values()
+                if c.location == "device" and c.name != keep and not c.pinned
+            ),
+            key=lambda c: c.last_used,
+        )
+        for component in candidates:
+            if resident <= self.budget_bytes:
+                return
+            if self._evict(component):
+                resident -= component.size_bytes
+        if resident > self.budget_bytes and not self._warned:
+            self._warned = True
+            print(
+                f"Warning: resident components need {resident / (1 << 30):.2f} GiB, over the "
+                f"{self.budget_bytes / (1 << 30):.2f} GiB residency budget"
+            )
+
+    def _evict(self, component: Component) -> bool:
+        to_host = self.device != "cpu" and (
+            self.host_budget_bytes is None
+            or self.host_bytes() + component.size_bytes <= self.host_budget_bytes
+            or self.offload_dir is None
+        )
+        if not to_host and self.offload_dir is None:
+            return False
+        start = time.perf_counter()
+        with tracing.stage("residency_evict"):
+            if to_host:
+                component.module.to("cpu")
+                component.location = "host"
+            else:
+                self._spill(component)
+        component.evictions += 1
+        component.evict_s += time.perf_counter() - start
+        return True
+
+    def _spill(self, component: Component) -> None:
+        from safetensors.torch import save_file
+
+        if component.spill_path is None:
+            # Weights do not change during inference, so one file serves every spill.
+            tensors, aliases = module_tensors(component.module)
+            path = self.offload_dir / f"{component.name}.safetensors"
+            save_file(
+                {name: tensor.detach().cpu().contiguous() for name, tensor in tensors.items()},
+                str(path),
+            )
+            component.spill_path = path
+            component.aliases = aliases
+            component.spills += 1
+        component.module.to("meta")
+        component.location = "disk"
+
+    def _load_spilled(self, component: Component) -> None:
+        from safetensors.torch import load_file
+
+        current, _ = module_tensors(component.module)
+        loaded = load_file(str(component.spill_path), device=self.device)
+        # A dtype change while spilled (e.g. the SDXL VAE upcast) is applied on the way in.
+        tensors = {
+            name: tensor.to(dtype=current[name].dtype) if name in current else tensor
+            for name, tensor in loaded.items()
+        }
+        assign_tensors(component.module, tensors, component.aliases)
+
+    def stats(self) -> dict[str, object]:
+        with self._lock:
+            components = {name: c.as_dict() for name, c in self.components.items()}
+            return {
+                "device": self.device,
+                "budget_bytes": self.budget_bytes,
+                "host_budget_bytes": self.host_budget_bytes,
+                "device_bytes": self.device_bytes(),
+                "host_bytes": self.host_bytes(),
+                "loads": sum(c["loads"] for c in components.values()),
+                "evictions": sum(c["evictions"] for c in components.values()),
+                "load_s": round(sum(c["load_s"] for c in components.values()), 4),
+                "evict_s": round(sum(c["evict_s"] for c in components.values()), 4),
+                "components": components,
+            }
+
+    def report(self) -> dict[str, object]:
+        stats = self.stats()
+        trace = tracing.active_trace()
+        if trace is not None:
+            trace.annotate("residency", stats)
+        print(json.dumps({"event": "residency", **stats}))
+        return stats
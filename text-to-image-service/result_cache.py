@@ -0,0 +1,146 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+from pathlib import Path
+
+
+META_NAME = "asset_result.json"
+
+
+def link_or_copy(source: Path, target: Path) -> None:
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copy2(source, target)
+
+
+class ResultCache:
+    """
+    Disk store of generated images keyed by the fully resolved request.
+
+    A request with explicit seeds is deterministic: the same checkpoint, LoRAs and
+    scales, prompts, seeds, steps, guidance, resolution, sampler chain, device and
+    output format produce the same pixels. The caller hashes all of those into a
+    key; a hit returns the stored image paths without loading a pipeline. Stored
+    images are hard links to the originals where the filesystem allows (copies
+    otherwise), so deleting or overwriting an output does not corrupt the cache.
+    When the store grows past `max_bytes`, the least recently used entries are
+    deleted.
+    """
+
+    def __init__(self, root: str | Path, max_bytes: int | None = None):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.root.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+
+    def key(self, request: dict[str, object]) -> str:
+        payload = json.dumps(request, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:32]
+
+    def lookup(self, key: str) -> dict[str, object] | None:
+        entry = self.root / key
+        try:
+            with (entry / META_NAME).open("r", encoding="utf-8") as f:
+                meta = json.load(f)
+            images = [entry / name for name in meta["images"]]
+        except (OSError, ValueError, KeyError, TypeError):
+            with self._lock:
+                self.misses += 1
+            return None
+        if not all(path.is_file() for path in images):
+            print(f"Result cache entry {key} is incomplete; regenerating it")
+            shutil.rmtree(entry, ignore_errors=True)
+            with self._lock:
+                self.misses += 1
+            return None
+        try:
+            os.utime(entry / META_NAME)
+        except OSError:
+            pass
+        with self._lock:
+            self.hits += 1
+        return {"images": images, "seeds": meta.get("seeds", [])}
+
+    def store(
+        self,
+        key: str,
+        paths: list[Path],
+        seeds: list[int],
+        request: dict[str, object] | None = None,
+    ) -> Path | None:
+        entry = self.root / key
+        if (entry / META_NAME).is_file():
+            return entry
+        tmp_entry = self.root / f".{key}.{uuid.uuid4().hex}.tmp"
+        try:
+            tmp_entry.mkdir(parents=True)
+            names = []
+            size = 0
+            for index, path in enumerate(paths):
+                path = Path(path)
+                name = f"{index:03d}{path.suffix}"
+                link_or_copy(path, tmp_entry / name)
+                names.append(name)
+                size += (tmp_entry / name).stat().st_size
+            meta = {
+                "images": names,
+                "seeds": list(seeds),
+                "request": request,
+                "bytes": size,
+                "created_at": time.time(),
+            }
+            with (tmp_entry / META_NAME).open("w", encoding="utf-8") as f:
+                json.dump(meta, f, indent=2, default=str)
+            with self._lock:
+                self._evict(size)
+            os.rename(tmp_entry, entry)
+        except OSError as exc:
+            # A full disk or a racing writer storing the same key must not fail the job.
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+            if (entry / META_NAME).is_file():
+                return entry
+            print(f"Could not store result cache entry {key}: {exc}")
+            return None
+        return entry
+
+    def entries(self) -> list[tuple[Path, int, float]]:
+        found: list[tuple[Path, int, float]] = []
+        for meta_path in self.root.glob(f"*/{META_NAME}"):
+            if meta_path.parent.name.startswith("."):
+                continue
+            try:
+                with meta_path.open("r", encoding="utf-8") as f:
+                    size = int(json.load(f).get("bytes", 0))
+                found.append((meta_path.parent, size, meta_path.stat().st_mtime))
+            except (OSError, ValueError):
+                continue
+        return found
+
+    def _evict(self, incoming: int) -> None:
+        if self.max_bytes is None:
+            return
+        entries = sorted(self.entries(), key=lambda item: item[2])
+        total = sum(size for _, size, _ in entries) + incoming
+        for path, size, _ in entries:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+            print(f"Evicted result cache entry {path.name}")
+
+    def stats(self) -> dict[str, object]:
+        entries = self.entries()
+        return {
+            "entries": len(entries),
+            "bytes": sum(size for _, size, _ in entries),
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
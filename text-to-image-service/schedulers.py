@@ -0,0 +1,170 @@
+import inspect
+from dataclasses import asdict, dataclass
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from diffusers import StableDiffusionXLPipeline
+
+
+# ComfyUI sampler names mapped to the diffusers scheduler class (and the options
+# that select the matching solver). Classes are looked up on the diffusers module
+# when first used, so importing this file stays cheap.
+SAMPLERS: dict[str, tuple[str, dict[str, object]]] = {
+    "euler": ("EulerDiscreteScheduler", {}),
+    "euler_ancestral": ("EulerAncestralDiscreteScheduler", {}),
+    "heun": ("HeunDiscreteScheduler", {}),
+    "dpm_2": ("KDPM2DiscreteScheduler", {}),
+    "dpm_2_ancestral": ("KDPM2AncestralDiscreteScheduler", {}),
+    "lms": ("LMSDiscreteScheduler", {}),
+    "dpmpp_2m": ("DPMSolverMultistepScheduler", {"algorithm_type": "dpmsolver++"}),
+    "dpmpp_2m_sde": ("DPMSolverMultistepScheduler", {"algorithm_type": "sde-dpmsolver++"}),
+    "dpmpp_sde": ("DPMSolverSinglestepScheduler", {}),
+    "ddim": ("DDIMScheduler", {}),
+    "ddpm": ("DDPMScheduler", {}),
+    "uni_pc": ("UniPCMultistepScheduler", {}),
+    "deis": ("DEISMultistepScheduler", {}),
+    "lcm": ("LCMScheduler", {}),
+    "tcd": ("TCDScheduler", {}),
+}
+
+# ComfyUI scheduler (sigma schedule) names mapped to scheduler options. "normal"
+# keeps the checkpoint's own spacing; "sgm_uniform" and "simple" space timesteps
+# from the end of the schedule ("trailing"), which few-step distilled models such
+# as SDXL-Lightning and SDXL-Turbo were trained with.
+SCHEDULES: dict[str, dict[str, object]] = {
+    "normal": {},
+    "karras": {"use_karras_sigmas": True},
+    "exponential": {"use_exponential_sigmas": True},
+    "beta": {"use_beta_sigmas": True},
+    "sgm_uniform": {"timestep_spacing": "trailing"},
+    "simple": {"timestep_spacing": "trailing"},
+    "ddim_uniform": {"timestep_spacing": "leading"},
+}
+
+# Sigma schedules each sampler's scheduler class has no option for. Checked by
+# name at preflight, before diffusers (and torch) are imported; create_scheduler
+# still checks the installed class, which can differ between diffusers versions.
+UNSUPPORTED_SCHEDULES: dict[str, frozenset[str]] = {
+    sampler: frozenset({"karras", "exponential", "beta"})
+    for sampler in ("euler_ancestral", "ddim", "ddpm", "lcm", "tcd")
+}
+
+# What a pipeline samples with when neither the request nor the config names a
+# sampler; the service has always run DPM++ 2M on the checkpoint's spacing.
+DEFAULT_SAMPLER = "dpmpp_2m"
+DEFAULT_SCHEDULE = "normal"
+
+
+@dataclass(frozen=True)
+class SchedulerPreset:
+    """A sampler, sigma schedule, step count and guidance scale that belong together."""
+
+    sampler_name: str
+    scheduler: str
+    steps: int
+    guidance_scale: float
+    description: str
+
+    def as_dict(self) -> dict[str, object]:
+        return asdict(self)
+
+
+PRESETS: dict[str, SchedulerPreset] = {
+    "quality": SchedulerPreset("dpmpp_2m", "karras", 30, 6.5, "DPM++ 2M Karras, full SDXL"),
+    "balanced": SchedulerPreset("dpmpp_2m", "karras", 20, 6.0, "DPM++ 2M Karras, fewer steps"),
+    "fast": SchedulerPreset("dpmpp_2m_sde", "karras", 12, 5.0, "DPM++ 2M SDE Karras, draft"),
+    "lightning": SchedulerPreset(
+        "euler", "sgm_uniform", 4, 0.0, "SDXL-Lightning 4-step LoRA/UNet"
+    ),
+    "lightning-8": SchedulerPreset(
+        "euler", "sgm_uniform", 8, 0.0, "SDXL-Lightning 8-step LoRA/UNet"
+    ),
+    "turbo": SchedulerPreset("euler_ancestral", "sgm_uniform", 1, 0.0, "SDXL-Turbo, one step"),
+    "lcm": SchedulerPreset("lcm", "normal", 4, 1.0, "LCM-LoRA for SDXL"),
+}
+
+
+def check_scheduler(sampler_name: str, scheduler: str) -> None:
+    if sampler_name not in SAMPLERS:
+        raise RuntimeError(
+            f"Unknown sampler_name '{sampler_name}'. Choose one of: {', '.join(sorted(SAMPLERS))}"
+        )
+    if scheduler not in SCHEDULES:
+        raise RuntimeError(
+            f"Unknown scheduler '{scheduler}'. Choose one of: {', '.join(sorted(SCHEDULES))}"
+        )
+    if scheduler in UNSUPPORTED_SCHEDULES.get(sampler_name, ()):
+        class_name = SAMPLERS[sampler_name][0]
+        raise RuntimeError(
+            f"Scheduler '{scheduler}' is not supported by sampler '{sampler_name}' "
+            f"({class_name} has no {', '.join(SCHEDULES[scheduler])} option)"
+        )
+
+
+def get_preset(name: str) -> SchedulerPreset:
+    preset = PRESETS.get(name)
+    if preset is None:
+        raise RuntimeError(
+            f"Unknown scheduler preset '{name}'. Choose one of: {', '.join(sorted(PRESETS))}"
+        )
+    return preset
+
+
+def create_scheduler(base_config: dict[str, object], sampler_name: str, scheduler: str) -> object:
+    """
+    Builds the diffusers scheduler for a ComfyUI sampler/scheduler pair.
+
+    `base_config` is the checkpoint's own scheduler config, so the noise schedule
+    (betas, prediction type, training timesteps) always comes from the model and
+    only the solver and the sigma spacing change.
+    """
+    import diffusers
+
+    check_scheduler(sampler_name, scheduler)
+    class_name, sampler_options = SAMPLERS[sampler_name]
+    cls = getattr(diffusers, class_name, None)
+    if cls is None:
+        raise RuntimeError(
+            f"Sampler '{sampler_name}' needs diffusers.{class_name}, which this diffusers "
+            "version does not provide"
+        )
+    accepted = inspect.signature(cls.__init__).parameters
+    unsupported = [name for name in SCHEDULES[scheduler] if name not in accepted]
+    if unsupported:
+        raise RuntimeError(
+            f"Scheduler '{scheduler}' is not supported by sampler '{sampler_name}' "
+            f"({class_name} has no {', '.join(unsupported)} option)"
+        )
+    options = {
+        name: value
+        for name, value in {**sampler_options, **SCHEDULES[scheduler]}.items()
+        if name in accepted
+    }
+    return cls.from_config(base_config, **options)
+
+
+def remember_scheduler_config(pipe: "StableDiffusionXLPipeline") -> None:
+    """Keeps the checkpoint's scheduler config so later swaps never compound."""
+    if getattr(pipe, "asset_scheduler_config", None) is None:
+        pipe.asset_scheduler_config = dict(pipe.scheduler.config)
+        pipe.asset_schedulers = {}
+        pipe.asset_scheduler_key = None
+
+
+def apply_scheduler(
+    pipe: "StableDiffusionXLPipeline", sampler_name: str | None, scheduler: str | None
+) -> None:
+    """
+    Switches a loaded pipeline to a sampler/scheduler pair without reloading anything.
+
+    Schedulers hold no weights, so a swap costs only the config construction;
+    instances are kept per pair on the pipeline and reused by later requests.
+    """
+    key = (sampler_name or DEFAULT_SAMPLER, scheduler or DEFAULT_SCHEDULE)
+    remember_scheduler_config(pipe)
+    if pipe.asset_scheduler_key == key:
+        return
+    if key not in pipe.asset_schedulers:
+        pipe.asset_schedulers[key] = create_scheduler(pipe.asset_scheduler_config, *key)
+    pipe.scheduler = pipe.asset_schedulers[key]
+    pipe.asset_scheduler_key = key
@@ -0,0 +1,26 @@
+import pytest
+
+import main
+
+
+def test_explicit_config_must_load(tmp_path):
+    with pytest.raises(RuntimeError, match="not found"):
+        main.load_config(str(tmp_path / "missing.json"))
+    broken = tmp_path / "broken.json"
+    broken.write_text("{not json")
+    with pytest.raises(RuntimeError, match="is not valid"):
+        main.load_config(str(broken))
+    listing = tmp_path / "list.json"
+    listing.write_text("[1, 2]")
+    with pytest.raises(RuntimeError, match="JSON object"):
+        main.load_config(str(listing))
+
+
+def test_unusable_default_config_is_ignored_with_a_warning(tmp_path, monkeypatch, capsys):
+    monkeypatch.setattr(main, "ROOT_DIR", tmp_path)
+    assert main.load_config(None) == {}
+    (tmp_path / "pipeline.json").write_text("{not json")
+    assert main.load_config(None) == {}
+    assert "Warning: ignoring" in capsys.readouterr().out
+    (tmp_path / "pipeline.json").write_text('{"steps": 4}')
+    assert main.load_config(None) == {"steps": 4}
@@ -0,0 +1,60 @@
+import pytest
+
+import cpu_inference
+import main
+from cpu_inference import CPUOptions, cpu_options, use_bf16
+
+
+def test_mode_defaults():
+    assert cpu_options("default") == CPUOptions()
+    assert cpu_options("optimized") == CPUOptions(
+        bf16="auto", channels_last=True, attention_slicing=True
+    )
+
+
+def test_explicit_knobs_override_the_mode():
+    options = cpu_options(
+        "optimized", threads=8, interop_threads=-1, bf16="off", attention_slicing=False
+    )
+    assert options == CPUOptions(threads=8, interop_threads=0, bf16="off", channels_last=True)
+    assert cpu_options("default", quantize_text_encoders=True).quantize_text_encoders
+
+
+@pytest.mark.parametrize(
+    "kwargs, message",
+    [({"mode": "turbo"}, "Unknown cpu mode"), ({"bf16": "maybe"}, "Unknown cpu bf16 setting")],
+)
+def test_invalid_settings_are_rejected(kwargs, message):
+    with pytest.raises(RuntimeError, match=message):
+        cpu_options(**kwargs)
+
+
+def test_bf16_auto_follows_hardware_support(monkeypatch):
+    monkeypatch.setattr(cpu_inference, "bf16_supported", lambda: False)
+    assert not use_bf16(CPUOptions(bf16="auto"))
+    assert use_bf16(CPUOptions(bf16="on"))
+    monkeypatch.setattr(cpu_inference, "bf16_supported", lambda: True)
+    assert use_bf16(CPUOptions(bf16="auto"))
+    assert not use_bf16(CPUOptions(bf16="off"))
+
+
+def test_cli_flags_and_config_block_reach_the_options():
+    args = main.parse_args(
+        ["--cpu-mode", "optimized", "--no-cpu-channels-last", "--cpu-threads", "4"]
+    )
+    assert main.create_cpu_options(args) == CPUOptions(
+        threads=4, bf16="auto", channels_last=False, attention_slicing=True
+    )
+
+    args = main.parse_args([])
+    main.apply_config(args, {"cpu": {"mode": "optimized", "bf16": "on", "unknown": 1}})
+    assert main.create_cpu_options(args) == CPUOptions(
+        bf16="on", channels_last=True, attention_slicing=True
+    )
+    assert not hasattr(args, "cpu_unknown")
+
+
+def test_parse_args_rejects_unknown_modes(capsys):
+    with pytest.raises(SystemExit):
+        main.parse_args(["--cpu-mode", "turbo"])
+    assert "invalid choice" in capsys.readouterr().err
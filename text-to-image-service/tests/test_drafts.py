@@ -0,0 +1,63 @@
+import argparse
+import json
+
+import pytest
+
+from drafts import (
+    MANIFEST_NAME,
+    draft_size,
+    draft_steps,
+    read_manifest,
+    run_finalize,
+    write_manifest,
+)
+
+
+def test_draft_size_snaps_to_multiples_of_64_within_bounds():
+    assert draft_size(1024, 1024, 0.5) == (512, 512)
+    assert draft_size(1000, 1344, 0.5) == (512, 640)
+    # Never below the smallest usable side, never above the full size.
+    assert draft_size(1024, 1024, 0.1) == (256, 256)
+    assert draft_size(512, 768, 2.0) == (512, 768)
+
+
+@pytest.mark.parametrize(
+    "steps, override, expected",
+    [(30, None, 10), (12, None, 8), (4, None, 4), (30, 6, 6)],
+)
+def test_draft_steps(steps, override, expected):
+    assert draft_steps(argparse.Namespace(steps=steps, draft_steps=override)) == expected
+
+
+def test_manifest_round_trip(tmp_path):
+    manifest = {"request": {"height": 1024}, "candidates": [{"seed": 7}]}
+    write_manifest(tmp_path, manifest)
+    assert [path.name for path in tmp_path.iterdir()] == [MANIFEST_NAME]
+    assert read_manifest(tmp_path) == (tmp_path, manifest)
+    # Pointing at any file inside the session works too.
+    assert read_manifest(tmp_path / MANIFEST_NAME) == (tmp_path, manifest)
+
+
+def test_unreadable_manifests_are_rejected(tmp_path):
+    with pytest.raises(RuntimeError, match="No draft session"):
+        read_manifest(tmp_path)
+    (tmp_path / MANIFEST_NAME).write_text("{not json")
+    with pytest.raises(RuntimeError, match="not valid JSON"):
+        read_manifest(tmp_path)
+
+
+@pytest.mark.parametrize(
+    "pick, message",
+    [
+        (None, "choose with --pick"),
+        ([2], "--pick 2 is out of range \\(0-1\\)"),
+        ([-1], "out of range"),
+    ],
+)
+def test_finalize_checks_picks_before_loading(tmp_path, pick, message):
+    (tmp_path / MANIFEST_NAME).write_text(
+        json.dumps({"request": {}, "candidates": [{"seed": 1}, {"seed": 2}]})
+    )
+    args = argparse.Namespace(finalize=str(tmp_path), pick=pick, trace_file=None)
+    with pytest.raises(RuntimeError, match=message):
+        run_finalize(args)
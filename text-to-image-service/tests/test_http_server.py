@@ -0,0 +1,67 @@
+import argparse
+import asyncio
+import threading
+import time
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("diffusers")
+
+import http_server  # noqa: E402
+from http_server import GenerationRequest, MicroBatcher  # noqa: E402
+
+
+@pytest.fixture
+def batcher(monkeypatch):
+    threads = []
+
+    def prepare(self, payload):
+        threads.append(threading.current_thread())
+        return GenerationRequest(
+            id=str(payload["id"]),
+            args=argparse.Namespace(),
+            key=("same",),
+            loras=[],
+            base_model="base",
+            arrived=time.monotonic(),
+        )
+
+    monkeypatch.setattr(http_server, "create_prompt_cache", lambda args: None)
+    monkeypatch.setattr(http_server, "create_output_writer", lambda args: None)
+    monkeypatch.setattr(MicroBatcher, "_prepare", prepare)
+    batcher = MicroBatcher(
+        argparse.Namespace(),
+        "cpu",
+        torch.float32,
+        None,
+        max_batch_size=4,
+        max_wait=1.0,
+        max_queue=2,
+    )
+    batcher.prepare_threads = threads
+    return batcher
+
+
+def test_submit_validates_off_the_event_loop(batcher):
+    async def submit_all():
+        return [await batcher.submit({"id": index}) for index in range(3)]
+
+    first, second, rejected = asyncio.run(submit_all())
+    assert [first.status, second.status] == ["queued", "queued"]
+    assert rejected is None
+    assert all(thread is not threading.main_thread() for thread in batcher.prepare_threads)
+    assert batcher.queued == 2
+
+
+def test_cancel_drops_queued_requests_but_not_saving_ones(batcher):
+    async def submit_all():
+        return [await batcher.submit({"id": index}) for index in range(2)]
+
+    queued, saving = asyncio.run(submit_all())
+    saving.status = "saving"
+    assert batcher.cancel(queued.id).status == "cancelled"
+    assert batcher.cancel(saving.id).status == "saving"
+    assert not saving.token.cancelled
+    assert batcher.queued == 1
+    assert batcher._groups[("same",)] == [saving]
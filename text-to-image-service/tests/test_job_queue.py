@@ -0,0 +1,171 @@
+import json
+import os
+import threading
+import time
+
+from job_queue import LeaseKeeper, MemoryQueue, SpoolQueue
+
+
+def test_memory_queue_lease_ack_and_requeue():
+    queue = MemoryQueue(visibility_timeout=0.05, max_attempts=2)
+    job_id = queue.put({"prompt": "a"}, "job-1")
+    [job] = queue.receive()
+    assert job.id == job_id and job.attempts == 1
+    assert queue.receive() == []
+
+    time.sleep(0.1)
+    [again] = queue.receive()
+    assert again.attempts == 2
+    assert queue.nack(again, "boom")
+    assert [dead.id for dead in queue.dead_letters] == [job_id]
+    assert queue.dead_letters[0].payload["_error"] == "boom"
+    assert len(queue) == 0
+
+
+def test_memory_queue_cancel_pending_and_inflight():
+    queue = MemoryQueue()
+    queue.put({}, "a")
+    queue.put({}, "b")
+    assert queue.cancel("b") == "cancelled"
+    [job] = queue.receive()
+    assert queue.cancel("a") == "cancelling"
+    assert queue.is_cancelled("a")
+    assert queue.discard(job, "cancelled")
+    assert {job.id for job in queue.cancelled} == {"a", "b"}
+    assert queue.cancel("missing") == "unknown"
+
+
+def test_spool_queue_states(tmp_path):
+    queue = SpoolQueue(tmp_path, max_attempts=2)
+    queue.put({"prompt": "a"}, "job/1")
+    [job] = queue.receive()
+    assert job.id == "job_1"
+    assert len(list((tmp_path / "inflight").glob("job_1@*.json"))) == 1
+
+    assert queue.nack(job, "first")
+    [job] = queue.receive()
+    assert job.attempts == 2
+    assert queue.nack(job, "second")
+    [record] = queue.records("failed")
+    assert record["error"] == "second" and record["attempts"] == 2
+    assert not queue.ack(job)
+
+
+def test_spool_queue_ingests_appended_lines(tmp_path):
+    source = tmp_path / "requests.jsonl"
+    source.write_text(json.dumps({"request_id": "r1", "prompt": "a"}) + "\n")
+    queue = SpoolQueue(tmp_path / "spool", source=source)
+    assert [job.id for job in queue.receive(4)] == ["r1"]
+
+    with source.open("a") as f:
+        f.write("not json\n")
+        f.write(json.dumps({"prompt": "b"}) + "\n")
+        f.write('{"request_id": "partial"')
+    assert [job.id for job in queue.receive(4)] == ["requests-000003"]
+    assert queue.receive(4) == []
+
+
+def test_spool_queue_restarts_lease_clock_on_receive(tmp_path):
+    queue = SpoolQueue(tmp_path, visibility_timeout=60)
+    queue.put({}, "old")
+    stale = time.time() - 3600
+    os.utime(tmp_path / "pending" / "old.json", (stale, stale))
+
+    [job] = queue.receive()
+    sibling = SpoolQueue(tmp_path, visibility_timeout=60)
+    assert sibling.receive() == []
+    assert queue.ack(job, {"ok": True})
+    assert queue.records("done")[0]["result"] == {"ok": True}
+
+
+def test_spool_queue_expired_lease_is_redelivered(tmp_path):
+    queue = SpoolQueue(tmp_path, visibility_timeout=0.05)
+    queue.put({}, "slow")
+    [job] = queue.receive()
+    time.sleep(0.1)
+    [again] = SpoolQueue(tmp_path, visibility_timeout=0.05).receive()
+    assert again.id == "slow" and again.attempts == 2
+    assert not queue.ack(job)
+    assert not queue.extend(job)
+
+
+def test_spool_queue_extend_keeps_lease(tmp_path):
+    queue = SpoolQueue(tmp_path, visibility_timeout=0.2)
+    queue.put({}, "long")
+    [job] = queue.receive()
+    for _ in range(4):
+        time.sleep(0.1)
+        assert queue.extend(job)
+        assert SpoolQueue(tmp_path, visibility_timeout=0.2).receive() == []
+    assert queue.ack(job)
+
+
+def test_spool_queue_concurrent_workers_deliver_each_job_once(tmp_path):
+    total = 200
+    seed = SpoolQueue(tmp_path)
+    for index in range(total):
+        seed.put({"index": index}, f"job-{index:03d}")
+
+    received: list[list[str]] = [[] for _ in range(4)]
+    errors: list[BaseException] = []
+
+    def work(slot: int) -> None:
+        queue = SpoolQueue(tmp_path)
+        try:
+            while True:
+                jobs = queue.receive(3)
+                if not jobs:
+                    if not any((tmp_path / "pending").iterdir()):
+                        return
+                    continue
+                for job in jobs:
+                    received[slot].append(job.id)
+                    assert queue.ack(job)
+        except BaseException as exc:
+            errors.append(exc)
+
+    threads = [threading.Thread(target=work, args=(slot,)) for slot in range(len(received))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=60)
+
+    assert errors == []
+    delivered = [job_id for ids in received for job_id in ids]
+    assert sorted(delivered) == [f"job-{index:03d}" for index in range(total)]
+    assert len(seed.records("done")) == total
+    assert len(seed) == 0
+
+
+def test_lease_keeper_renews_held_jobs(tmp_path):
+    queue = SpoolQueue(tmp_path, visibility_timeout=0.3)
+    queue.put({}, "render")
+    queue.put({}, "prefetched")
+    jobs = queue.receive(2)
+    leases = LeaseKeeper(queue)
+    try:
+        for job in jobs:
+            leases.hold(job)
+        time.sleep(0.8)
+        assert SpoolQueue(tmp_path, visibility_timeout=0.3).receive(2) == []
+        for job in jobs:
+            leases.drop(job)
+            assert queue.ack(job)
+        assert leases.renew() == []
+    finally:
+        leases.close()
+
+
+def test_lease_keeper_reports_lost_leases(tmp_path):
+    queue = SpoolQueue(tmp_path, visibility_timeout=0.05)
+    queue.put({}, "stale")
+    [job] = queue.receive()
+    time.sleep(0.1)
+    [again] = SpoolQueue(tmp_path, visibility_timeout=0.05).receive()
+    leases = LeaseKeeper(queue, interval=60)
+    try:
+        leases.hold(job)
+        assert leases.renew() == [job]
+        assert leases.renew() == []
+    finally:
+        leases.close()
@@ -0,0 +1,114 @@
+from types import SimpleNamespace
+
+import pytest
+
+import memory_budget
+from memory_budget import GIB, VAE_BYTES_PER_MEGAPIXEL, plan_memory, vae_bytes
+
+PIPE = SimpleNamespace(unet=SimpleNamespace(dtype="float16"))
+
+
+@pytest.fixture
+def flat_unet(monkeypatch):
+    """1 GiB of UNet activations per image, a third less with attention slicing."""
+    monkeypatch.setattr(memory_budget, "resident_weight_bytes", lambda pipe, device: 2 * GIB)
+    monkeypatch.setattr(
+        memory_budget,
+        "unet_bytes",
+        lambda height, width, dtype, guidance, slicing: GIB * (2 / 3 if slicing else 1),
+    )
+
+
+def test_vae_modes():
+    outputs = 1024 * 1024 * 3 * 4
+    assert vae_bytes(1024, 1024, 4, "full") == 4 * VAE_BYTES_PER_MEGAPIXEL + 4 * outputs
+    assert vae_bytes(1024, 1024, 4, "sliced") == VAE_BYTES_PER_MEGAPIXEL + 4 * outputs
+    # A tile is never larger than the image it is cut from.
+    assert vae_bytes(256, 256, 1, "tiled") == vae_bytes(256, 256, 1, "sliced")
+    assert vae_bytes(2048, 2048, 1, "tiled") < vae_bytes(2048, 2048, 1, "sliced")
+
+
+def test_cheapest_fitting_plan_wins(flat_unet):
+    # Working memory is 0.9 * 20 GiB - 2 GiB = 16 GiB: four full VAE decodes (12 GiB+)
+    # fit beside four images of UNet activations.
+    plan = plan_memory(PIPE, "cuda", 20 * GIB, 1024, 1024, 5.0, requested=4)
+    assert (plan.chunk_size, plan.attention_slicing, plan.vae_mode, plan.fits) == (
+        4,
+        False,
+        "full",
+        True,
+    )
+    assert plan.estimated_peak_bytes == 2 * GIB + int(vae_bytes(1024, 1024, 4, "full"))
+
+
+def test_decode_is_sliced_before_attention_or_batch(flat_unet):
+    # 0.9 * 10 GiB - 2 GiB = 7 GiB: the full decode of four images no longer fits,
+    # a sliced decode does, and four images of activations (4 GiB) still fit.
+    plan = plan_memory(PIPE, "cuda", 10 * GIB, 1024, 1024, 5.0, requested=4)
+    assert (plan.chunk_size, plan.attention_slicing, plan.vae_mode) == (4, False, "sliced")
+
+
+def test_attention_is_sliced_before_the_batch_is_split(flat_unet):
+    # 0.9 * 6 GiB - 2 GiB = 3.4 GiB: four images of activations (4 GiB) only fit
+    # with attention slicing (4 * 2/3 GiB).
+    plan = plan_memory(PIPE, "cuda", 6 * GIB, 1024, 1024, 5.0, requested=4)
+    assert (plan.chunk_size, plan.attention_slicing, plan.vae_mode) == (4, True, "sliced")
+
+
+def test_batch_is_split_last(flat_unet):
+    # 0.9 * 5 GiB - 2 GiB = 2.5 GiB: four images do not fit in any mode; three do with
+    # sliced attention, and only a tiled decode keeps the VAE under 2.5 GiB.
+    plan = plan_memory(PIPE, "cuda", 5 * GIB, 1024, 1024, 5.0, requested=4)
+    assert (plan.chunk_size, plan.attention_slicing, plan.vae_mode) == (3, True, "tiled")
+
+
+def test_free_memory_caps_the_budget(flat_unet):
+    # 20 GiB would fit everything, but only 0.9 * 4 GiB is actually free.
+    plan = plan_memory(
+        PIPE, "cuda", 20 * GIB, 1024, 1024, 5.0, requested=4, available_bytes=4 * GIB
+    )
+    assert (plan.chunk_size, plan.attention_slicing, plan.vae_mode) == (4, True, "sliced")
+
+
+def test_leanest_plan_when_nothing_fits(flat_unet):
+    plan = plan_memory(PIPE, "cuda", 2 * GIB, 1024, 1024, 5.0, requested=2)
+    assert (plan.chunk_size, plan.attention_slicing, plan.vae_mode, plan.fits) == (
+        1,
+        True,
+        "tiled",
+        False,
+    )
+
+
+def test_unet_activations_scale_with_dtype_guidance_and_slicing():
+    torch = pytest.importorskip("torch")
+
+    base = memory_budget.unet_bytes(1024, 1024, torch.float16, 1.0, False)
+    assert base == memory_budget.UNET_BYTES_PER_MEGAPIXEL
+    assert memory_budget.unet_bytes(1024, 1024, torch.float32, 1.0, False) == 2 * base
+    assert memory_budget.unet_bytes(1024, 1024, torch.float16, 5.0, False) == 2 * base
+    assert memory_budget.unet_bytes(1024, 1024, torch.float16, 1.0, True) < base
+
+
+class RecordingPipe:
+    def __init__(self):
+        self.vae = SimpleNamespace(tile_sample_min_size=1024, tile_latent_min_size=128)
+        self.calls = []
+
+    def __getattr__(self, name):
+        if name.startswith(("enable_", "disable_")):
+            return lambda *args: self.calls.append(name)
+        raise AttributeError(name)
+
+
+def test_applying_a_plan_undoes_the_previous_one():
+    pipe = RecordingPipe()
+    lean = memory_budget.MemoryPlan(GIB, 0, 1, True, "tiled", GIB, True)
+    memory_budget.apply_memory_plan(pipe, lean)
+    assert pipe.calls == ["enable_attention_slicing", "enable_vae_tiling", "disable_vae_slicing"]
+    assert pipe.vae.tile_sample_min_size == memory_budget.VAE_TILE_SIZE
+
+    pipe.calls.clear()
+    full = memory_budget.MemoryPlan(GIB, 0, 4, False, "full", GIB, True)
+    memory_budget.apply_memory_plan(pipe, full)
+    assert pipe.calls == ["disable_attention_slicing", "disable_vae_tiling", "disable_vae_slicing"]
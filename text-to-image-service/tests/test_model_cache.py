@@ -0,0 +1,91 @@
+import json
+import os
+import time
+
+import pytest
+
+from model_cache import META_NAME, ModelCache
+from model_registry import ModelRegistry
+
+
+def make_entry(root, name, size, age):
+    entry = root / name
+    entry.mkdir(parents=True)
+    (entry / META_NAME).write_text(json.dumps({"bytes": size}))
+    stamp = time.time() - age
+    os.utime(entry / META_NAME, (stamp, stamp))
+    return entry
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    root = tmp_path / "cache"
+    cache = ModelCache(root, max_bytes=300, registry=ModelRegistry(tmp_path / "models"))
+    make_entry(root, "old", 100, age=30)
+    make_entry(root, "recent", 100, age=10)
+    make_entry(root, ".partial.tmp", 500, age=60)
+    cache._evict(150)
+    assert not (root / "old").exists()
+    assert (root / "recent").exists() and (root / ".partial.tmp").exists()
+    assert [path.name for path, _, _ in cache.entries()] == ["recent"]
+
+
+class SavedPipeline:
+    def __init__(self):
+        self.saves = 0
+
+    def save_pretrained(self, path, safe_serialization=True):
+        self.saves += 1
+        os.makedirs(path)
+        with open(os.path.join(path, "model_index.json"), "w") as f:
+            f.write("{}")
+
+
+def test_store_writes_one_entry_per_key(tmp_path):
+    pytest.importorskip("diffusers")
+    cache = ModelCache(tmp_path / "cache", registry=ModelRegistry(tmp_path / "models"))
+    checkpoint = tmp_path / "base.safetensors"
+    checkpoint.write_bytes(b"weights")
+    pipe = SavedPipeline()
+    entry = cache.store(pipe, str(checkpoint), "torch.float16", [])
+    assert cache.store(pipe, str(checkpoint), "torch.float16", []) == entry
+    assert pipe.saves == 1
+    assert json.loads((entry / META_NAME).read_text())["base_model"] == str(checkpoint)
+    other = cache.store(pipe, str(checkpoint), "torch.float32", [])
+    assert other != entry and len(cache.entries()) == 2
+
+
+def test_model_cache_is_opt_in(monkeypatch, tmp_path):
+    from main import create_model_cache, parse_args
+
+    monkeypatch.delenv("ASSET_TTI_MODEL_CACHE_DIR", raising=False)
+    assert create_model_cache(parse_args([])) is None
+    enabled = create_model_cache(parse_args(["--model-cache-dir", str(tmp_path / "cache")]))
+    assert enabled.root == tmp_path / "cache"
+    assert create_model_cache(parse_args(["--model-cache-dir", "none"])) is None
+
+
+def test_cache_entry_is_stored_before_the_scheduler_swap(monkeypatch, tmp_path):
+    import main
+
+    checkpoint = tmp_path / "base.safetensors"
+    checkpoint.write_bytes(b"weights")
+    events = []
+
+    class RecordingCache:
+        def load(self, base_model, dtype, loras):
+            return None
+
+        def store(self, pipe, base_model, dtype, loras):
+            events.append("store")
+
+    monkeypatch.setattr(main, "read_base_pipeline", lambda base_model, dtype: object())
+    monkeypatch.setattr(
+        main, "finish_base_pipeline", lambda pipe, base_model: events.append("finish")
+    )
+    monkeypatch.setattr(main, "place_pipeline", lambda *args: None)
+
+    main.load_base_pipeline(str(checkpoint), "float16", RecordingCache())
+    assert events == ["store", "finish"]
+    events.clear()
+    main.build_pipeline(str(checkpoint), "cpu", "float16", None, None, model_cache=RecordingCache())
+    assert events == ["store", "finish"]
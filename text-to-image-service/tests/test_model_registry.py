@@ -0,0 +1,148 @@
+import json
+import struct
+
+import pytest
+
+from model_registry import ModelRegistry, read_safetensors_header
+
+
+def write_safetensors(path, tensors, metadata=None):
+    header = {
+        name: {"dtype": dtype, "shape": shape, "data_offsets": [0, 0]}
+        for name, (dtype, shape) in tensors.items()
+    }
+    if metadata:
+        header["__metadata__"] = metadata
+    raw = json.dumps(header).encode("utf-8")
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(struct.pack("<Q", len(raw)) + raw)
+    return path
+
+
+SDXL_KEY = "model.diffusion_model.input_blocks.4.1.transformer_blocks.0.attn2.to_k.weight"
+SD1_KEY = "model.diffusion_model.input_blocks.1.1.transformer_blocks.0.attn2.to_k.weight"
+LORA_KEY = "lora_unet_input_blocks_4_1_transformer_blocks_0_attn2_to_k.lora_down.weight"
+
+
+@pytest.fixture
+def models(tmp_path):
+    root = tmp_path / "models"
+    write_safetensors(root / "checkpoints" / "xl_base.safetensors", {SDXL_KEY: ("F16", [640, 2048])})
+    write_safetensors(root / "checkpoints" / "sd15.safetensors", {SD1_KEY: ("F32", [320, 768])})
+    write_safetensors(
+        root / "loras" / "styles" / "pixel.safetensors",
+        {LORA_KEY: ("F16", [16, 2048])},
+        {"ss_output_name": "pixel_art", "ss_network_dim": "16"},
+    )
+    return root
+
+
+def test_headers_identify_architecture_and_rank(models):
+    registry = ModelRegistry(models)
+    assert registry.find("checkpoint", "xl_base").architecture == "sdxl"
+    assert registry.find("checkpoint", "sd15.safetensors").architecture == "sd1"
+    lora = registry.find("lora", "pixel_art")
+    assert lora is registry.find("lora", "styles/pixel")
+    assert (lora.architecture, lora.rank, lora.dtypes) == ("sdxl", 16, ["F16"])
+    assert registry.find("lora", "missing") is None
+
+
+def test_mismatched_lora_is_rejected(models):
+    registry = ModelRegistry(models)
+    lora = models / "loras" / "styles" / "pixel.safetensors"
+    registry.check_lora(str(models / "checkpoints" / "xl_base.safetensors"), lora)
+    with pytest.raises(RuntimeError, match="cannot be combined"):
+        registry.check_lora(str(models / "checkpoints" / "sd15.safetensors"), lora)
+
+
+def test_index_is_reused_and_refreshed(models):
+    ModelRegistry(models)
+    index = json.loads((models / "registry.json").read_text())
+    assert len(index["models"]) == 3
+
+    checkpoint = models / "checkpoints" / "xl_base.safetensors"
+    write_safetensors(checkpoint, {SD1_KEY: ("F16", [320, 768]), "extra": ("F16", [1])})
+    (models / "checkpoints" / "sd15.safetensors").unlink()
+    registry = ModelRegistry(models)
+    assert registry.find("checkpoint", "xl_base").architecture == "sd1"
+    assert registry.find("checkpoint", "xl_base").tensors == 2
+    assert registry.find("checkpoint", "sd15") is None
+
+
+def test_digest_is_cached_until_the_file_changes(models):
+    registry = ModelRegistry(models)
+    path = models / "checkpoints" / "xl_base.safetensors"
+    first = registry.digest(path)
+    assert first == registry.digest(path)
+    assert ModelRegistry(models).find("checkpoint", "xl_base").sha256 == first
+
+
+def test_bad_headers_are_reported(tmp_path):
+    short = tmp_path / "short.safetensors"
+    short.write_bytes(b"abc")
+    with pytest.raises(RuntimeError, match="too short"):
+        read_safetensors_header(short)
+    huge = tmp_path / "huge.safetensors"
+    huge.write_bytes(struct.pack("<Q", 1 << 40))
+    with pytest.raises(RuntimeError, match="implausible"):
+        read_safetensors_header(huge)
+    garbled = tmp_path / "garbled.safetensors"
+    garbled.write_bytes(struct.pack("<Q", 4) + b"nope")
+    with pytest.raises(RuntimeError, match="unreadable"):
+        read_safetensors_header(garbled)
+
+
+def test_lookup_rescans_for_files_added_later(models):
+    registry = ModelRegistry(models)
+    assert registry.find("lora", "ink") is None
+    write_safetensors(models / "loras" / "ink.safetensors", {LORA_KEY: ("F16", [8, 2048])})
+    assert registry.lookup("lora", "missing", "ink").rank == 8
+    assert registry.lookup("lora", "still-missing") is None
+
+
+def test_names_added_after_startup_resolve(models, monkeypatch):
+    import main
+
+    monkeypatch.setattr(main, "MODELS_DIR", models)
+    monkeypatch.setattr(main, "CHECKPOINTS_DIR", models / "checkpoints")
+    assert main.resolve_base_model("xl_base") == str((models / "checkpoints" / "xl_base.safetensors").resolve())
+
+    write_safetensors(models / "checkpoints" / "late.safetensors", {SDXL_KEY: ("F16", [640, 2048])})
+    write_safetensors(models / "loras" / "late_style.safetensors", {LORA_KEY: ("F16", [4, 2048])})
+    assert main.resolve_base_model("late").endswith("late.safetensors")
+    assert main.resolve_lora_values("late_style", None)[1] == "late_style.safetensors"
+    # A diffusers directory without model_index.json is still found by its name.
+    (models / "checkpoints" / "plain_dir").mkdir()
+    assert main.resolve_base_model("plain_dir") == str(models / "checkpoints" / "plain_dir")
+
+
+def test_file_digests_are_persisted_in_the_index(models, tmp_path):
+    registry = ModelRegistry(models)
+    outside = tmp_path / "elsewhere" / "lora.safetensors"
+    write_safetensors(outside, {LORA_KEY: ("F16", [4, 2048])})
+    first = registry.file_digest(outside)
+
+    index = json.loads((models / "registry.json").read_text())
+    index["hashes"][str(outside.resolve())]["sha256"] = "remembered"
+    (models / "registry.json").write_text(json.dumps(index))
+    assert ModelRegistry(models).file_digest(outside) == "remembered"
+
+    outside.write_bytes(b"changed")
+    assert ModelRegistry(models).file_digest(outside) not in {first, "remembered"}
+
+
+def test_source_digest_covers_directories_and_hub_ids(models):
+    registry = ModelRegistry(models)
+    model = models / "checkpoints" / "diffusers_model"
+    (model / "unet").mkdir(parents=True)
+    (model / "unet" / "weights.safetensors").write_bytes(b"a")
+    (model / ".cache").mkdir()
+    (model / ".cache" / "lock").write_bytes(b"ignored")
+    before = registry.source_digest(str(model))
+    (model / ".cache" / "lock").write_bytes(b"still ignored")
+    assert registry.source_digest(str(model)) == before
+    (model / "unet" / "weights.safetensors").write_bytes(b"b")
+    assert registry.source_digest(str(model)) != before
+    assert registry.source_digest("stabilityai/sdxl") == "ref:stabilityai/sdxl"
+    checkpoint = models / "checkpoints" / "xl_base.safetensors"
+    assert registry.source_digest(str(checkpoint)) == registry.digest(checkpoint)
@@ -0,0 +1,78 @@
+import threading
+
+import pytest
+
+import output_writer
+from output_writer import OutputFormat, OutputWriter
+
+
+class FakeImage:
+    """Writes its payload where PIL would write the encoded image."""
+
+    def __init__(self, payload=b"image", fail=False):
+        self.payload = payload
+        self.fail = fail
+        self.saved_with = None
+
+    def save(self, f, **kwargs):
+        self.saved_with = kwargs
+        f.write(self.payload[:2])
+        if self.fail:
+            raise OSError("disk full")
+        f.write(self.payload[2:])
+
+
+@pytest.fixture
+def frozen_time(monkeypatch):
+    monkeypatch.setattr(output_writer.time, "time", lambda: 1700000000)
+
+
+@pytest.mark.parametrize("atomic", [False, True])
+def test_names_never_collide(tmp_path, frozen_time, atomic):
+    writer = OutputWriter(workers=4, atomic=atomic)
+    (tmp_path / "asset_1700000000.png").write_bytes(b"earlier run")
+    batches = [writer.submit([FakeImage(bytes([n]) * 4)], tmp_path, "asset") for n in range(3)]
+    paths = sorted(path for batch in batches for path in batch.result())
+    writer.close()
+    assert [path.name for path in paths] == [
+        "asset_1700000000_1.png",
+        "asset_1700000000_2.png",
+        "asset_1700000000_3.png",
+    ]
+    assert sorted(path.read_bytes() for path in paths) == [bytes([n]) * 4 for n in range(3)]
+    assert (tmp_path / "asset_1700000000.png").read_bytes() == b"earlier run"
+
+
+def test_batch_names_and_order(tmp_path, frozen_time):
+    writer = OutputWriter()
+    images = [FakeImage(), FakeImage()]
+    batch = writer.submit(
+        images, tmp_path, "chest", OutputFormat("webp", quality=80), start=4, total=6
+    )
+    done = threading.Event()
+    batch.add_done_callback(lambda _: done.set())
+    assert [path.name for path in batch.result()] == [
+        "chest_1700000000_004.webp",
+        "chest_1700000000_005.webp",
+    ]
+    assert done.wait(5) and batch.done()
+    assert images[0].saved_with == {"format": "WEBP", "lossless": False, "quality": 80}
+    writer.close()
+
+
+@pytest.mark.parametrize("atomic", [False, True])
+def test_failed_writes_leave_no_partial_files(tmp_path, frozen_time, atomic):
+    writer = OutputWriter(atomic=atomic)
+    batch = writer.submit([FakeImage(fail=True)], tmp_path, "asset")
+    with pytest.raises(OSError, match="disk full"):
+        batch.result()
+    writer.close()
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_atomic_writes_only_expose_complete_files(tmp_path, frozen_time):
+    writer = OutputWriter(atomic=True, fsync=True)
+    path = writer.submit([FakeImage(b"complete")], tmp_path, "asset").result()[0]
+    writer.close()
+    assert path.read_bytes() == b"complete"
+    assert [entry.name for entry in tmp_path.iterdir()] == [path.name]
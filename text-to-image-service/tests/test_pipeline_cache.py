@@ -0,0 +1,126 @@
+import json
+import struct
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("diffusers")
+
+import pipeline_cache  # noqa: E402
+from pipeline_cache import PipelineCache  # noqa: E402
+
+
+class AdapterPipeline:
+    """Records the adapter calls PipelineCache makes on a loaded pipeline."""
+
+    def __init__(self, base_model, numel):
+        self.base_model = base_model
+        self.components = {"unet": torch.nn.Linear(numel, 1, bias=False)}
+        self.calls = []
+
+    def enable_lora(self):
+        self.calls.append(("enable",))
+
+    def disable_lora(self):
+        self.calls.append(("disable",))
+
+    def set_adapters(self, names, adapter_weights):
+        self.calls.append(("set", tuple(names), tuple(adapter_weights)))
+
+    def delete_adapters(self, name):
+        self.calls.append(("delete", name))
+
+
+@pytest.fixture
+def loads(monkeypatch):
+    loaded = []
+
+    def load_base_pipeline(base_model, dtype, model_cache=None):
+        loaded.append(base_model)
+        return AdapterPipeline(base_model, numel=100)
+
+    def load_lora_adapters(pipe, loras):
+        return [f"{weight_name}" for _, weight_name, _ in loras]
+
+    monkeypatch.setattr(pipeline_cache, "load_base_pipeline", load_base_pipeline)
+    monkeypatch.setattr(pipeline_cache, "load_lora_adapters", load_lora_adapters)
+    monkeypatch.setattr(pipeline_cache, "lora_adapter_name", lambda repo, weight: weight)
+    monkeypatch.setattr(pipeline_cache, "place_pipeline", lambda *args: None)
+    return loaded
+
+
+def test_pipelines_are_reused_per_model(loads):
+    cache = PipelineCache(max_bytes=None)
+    first, load_s, _ = cache.get("a", torch.float32, "cpu")
+    again, again_s, _ = cache.get("a", torch.float32, "cpu")
+    assert first is again and again_s == 0.0
+    cache.get("a", torch.float16, "cpu")
+    assert loads == ["a", "a"]
+    assert (cache.stats()["hits"], cache.stats()["misses"]) == (1, 2)
+
+
+def test_least_recently_used_pipeline_is_evicted(loads, monkeypatch):
+    monkeypatch.setattr(pipeline_cache, "estimate_model_bytes", lambda base_model, dtype: 400)
+    # Each pipeline holds 400 bytes of float32 weights; the budget fits two.
+    cache = PipelineCache(max_bytes=800)
+    cache.get("a", torch.float32, "cpu")
+    cache.get("b", torch.float32, "cpu")
+    cache.get("a", torch.float32, "cpu")
+    cache.get("c", torch.float32, "cpu")
+    cache.get("a", torch.float32, "cpu")
+    cache.get("b", torch.float32, "cpu")
+    assert loads == ["a", "b", "c", "b"]
+    assert cache.stats()["evictions"] == 2
+
+
+def test_loras_switch_without_reloading(loads):
+    cache = PipelineCache(max_bytes=None)
+    pipe, _, _ = cache.get("a", torch.float32, "cpu", [("repo", "pixel", 0.8)])
+    cache.get("a", torch.float32, "cpu", [("repo", "pixel", 0.8)])
+    cache.get("a", torch.float32, "cpu", [("repo", "pixel", 0.5), ("repo", "ink", 1.0)])
+    cache.get("a", torch.float32, "cpu")
+    assert loads == ["a"]
+    assert pipe.calls == [
+        ("enable",),
+        ("set", ("pixel",), (0.8,)),
+        ("enable",),
+        ("set", ("pixel", "ink"), (0.5, 1.0)),
+        ("disable",),
+    ]
+    assert pipe.asset_lora_state == ()
+
+
+def test_adapter_weights_count_towards_the_budget(loads, monkeypatch):
+    def load_lora_adapters(pipe, loras):
+        for _, weight_name, _ in loras:
+            pipe.components[weight_name] = torch.nn.Linear(100, 1, bias=False)
+        return [weight_name for _, weight_name, _ in loras]
+
+    monkeypatch.setattr(pipeline_cache, "load_lora_adapters", load_lora_adapters)
+    monkeypatch.setattr(pipeline_cache, "estimate_model_bytes", lambda base_model, dtype: 400)
+    cache = PipelineCache(max_bytes=1000)
+    cache.get("a", torch.float32, "cpu")
+    cache.get("b", torch.float32, "cpu", [("repo", "pixel", 1.0)])
+    # The adapter doubles "b" to 800 bytes, so "a" no longer fits beside it.
+    assert cache.stats()["bytes"] == 800
+    assert cache.stats()["evictions"] == 1
+    cache.get("b", torch.float32, "cpu")
+    assert loads == ["a", "b"]
+
+
+def test_estimate_uses_the_load_dtype(tmp_path):
+    header = json.dumps(
+        {"weight": {"dtype": "F32", "shape": [10, 10], "data_offsets": [0, 400]}}
+    ).encode("utf-8")
+    checkpoint = tmp_path / "model.safetensors"
+    checkpoint.write_bytes(struct.pack("<Q", len(header)) + header + bytes(400))
+    assert pipeline_cache.estimate_model_bytes(str(checkpoint), torch.float32) == 400
+    assert pipeline_cache.estimate_model_bytes(str(checkpoint), torch.float16) == 200
+
+    model = tmp_path / "diffusers"
+    (model / "unet").mkdir(parents=True)
+    (model / "unet" / "diffusion_pytorch_model.safetensors").write_bytes(checkpoint.read_bytes())
+    (model / "unet" / "diffusion_pytorch_model.fp16.safetensors").write_bytes(
+        checkpoint.read_bytes()
+    )
+    assert pipeline_cache.estimate_model_bytes(str(model), torch.float16) == 200
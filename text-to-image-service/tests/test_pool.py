@@ -0,0 +1,100 @@
+import argparse
+import json
+
+import pytest
+
+import pool
+from job_queue import SpoolQueue
+
+
+def test_cpu_workers_get_disjoint_core_sets(monkeypatch):
+    monkeypatch.setattr(pool, "available_cores", lambda: [0, 1, 2, 3, 4])
+    plan = pool.plan_workers(2, "cpu", "auto")
+    assert plan == [
+        {"device": "cpu", "cpu_cores": [0, 1, 2]},
+        {"device": "cpu", "cpu_cores": [3, 4]},
+    ]
+    # Never more workers than cores.
+    assert len(pool.plan_workers(8, "cpu", "auto")) == 5
+
+
+def test_gpus_are_dealt_round_robin(monkeypatch):
+    monkeypatch.setattr(pool, "cuda_device_ids", lambda: ["0", "1"])
+    assert [item["gpu"] for item in pool.plan_workers(3, "auto", "auto")] == ["0", "1", "0"]
+    assert [item["gpu"] for item in pool.plan_workers(2, "cuda:2,cuda:3", "auto")] == ["2", "3"]
+    monkeypatch.setattr(pool, "cuda_device_ids", lambda: [])
+    with pytest.raises(RuntimeError, match="No CUDA devices"):
+        pool.plan_workers(2, "cuda", "auto")
+
+
+class InlineProcess:
+    """Runs the pool worker target in-process, one after the other, on start()."""
+
+    next_pid = 1000
+
+    def __init__(self, target, args, name):
+        self.target, self.args, self.name = target, args, name
+        self.pid = InlineProcess.next_pid
+        InlineProcess.next_pid += 1
+        self.exitcode = None
+
+    def start(self):
+        self.target(*self.args, pid=self.pid)
+        self.exitcode = 0
+
+    def join(self):
+        pass
+
+
+def drain(index, assignment, values, pid):
+    # Stands in for worker.serve: leases until the spool is empty.
+    assert values["prefetch"] == 0 and values["exit_when_idle"] and values["pool"] == 0
+    queue = SpoolQueue(values["queue_path"], max_attempts=2)
+    while True:
+        jobs = queue.receive()
+        if not jobs:
+            return
+        job = jobs[0]
+        if job.payload.get("fail"):
+            queue.nack(job, "boom")
+        elif not job.payload.get("hold"):
+            queue.ack(job, {"worker_pid": pid, "images": [f"{job.id}.png"], "seeds": [1]})
+
+
+def test_pool_ingests_once_and_writes_a_manifest(tmp_path, monkeypatch, capsys):
+    jobs = tmp_path / "jobs.jsonl"
+    lines = [{"id": "a"}, {"id": "b", "fail": True}, {"id": "c"}, {"id": "d", "hold": True}]
+    jobs.write_text("".join(json.dumps(line) + "\n" for line in lines))
+    monkeypatch.setattr(pool, "available_cores", lambda: [0, 1, 2, 3])
+    context = argparse.Namespace(Process=InlineProcess)
+    monkeypatch.setattr(pool, "get_context", lambda method: context)
+    monkeypatch.setattr(pool, "pool_worker", drain)
+    args = argparse.Namespace(
+        queue_path=str(jobs),
+        visibility_timeout=60.0,
+        max_attempts=2,
+        pool=2,
+        pool_devices="cpu",
+        device="auto",
+        pool_manifest=None,
+    )
+
+    manifest = pool.run_pool(args)
+
+    spool = tmp_path / "jobs.spool"
+    assert json.loads((spool / "manifest.json").read_text()) == manifest
+    statuses = {job["id"]: job["status"] for job in manifest["jobs"]}
+    assert statuses == {"a": "done", "b": "failed", "c": "done", "d": "unfinished"}
+    done = [job for job in manifest["jobs"] if job["status"] == "done"]
+    assert all(job["worker"] == 0 and job["images"] for job in done)
+    assert manifest["jobs"][1]["error"] == "boom"
+    summary = manifest["summary"]
+    assert (summary["done"], summary["failed"], summary["unfinished"], summary["images"]) == (
+        2,
+        1,
+        1,
+        2,
+    )
+    workers = [(item["worker"], item["jobs"], item["cpu_cores"]) for item in manifest["workers"]]
+    assert workers == [(0, 2, [0, 1]), (1, 0, [2, 3])]
+    assert '"event": "pool_done"' in capsys.readouterr().out
@@ -0,0 +1,78 @@
+from types import SimpleNamespace
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("diffusers")
+pytest.importorskip("safetensors")
+
+from prompt_cache import PromptEmbeddingCache  # noqa: E402
+
+
+def text_encoder(seed):
+    weight = torch.arange(16, dtype=torch.float32).reshape(8, 2) + seed
+    layer = SimpleNamespace(self_attn=SimpleNamespace(q_proj=SimpleNamespace(weight=weight)))
+    return SimpleNamespace(
+        config=SimpleNamespace(_name_or_path=f"encoder-{seed}"),
+        dtype=torch.float32,
+        text_model=SimpleNamespace(encoder=SimpleNamespace(layers=[layer])),
+    )
+
+
+class EncodingPipeline:
+    """Stands in for the SDXL pipeline's prompt encoding only."""
+
+    def __init__(self, seed=0):
+        self.text_encoder = text_encoder(seed)
+        self.text_encoder_2 = text_encoder(seed + 1)
+        self.config = SimpleNamespace(force_zeros_for_empty_prompt=True)
+        self._execution_device = torch.device("cpu")
+        self.calls = []
+
+    def encode_prompt(self, prompt, device, num_images_per_prompt, do_classifier_free_guidance, clip_skip):
+        self.calls.append((prompt, clip_skip))
+        value = float(len(prompt) + (clip_skip or 0))
+        return torch.full((1, 77, 4), value), None, torch.full((1, 8), value), None
+
+
+def test_repeated_prompts_are_encoded_once():
+    cache = PromptEmbeddingCache(max_entries=4)
+    pipe = EncodingPipeline()
+    first = cache.encode(pipe, "a chest")
+    second = cache.encode(pipe, "a chest")
+    assert torch.equal(first[0], second[0])
+    assert pipe.calls == [("a chest", None)]
+    cache.encode(pipe, "a chest", clip_skip=2)
+    assert len(pipe.calls) == 2
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 2
+
+
+def test_lora_state_and_encoders_separate_entries():
+    cache = PromptEmbeddingCache()
+    pipe = EncodingPipeline()
+    cache.encode(pipe, "a chest")
+    pipe.asset_lora_state = (("pixel", 0.8),)
+    cache.encode(pipe, "a chest")
+    cache.encode(EncodingPipeline(seed=5), "a chest")
+    assert cache.stats()["misses"] == 3
+
+
+def test_batch_uses_zero_embeddings_for_empty_negatives():
+    cache = PromptEmbeddingCache()
+    pipe = EncodingPipeline()
+    embeds = cache.encode_batch(pipe, ["a chest", "a sword"], ["", "blurry"])
+    assert embeds["prompt_embeds"].shape == (2, 77, 4)
+    assert not embeds["negative_prompt_embeds"][0].any()
+    assert embeds["negative_prompt_embeds"][1].any()
+    assert [text for text, _ in pipe.calls] == ["a chest", "a sword", "blurry"]
+
+
+def test_lru_and_disk_tier(tmp_path):
+    cache = PromptEmbeddingCache(max_entries=1, cache_dir=tmp_path)
+    pipe = EncodingPipeline()
+    cache.encode(pipe, "a chest")
+    cache.encode(pipe, "a sword")
+    restored = PromptEmbeddingCache(max_entries=1, cache_dir=tmp_path)
+    restored.encode(pipe, "a chest")
+    assert len(pipe.calls) == 2
+    assert restored.stats()["disk_hits"] == 1
@@ -0,0 +1,86 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("accelerate")
+
+from residency import ResidencyManager  # noqa: E402
+
+# A Linear(10, 10) holds 110 float32 values: 440 bytes.
+SIZE = 440
+
+
+class MovableLinear(torch.nn.Linear):
+    """Records device moves instead of making them, so "cuda" can be budgeted without a GPU."""
+
+    def __init__(self):
+        super().__init__(10, 10)
+        self.moves = []
+
+    def to(self, device):
+        self.moves.append(str(device))
+        return self
+
+
+def test_components_page_between_device_and_host():
+    manager = ResidencyManager("cuda", budget_bytes=SIZE)
+    first, second = MovableLinear(), MovableLinear()
+    a = manager.register("a", first)
+    b = manager.register("b", second)
+    assert (manager.device_bytes(), manager.host_bytes()) == (0, 2 * SIZE)
+
+    manager.acquire(a)
+    manager.acquire(a)
+    manager.acquire(b)
+    manager.acquire(a)
+    components = manager.stats()["components"]
+    assert components["a"]["location"] == "device" and components["b"]["location"] == "host"
+    assert (components["a"]["loads"], components["a"]["evictions"]) == (2, 1)
+    assert (components["b"]["loads"], components["b"]["evictions"]) == (1, 1)
+    stats = manager.stats()
+    assert (stats["loads"], stats["evictions"]) == (3, 2)
+    assert (stats["device_bytes"], stats["host_bytes"]) == (SIZE, SIZE)
+    assert first.moves == ["cuda", "cpu", "cuda"] and second.moves == ["cuda", "cpu"]
+
+
+def test_spilled_weights_are_written_once_and_reloaded(tmp_path):
+    pytest.importorskip("safetensors")
+    manager = ResidencyManager("cpu", budget_bytes=SIZE, offload_dir=tmp_path)
+    first, second = torch.nn.Linear(10, 10), torch.nn.Linear(10, 10)
+    weight = first.weight.detach().clone()
+    a = manager.register("a", first)
+    manager.acquire(a)
+    b = manager.register("b", second)
+    # On CPU there is no host tier: making room for "b" spills "a" to disk.
+    assert manager.components[a].location == "disk"
+    assert first.weight.device.type == "meta"
+
+    manager.acquire(a)
+    manager.acquire(b)
+    manager.acquire(a)
+    assert torch.equal(first.weight, weight)
+    components = manager.stats()["components"]
+    assert (components["a"]["spills"], components["a"]["evictions"]) == (1, 2)
+    assert components["a"]["loads"] == 2
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["a.safetensors", "b.safetensors"]
+
+    manager.unregister(a)
+    assert not (tmp_path / "a.safetensors").exists()
+    assert list(manager.components) == ["b"]
+
+
+def test_names_are_unique_and_modules_registered_once():
+    manager = ResidencyManager("cuda", budget_bytes=4 * SIZE)
+    module = torch.nn.Linear(10, 10)
+    assert manager.register("unet", module) == "unet"
+    assert manager.register("refiner", module) == "unet"
+    assert manager.register("unet", torch.nn.Linear(10, 10)) == "unet#2"
+
+
+def test_over_budget_without_a_spill_tier_warns_once(capsys):
+    manager = ResidencyManager("cpu", budget_bytes=SIZE)
+    manager.register("a", torch.nn.Linear(10, 10))
+    manager.register("b", torch.nn.Linear(10, 10))
+    manager.register("c", torch.nn.Linear(10, 10))
+    assert manager.stats()["evictions"] == 0
+    assert manager.device_bytes() == 3 * SIZE
+    assert capsys.readouterr().out.count("over the") == 1
@@ -0,0 +1,51 @@
+import os
+import time
+
+from result_cache import META_NAME, ResultCache
+
+
+def write_image(path, size=16):
+    path.write_bytes(os.urandom(size))
+    return path
+
+
+def test_key_is_order_independent(tmp_path):
+    cache = ResultCache(tmp_path / "cache")
+    assert cache.key({"a": 1, "b": [1, 2]}) == cache.key({"b": [1, 2], "a": 1})
+    assert cache.key({"a": 1}) != cache.key({"a": 2})
+
+
+def test_store_and_lookup(tmp_path):
+    cache = ResultCache(tmp_path / "cache")
+    image = write_image(tmp_path / "out.png")
+    key = cache.key({"prompt": "chest", "seed": 1})
+    assert cache.lookup(key) is None
+
+    entry = cache.store(key, [image], [1], {"prompt": "chest"})
+    image.unlink()
+    hit = cache.lookup(key)
+    assert hit["seeds"] == [1]
+    assert hit["images"] == [entry / "000.png"] and hit["images"][0].is_file()
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 1
+
+
+def test_incomplete_entry_is_dropped(tmp_path):
+    cache = ResultCache(tmp_path / "cache")
+    key = "k" * 32
+    entry = cache.store(key, [write_image(tmp_path / "a.png")], [7])
+    (entry / "000.png").unlink()
+    assert cache.lookup(key) is None
+    assert not entry.exists()
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    cache = ResultCache(tmp_path / "cache", max_bytes=250)
+    keys = [f"{index:032d}" for index in range(3)]
+    for index, key in enumerate(keys):
+        cache.store(key, [write_image(tmp_path / f"{index}.png", 100)], [index])
+        old = time.time() - 100 + index
+        os.utime(tmp_path / "cache" / key / META_NAME, (old, old))
+    assert cache.lookup(keys[0]) is None
+    assert cache.lookup(keys[1]) is not None
+    assert cache.stats()["entries"] == 2
+
@@ -0,0 +1,30 @@
+import pytest
+
+from schedulers import PRESETS, SAMPLERS, SCHEDULES, check_scheduler, get_preset
+
+
+def test_presets_use_known_names():
+    for preset in PRESETS.values():
+        check_scheduler(preset.sampler_name, preset.scheduler)
+
+
+def test_unknown_names_are_rejected():
+    with pytest.raises(RuntimeError, match="Unknown sampler_name"):
+        check_scheduler("dpmpp_3m", "normal")
+    with pytest.raises(RuntimeError, match="Unknown scheduler"):
+        check_scheduler("euler", "linear")
+    with pytest.raises(RuntimeError, match="Unknown scheduler preset"):
+        get_preset("ultra")
+
+
+@pytest.mark.parametrize("sampler_name", ["lcm", "tcd", "ddim", "ddpm", "euler_ancestral"])
+def test_sigma_schedules_rejected_without_diffusers(sampler_name):
+    with pytest.raises(RuntimeError, match="is not supported by sampler"):
+        check_scheduler(sampler_name, "karras")
+    check_scheduler(sampler_name, "sgm_uniform")
+
+
+def test_every_sampler_accepts_the_default_schedule():
+    for sampler_name in SAMPLERS:
+        check_scheduler(sampler_name, "normal")
+    assert "normal" in SCHEDULES
@@ -0,0 +1,255 @@
+import copy
+
+import pytest
+
+from workflow import NodeRef, WorkflowExecutor, compile_workflow
+
+
+def api_graph():
+    return {
+        "4": {"class_type": "CheckpointLoaderSimple", "inputs": {"ckpt_name": "base.safetensors"}},
+        "5": {"class_type": "EmptyLatentImage", "inputs": {"width": 1024, "height": 1024, "batch_size": 1}},
+        "6": {"class_type": "CLIPTextEncode", "inputs": {"text": "a chest", "clip": ["4", 1]}},
+        "7": {"class_type": "CLIPTextEncode", "inputs": {"text": "blurry", "clip": ["4", 1]}},
+        "3": {
+            "class_type": "KSampler",
+            "inputs": {
+                "seed": 1,
+                "control_after_generate": "fixed",
+                "steps": 4,
+                "cfg": 1.0,
+                "sampler_name": "euler",
+                "scheduler": "sgm_uniform",
+                "denoise": 1.0,
+                "model": ["4", 0],
+                "positive": ["6", 0],
+                "negative": ["7", 0],
+                "latent_image": ["5", 0],
+            },
+        },
+        "8": {"class_type": "VAEDecode", "inputs": {"samples": ["3", 0], "vae": ["4", 2]}},
+        "9": {"class_type": "SaveImage", "inputs": {"filename_prefix": "asset", "images": ["8", 0]}},
+        "12": {"class_type": "Note", "inputs": {"text": "ignored"}},
+    }
+
+
+def ui_node(node_id, node_type, widgets=None, inputs=(), outputs=(), mode=0):
+    return {
+        "id": node_id,
+        "type": node_type,
+        "mode": mode,
+        "widgets_values": widgets if widgets is not None else [],
+        "inputs": [{"name": name, "type": kind, "link": link} for name, kind, link in inputs],
+        "outputs": [{"name": kind, "type": kind} for kind in outputs],
+    }
+
+
+def ui_graph():
+    nodes = [
+        ui_node(4, "CheckpointLoaderSimple", ["base.safetensors"], outputs=("MODEL", "CLIP", "VAE")),
+        ui_node(10, "LoraLoader", ["pixel.safetensors", 0.8, 0.8],
+                [("model", "MODEL", 1), ("clip", "CLIP", 2)], ("MODEL", "CLIP"), mode=4),
+        ui_node(11, "Reroute", inputs=[("", "*", 3)], outputs=("*",)),
+        ui_node(6, "CLIPTextEncode", ["a chest"], [("clip", "CLIP", 4)], ("CONDITIONING",)),
+        ui_node(7, "CLIPTextEncode", ["blurry"], [("clip", "CLIP", 5)], ("CONDITIONING",)),
+        ui_node(5, "EmptyLatentImage", [1024, 1024, 1], outputs=("LATENT",)),
+        ui_node(13, "PrimitiveNode", [42], outputs=("INT",)),
+        ui_node(3, "KSampler", [1, "fixed", 4, 1.0, "euler", "sgm_uniform", 1.0],
+                [("model", "MODEL", 6), ("positive", "CONDITIONING", 7),
+                 ("negative", "CONDITIONING", 8), ("latent_image", "LATENT", 9),
+                 ("seed", "INT", 13)], ("LATENT",)),
+        ui_node(8, "VAEDecode", inputs=[("samples", "LATENT", 10), ("vae", "VAE", 11)], outputs=("IMAGE",)),
+        ui_node(9, "SaveImage", ["asset"], [("images", "IMAGE", 12)]),
+        ui_node(14, "SaveImage", ["muted"], [("images", "IMAGE", 14)], mode=2),
+    ]
+    links = [
+        [1, 4, 0, 10, 0, "MODEL"],
+        [2, 4, 1, 10, 1, "CLIP"],
+        [3, 10, 1, 11, 0, "CLIP"],
+        [4, 11, 0, 6, 0, "CLIP"],
+        [5, 11, 0, 7, 0, "CLIP"],
+        [6, 10, 0, 3, 0, "MODEL"],
+        [7, 6, 0, 3, 1, "CONDITIONING"],
+        [8, 7, 0, 3, 2, "CONDITIONING"],
+        [9, 5, 0, 3, 3, "LATENT"],
+        [10, 3, 0, 8, 0, "LATENT"],
+        [11, 4, 2, 8, 1, "VAE"],
+        [12, 8, 0, 9, 0, "IMAGE"],
+        [13, 13, 0, 3, 4, "INT"],
+        [14, 8, 0, 14, 0, "IMAGE"],
+    ]
+    return {"nodes": nodes, "links": links}
+
+
+def test_api_graph_is_ordered_and_pruned():
+    plan = compile_workflow(api_graph())
+    order = [node.id for node in plan.nodes]
+    assert "12" not in order
+    assert order.index("4") < order.index("6") < order.index("3") < order.index("8") < order.index("9")
+    sampler = next(node for node in plan.nodes if node.id == "3")
+    assert sampler.inputs["model"] == NodeRef("4", 0)
+    assert "control_after_generate" not in sampler.inputs
+    assert [node.id for node in plan.outputs()] == ["9"]
+
+
+def test_api_graph_wrapped_in_prompt_key():
+    assert compile_workflow({"prompt": api_graph()}).signatures == compile_workflow(api_graph()).signatures
+
+
+def test_signatures_change_only_downstream_of_an_edit():
+    before = compile_workflow(api_graph()).signatures
+    graph = api_graph()
+    graph["3"]["inputs"]["seed"] = 2
+    after = compile_workflow(graph).signatures
+    for node_id in ("4", "5", "6", "7"):
+        assert before[node_id] == after[node_id]
+    for node_id in ("3", "8", "9"):
+        assert before[node_id] != after[node_id]
+
+
+def test_ui_graph_follows_reroutes_bypass_and_primitives():
+    plan = compile_workflow(ui_graph())
+    by_id = {node.id: node for node in plan.nodes}
+    assert set(by_id) == {"3", "4", "5", "6", "7", "8", "9"}
+    # The bypassed LoRA loader passes the checkpoint's model and clip straight through.
+    assert by_id["3"].inputs["model"] == NodeRef("4", 0)
+    assert by_id["6"].inputs["clip"] == NodeRef("4", 1)
+    assert by_id["3"].inputs["seed"] == 42
+    assert by_id["3"].inputs["sampler_name"] == "euler"
+    assert by_id["5"].inputs == {"width": 1024, "height": 1024, "batch_size": 1}
+
+
+def test_ui_graph_with_active_lora_keeps_the_loader():
+    graph = ui_graph()
+    graph["nodes"][1]["mode"] = 0
+    by_id = {node.id: node for node in compile_workflow(graph).nodes}
+    assert by_id["3"].inputs["model"] == NodeRef("10", 0)
+    assert by_id["10"].inputs["strength_model"] == 0.8
+
+
+def test_cycles_are_rejected():
+    graph = api_graph()
+    graph["6"]["inputs"]["clip"] = ["3", 0]
+    with pytest.raises(RuntimeError, match="cycle"):
+        compile_workflow(graph)
+
+
+def test_reroute_loops_are_rejected():
+    graph = ui_graph()
+    graph["nodes"].append(ui_node(20, "Reroute", inputs=[("", "*", 21)], outputs=("*",)))
+    graph["links"].append([21, 20, 0, 20, 0, "*"])
+    graph["links"][3] = [4, 20, 0, 6, 0, "CLIP"]
+    with pytest.raises(RuntimeError, match="reroute loop"):
+        compile_workflow(graph)
+
+
+@pytest.mark.parametrize(
+    "edit, message",
+    [
+        (lambda graph: graph["8"].update(class_type="UpscaleModelLoader"), "unsupported type"),
+        (lambda graph: graph["8"]["inputs"].update(samples=["99", 0]), "missing or muted node 99"),
+        (lambda graph: graph.pop("9"), "no SaveImage or PreviewImage"),
+    ],
+)
+def test_invalid_graphs_are_rejected(edit, message):
+    graph = copy.deepcopy(api_graph())
+    edit(graph)
+    with pytest.raises(RuntimeError, match=message):
+        compile_workflow(graph)
+
+
+def test_unknown_format_is_rejected():
+    with pytest.raises(RuntimeError, match="API or UI format"):
+        compile_workflow({"version": 0.4})
+
+
+def advanced_graph(base=None, refiner=None):
+    graph = api_graph()
+    sampler = graph.pop("3")["inputs"]
+    common = {key: sampler[key] for key in ("model", "positive", "negative", "cfg")}
+    common.update(sampler_name="euler", scheduler="normal", steps=10, noise_seed=1)
+    graph["30"] = {
+        "class_type": "KSamplerAdvanced",
+        "inputs": {
+            **common,
+            "latent_image": ["5", 0],
+            "add_noise": "enable",
+            "start_at_step": 0,
+            "end_at_step": 8,
+            "return_with_leftover_noise": "enable",
+            **(base or {}),
+        },
+    }
+    graph["31"] = {
+        "class_type": "KSamplerAdvanced",
+        "inputs": {
+            **common,
+            "latent_image": ["30", 0],
+            "add_noise": "disable",
+            "start_at_step": 8,
+            "end_at_step": 10000,
+            "return_with_leftover_noise": "disable",
+            **(refiner or {}),
+        },
+    }
+    graph["8"]["inputs"]["samples"] = ["31", 0]
+    return graph
+
+
+def test_base_to_refiner_advanced_samplers_are_accepted():
+    plan = compile_workflow(advanced_graph())
+    assert [node.id for node in plan.nodes if node.class_type == "KSamplerAdvanced"] == ["30", "31"]
+
+
+@pytest.mark.parametrize(
+    "base, refiner, message",
+    [
+        ({"add_noise": "disable"}, None, "add_noise must be 'enable'"),
+        (None, {"add_noise": "enable"}, "add_noise must be 'disable'"),
+        ({"return_with_leftover_noise": "disable"}, None, "return_with_leftover_noise"),
+    ],
+)
+def test_unsupported_advanced_sampler_inputs_are_rejected(base, refiner, message):
+    with pytest.raises(RuntimeError, match=message):
+        compile_workflow(advanced_graph(base, refiner))
+
+
+def test_separate_lora_clip_strength_is_rejected():
+    graph = api_graph()
+    graph["10"] = {
+        "class_type": "LoraLoader",
+        "inputs": {
+            "lora_name": "pixel.safetensors",
+            "strength_model": 0.8,
+            "strength_clip": 0.8,
+            "model": ["4", 0],
+            "clip": ["4", 1],
+        },
+    }
+    graph["3"]["inputs"]["model"] = ["10", 0]
+    compile_workflow(graph)
+    graph["10"]["inputs"]["strength_clip"] = 0.5
+    with pytest.raises(RuntimeError, match="Workflow node 10 .*strength_clip"):
+        compile_workflow(graph)
+
+
+class Block:
+    """Stands in for a tensor of `size` bytes."""
+
+    def __init__(self, size):
+        self.size = size
+
+    def numel(self):
+        return self.size
+
+    def element_size(self):
+        return 1
+
+
+def test_node_outputs_are_bounded_by_bytes():
+    executor = WorkflowExecutor(None, "cpu", None, max_entries=10, max_bytes=300)
+    executor._remember("a", ({"samples": Block(100)},))
+    executor._remember("b", ({"prompt_embeds": Block(100), "pooled_prompt_embeds": Block(50)},))
+    executor._remember("c", ([Block(100)],))
+    assert list(executor._entries) == ["b", "c"]
+    assert executor.stats()["bytes"] == 250
@@ -0,0 +1,277 @@
+import contextlib
+import functools
+import json
+import os
+import resource
+import sys
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Callable, Iterator
+
+from previews import GenerationCancelled
+
+
+STAGE_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+_local = threading.local()
+
+
+def current_rss_bytes() -> int | None:
+    try:
+        with open("/proc/self/statm", "r", encoding="utf-8") as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def max_rss_bytes() -> int:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in bytes on macOS and in KiB on Linux.
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def reset_accelerator_peak() -> None:
+    # Only consult torch once something else has imported it; tracing the config
+    # and path-resolution stages must not pull it in.
+    torch = sys.modules.get("torch")
+    if torch is not None and torch.cuda.is_available():
+        torch.cuda.reset_peak_memory_stats()
+
+
+def accelerator_peak_bytes() -> int | None:
+    torch = sys.modules.get("torch")
+    if torch is None:
+        return None
+    if torch.cuda.is_available():
+        return int(torch.cuda.max_memory_allocated())
+    if torch.backends.mps.is_available():
+        # MPS has no peak counter; the driver allocation at stage end is the closest proxy.
+        return int(torch.mps.driver_allocated_memory())
+    return None
+
+
+class Trace:
+    """
+    Per-job record of where the time and memory went.
+
+    Stages nest: a stage's `wall_s` excludes the time spent in stages opened inside
+    it, so the denoising loop is not double-counted with the text encoding and VAE
+    decode that happen inside the same pipeline call. `max_rss_bytes` is the process
+    high-water mark when the stage ended; `accelerator_peak_bytes` is the CUDA peak
+    allocation during the stage (allocated memory at stage end on MPS).
+    """
+
+    def __init__(self, job_id: str | None = None):
+        self.job_id = job_id or uuid.uuid4().hex
+        self.started = time.time()
+        self.outcome = "running"
+        self.stages: dict[str, dict[str, float | int | None]] = {}
+        self.annotations: dict[str, object] = {}
+        self._stack: list[list[float]] = []
+        self._start = time.perf_counter()
+        self._end: float | None = None
+
+    @contextlib.contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        if self._stack:
+            # Keep the parent's peak so far before the counter is reset for this stage.
+            self._stack[-1][2] = max(self._stack[-1][2], accelerator_peak_bytes() or 0)
+        frame = [time.perf_counter(), 0.0, 0.0]  # start, child time, child accelerator peak
+        self._stack.append(frame)
+        reset_accelerator_peak()
+        try:
+            yield
+        finally:
+            self._stack.pop()
+            elapsed = time.perf_counter() - frame[0]
+            peak = accelerator_peak_bytes()
+            if peak is not None:
+                peak = max(peak, int(frame[2]))
+            if self._stack:
+                self._stack[-1][1] += elapsed
+                self._stack[-1][2] = max(self._stack[-1][2], peak or 0)
+
+            entry = self.stages.setdefault(
+                name,
+                {"count": 0, "wall_s": 0.0, "max_rss_bytes": None, "accelerator_peak_bytes": None},
+            )
+            entry["count"] += 1
+            entry["wall_s"] += elapsed - frame[1]
+            entry["max_rss_bytes"] = max_rss_bytes()
+            if peak is not None:
+                entry["accelerator_peak_bytes"] = max(entry["accelerator_peak_bytes"] or 0, peak)
+
+    def annotate(self, key: str, value: object) -> None:
+        """Attaches extra job-level data (e.g. the memory plan) to the record."""
+        self.annotations[key] = value
+
+    def finish(self, outcome: str) -> None:
+        self.outcome = outcome
+        self._end = time.perf_counter()
+
+    def record(self) -> dict[str, object]:
+        end = self._end if self._end is not None else time.perf_counter()
+        return {
+            "event": "trace",
+            "job_id": self.job_id,
+            "outcome": self.outcome,
+            "started_at": round(self.started, 3),
+            "total_s": round(end - self._start, 4),
+            "rss_bytes": current_rss_bytes(),
+            **self.annotations,
+            "stages": {
+                name: {**entry, "wall_s": round(float(entry["wall_s"]), 4)}
+                for name, entry in self.stages.items()
+            },
+        }
+
+
+def active_trace() -> Trace | None:
+    return getattr(_local, "trace", None)
+
+
+def stage(name: str) -> contextlib.AbstractContextManager[None]:
+    trace = active_trace()
+    return trace.stage(name) if trace is not None else contextlib.nullcontext()
+
+
+@contextlib.contextmanager
+def trace_job(job_id: str | None = None, trace_file: str | None = None) -> Iterator[Trace]:
+    """
+    Makes a Trace active on this thread for the duration of one job.
+
+    On exit the record is added to METRICS and, when `trace_file` is set, appended
+    to it as one JSON line.
+    """
+    trace = Trace(job_id)
+    previous = active_trace()
+    _local.trace = trace
+    try:
+        yield trace
+        trace.finish("done")
+    except BaseException as exc:
+        trace.finish("cancelled" if isinstance(exc, GenerationCancelled) else "failed")
+        raise
+    finally:
+        _local.trace = previous
+        record = trace.record()
+        METRICS.observe(record)
+        if trace_file:
+            Path(trace_file).parent.mkdir(parents=True, exist_ok=True)
+            with open(trace_file, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record) + "\n")
+
+
+def traced(name: str, func: Callable) -> Callable:
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with stage(name):
+            return func(*args, **kwargs)
+
+    wrapper.asset_traced = True
+    return wrapper
+
+
+def instrument_pipeline(pipe: object) -> None:
+    # Text encoding and VAE decode run inside the pipeline call; wrapping them on the
+    # instance lets the trace split that call into encode / denoise / decode.
+    encode_prompt = getattr(pipe, "encode_prompt", None)
+    if encode_prompt is not None and not getattr(encode_prompt, "asset_traced", False):
+        pipe.encode_prompt = traced("text_encode", encode_prompt)
+    vae = getattr(pipe, "vae", None)
+    if vae is not None and not getattr(vae.decode, "asset_traced", False):
+        vae.decode = traced("vae_decode", vae.decode)
+
+
+class MetricsRegistry:
+    """
+    Fleet-level aggregates of job traces in the Prometheus text exposition format.
+
+    Per-stage wall time is a histogram (so p95 can be computed with
+    histogram_quantile), peak memory per stage is a gauge of the largest value seen,
+    and jobs are counted by outcome.
+    """
+
+    def __init__(self, buckets: tuple[float, ...] = STAGE_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._jobs: dict[str, int] = {}
+        self._stage_counts: dict[str, list[int]] = {}
+        self._stage_sums: dict[str, float] = {}
+        self._stage_totals: dict[str, int] = {}
+        self._stage_rss: dict[str, int] = {}
+        self._stage_accelerator: dict[str, int] = {}
+
+    def _observe_stage(self, stage_name: str, seconds: float) -> None:
+        counts = self._stage_counts.setdefault(stage_name, [0] * len(self.buckets))
+        for index, bound in enumerate(self.buckets):
+            if seconds <= bound:
+                counts[index] += 1
+        self._stage_sums[stage_name] = self._stage_sums.get(stage_name, 0.0) + seconds
+        self._stage_totals[stage_name] = self._stage_totals.get(stage_name, 0) + 1
+
+    def observe(self, record: dict[str, object]) -> None:
+        with self._lock:
+            outcome = str(record.get("outcome", "done"))
+            self._jobs[outcome] = self._jobs.get(outcome, 0) + 1
+            self._observe_stage("job", float(record.get("total_s", 0.0)))
+            for stage_name, entry in dict(record.get("stages", {})).items():
+                self._observe_stage(stage_name, float(entry["wall_s"]))
+                if entry.get("max_rss_bytes"):
+                    self._stage_rss[stage_name] = max(
+                        self._stage_rss.get(stage_name, 0), int(entry["max_rss_bytes"])
+                    )
+                if entry.get("accelerator_peak_bytes"):
+                    self._stage_accelerator[stage_name] = max(
+                        self._stage_accelerator.get(stage_name, 0),
+                        int(entry["accelerator_peak_bytes"]),
+                    )
+
+    def render(self) -> str:
+        with self._lock:
+            lines = [
+                "# HELP tti_jobs_total Text-to-image jobs by outcome.",
+                "# TYPE tti_jobs_total counter",
+            ]
+            for outcome, count in sorted(self._jobs.items()):
+                lines.append(f'tti_jobs_total{{outcome="{outcome}"}} {count}')
+
+            lines += [
+                '# HELP tti_stage_seconds Wall time per pipeline stage; stage="job" is the whole job.',
+                "# TYPE tti_stage_seconds histogram",
+            ]
+            for stage_name in sorted(self._stage_counts):
+                counts = self._stage_counts[stage_name]
+                for bound, count in zip(self.buckets, counts):
+                    lines.append(f'tti_stage_seconds_bucket{{stage="{stage_name}",le="{bound}"}} {count}')
+                total = self._stage_totals[stage_name]
+                lines.append(f'tti_stage_seconds_bucket{{stage="{stage_name}",le="+Inf"}} {total}')
+                lines.append(f'tti_stage_seconds_sum{{stage="{stage_name}"}} {self._stage_sums[stage_name]:.6f}')
+                lines.append(f'tti_stage_seconds_count{{stage="{stage_name}"}} {total}')
+
+            for metric, values, help_text in (
+                ("tti_stage_max_rss_bytes", self._stage_rss, "Process RSS high-water mark at stage end."),
+                (
+                    "tti_stage_accelerator_peak_bytes",
+                    self._stage_accelerator,
+                    "Largest accelerator memory peak seen during the stage.",
+                ),
+            ):
+                lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} gauge"]
+                for stage_name, value in sorted(values.items()):
+                    lines.append(f'{metric}{{stage="{stage_name}"}} {value}')
+            return "\n".join(lines) + "\n"
+
+    def write(self, path: str | Path) -> None:
+        # Atomic replace so a node_exporter textfile collector never reads a partial file.
+        target = Path(path)
+        target.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = target.with_name(f".{target.name}.{uuid.uuid4().hex}.tmp")
+        tmp_path.write_text(self.render(), encoding="utf-8")
+        os.replace(tmp_path, target)
+
+
+METRICS = MetricsRegistry()
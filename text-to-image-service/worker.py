@@ -0,0 +1,366 @@
+import argparse
+import json
+import os
+import time
+from collections import deque
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+import torch
+
+from job_queue import Job, LeaseKeeper, MemoryQueue, SpoolQueue, open_queue
+from main import (
+    apply_comfy_nodes,
+    apply_config,
+    apply_sampling_defaults,
+    check_lora_compatibility,
+    check_memory_budget,
+    check_sampling,
+    create_cpu_options,
+    create_model_cache,
+    create_output_writer,
+    create_prompt_cache,
+    create_prompt_enhancer,
+    create_residency_manager,
+    create_result_cache,
+    create_step_monitor,
+    enhance_prompts,
+    generate,
+    lora_specs,
+    output_format,
+    parse_size,
+    preflight,
+    print_configuration,
+    resolve_base_model,
+    resolve_prompts,
+    result_request,
+    select_device,
+)
+import tracing
+from output_writer import OutputWriter, WriteBatch
+from pipeline_cache import PipelineCache
+from previews import CancellationToken, GenerationCancelled
+from prompt_cache import PromptEmbeddingCache
+from result_cache import ResultCache
+from workflow import WorkflowExecutor, check_models, compile_workflow
+
+if TYPE_CHECKING:
+    from llm_prompt_enhancer import LLMPromptEnhancer
+
+
+def job_args(base_args: argparse.Namespace, payload: dict[str, object]) -> argparse.Namespace:
+    args = argparse.Namespace(**vars(base_args))
+    args.config = None
+    # Per-job prompts and seeds replace the lists inherited from the worker config.
+    if "positive_prompt" in payload or "prompt" in payload:
+        args.positive_prompts = None
+    if "negative_prompt" in payload or "prompt" in payload:
+        args.negative_prompts = None
+    if "seed" in payload:
+        args.seeds = None
+    if payload.get("scheduler_preset"):
+        # A per-job preset replaces the worker's sampling settings unless the job sets them.
+        for attr in ("sampler_name", "scheduler", "steps", "guidance_scale"):
+            setattr(args, attr, None)
+    apply_config(args, payload)
+    apply_comfy_nodes(args, payload)
+    apply_sampling_defaults(args)
+    return args
+
+
+def process_job(
+    cache: PipelineCache,
+    prompt_cache: PromptEmbeddingCache | None,
+    device: str,
+    dtype: torch.dtype,
+    base_args: argparse.Namespace,
+    job: Job,
+    writer: OutputWriter,
+    token: CancellationToken | None = None,
+    result_cache: ResultCache | None = None,
+    executor: WorkflowExecutor | None = None,
+    enhancer: "LLMPromptEnhancer | None" = None,
+) -> tuple[dict[str, object], WriteBatch]:
+    """
+    Generates one job and hands its images to `writer`.
+
+    Returns as soon as the images are queued for encoding; the result is complete
+    (and the job may be acknowledged) once the returned batch is done. A result
+    cache hit returns the stored images and an empty, already finished batch. Jobs
+    with a `workflow` graph go to `process_workflow_job`; their prompts come from
+    the graph and are not enhanced.
+    """
+    if "workflow" in job.payload:
+        return process_workflow_job(executor, base_args, job, writer, token)
+    timings: dict[str, float] = {}
+    start = time.perf_counter()
+
+    with tracing.trace_job(job.id, base_args.trace_file) as trace:
+        with tracing.stage("config"):
+            args = job_args(base_args, job.payload)
+            image_format = output_format(args)
+        with tracing.stage("resolve_model"):
+            base_model = resolve_base_model(args.base_model)
+        loras = lora_specs(args)
+        check_lora_compatibility(base_model, loras)
+        check_sampling(args)
+        positive, negative = resolve_prompts(args, interactive=False)
+        if enhancer is not None:
+            positive, negative = enhance_prompts(args, enhancer, positive, negative)
+
+        cache_key = None
+        cached = None
+        if result_cache is not None:
+            request = result_request(args, base_model, loras, positive, negative, device, dtype)
+            if request is not None:
+                cache_key = result_cache.key(request)
+                with tracing.stage("result_cache"):
+                    cached = result_cache.lookup(cache_key)
+
+        if cached is not None:
+            seeds = cached["seeds"]
+            batch = writer.submit([], Path(args.output_dir), args.filename_prefix, image_format)
+        else:
+            pipe, timings["pipeline_s"], timings["lora_s"] = cache.get(
+                base_model, dtype, device, loras
+            )
+            monitor = create_step_monitor(args, f"{args.filename_prefix}_{job.id}", token)
+
+            stage_start = time.perf_counter()
+            images, seeds = generate(pipe, args, device, positive, negative, prompt_cache, monitor)
+            timings["generate_s"] = time.perf_counter() - stage_start
+
+            batch = writer.submit(images, Path(args.output_dir), args.filename_prefix, image_format)
+
+    timings["total_s"] = time.perf_counter() - start
+    result = {
+        "seeds": seeds,
+        "timings": {name: round(value, 4) for name, value in timings.items()},
+        "stages": trace.record()["stages"],
+        "worker_pid": os.getpid(),
+    }
+    if cache_key is not None:
+        result["result_cache"] = {"key": cache_key, "hit": cached is not None}
+    if cached is not None:
+        result["images"] = [str(path) for path in cached["images"]]
+    if "memory" in trace.annotations:
+        result["memory"] = trace.annotations["memory"]
+    if cache.residency is not None:
+        result["residency"] = cache.residency.stats()
+    return result, batch
+
+
+def process_workflow_job(
+    executor: WorkflowExecutor | None,
+    base_args: argparse.Namespace,
+    job: Job,
+    writer: OutputWriter,
+    token: CancellationToken | None = None,
+) -> tuple[dict[str, object], WriteBatch]:
+    """
+    Runs a job whose payload carries a ComfyUI `workflow` graph.
+
+    Only nodes whose inputs changed since an earlier job re-execute. The save
+    nodes write their images before this returns, so the batch is empty.
+    """
+    timings: dict[str, float] = {}
+    start = time.perf_counter()
+
+    with tracing.trace_job(job.id, base_args.trace_file) as trace:
+        with tracing.stage("config"):
+            args = job_args(base_args, job.payload)
+            image_format = output_format(args)
+        workflow = job.payload["workflow"]
+        if executor is None or not isinstance(workflow, dict):
+            raise RuntimeError("Job 'workflow' must be a ComfyUI graph object")
+        with tracing.stage("resolve_model"):
+            plan = compile_workflow(workflow)
+            check_models(plan)
+        monitor = create_step_monitor(args, f"{args.filename_prefix}_{job.id}", token)
+
+        stage_start = time.perf_counter()
+        outcome = executor.execute(plan, writer, Path(args.output_dir), image_format, monitor)
+        timings["generate_s"] = time.perf_counter() - stage_start
+        batch = writer.submit([], Path(args.output_dir), args.filename_prefix, image_format)
+
+    timings["total_s"] = time.perf_counter() - start
+    result = {
+        "images": outcome["images"],
+        "seeds": [],
+        "timings": {name: round(value, 4) for name, value in timings.items()},
+        "stages": trace.record()["stages"],
+        "workflow": {"nodes": outcome["nodes"], "cache": executor.stats()},
+        "worker_pid": os.getpid(),
+    }
+    return result, batch
+
+
+def finish_job(
+    queue: MemoryQueue | SpoolQueue,
+    job: Job,
+    result: dict[str, object],
+    batch: WriteBatch,
+    prompt_cache: PromptEmbeddingCache | None,
+    result_cache: ResultCache | None = None,
+    leases: LeaseKeeper | None = None,
+) -> None:
+    # Runs on a writer thread once the job's images are on disk; only then is the
+    # job acknowledged, so a crash mid-write leads to a redelivery, not a lost image.
+    try:
+        paths = batch.result()
+    except Exception as exc:
+        if leases is not None:
+            leases.drop(job)
+        queue.nack(job, f"writing images failed: {exc}")
+        print(
+            json.dumps(
+                {
+                    "event": "job_failed",
+                    "job_id": job.id,
+                    "attempt": job.attempts,
+                    "error": f"writing images failed: {exc}",
+                }
+            )
+        )
+        return
+    cache_info = result.get("result_cache")
+    if result_cache is not None and cache_info and not cache_info["hit"]:
+        result_cache.store(str(cache_info["key"]), paths, list(result["seeds"]))
+    result = {"images": [str(path) for path in paths], **result}
+    result["timings"]["save_s"] = round(batch.seconds, 4)
+    if leases is not None:
+        leases.drop(job)
+    if not queue.ack(job, result):
+        print(json.dumps({"event": "lease_lost", "job_id": job.id}))
+        return
+    if prompt_cache is not None:
+        result["prompt_cache"] = prompt_cache.stats()
+    print(json.dumps({"event": "job_done", "job_id": job.id, **result}))
+
+
+def serve(args: argparse.Namespace, queue: MemoryQueue | SpoolQueue | None = None) -> None:
+    base_model, loras, lora_repo_or_dir, lora_weight_name = preflight(args)
+    if queue is None:
+        queue = open_queue(
+            args.queue,
+            args.queue_path,
+            visibility_timeout=args.visibility_timeout,
+            max_attempts=args.max_attempts,
+        )
+
+    device, dtype = select_device(args.device)
+    print_configuration(
+        args, device, dtype, base_model, loras, lora_repo_or_dir, lora_weight_name
+    )
+    residency = create_residency_manager(args, device)
+    cache = PipelineCache(
+        max_bytes=parse_size(args.pipeline_cache_memory),
+        device=device,
+        model_cache=create_model_cache(args),
+        cpu_options=create_cpu_options(args),
+        residency=residency,
+    )
+    pipe, load_s, lora_s = cache.get(base_model, dtype, device, lora_specs(args))
+    enhancer = create_prompt_enhancer(args, residency)
+    memory_plan = check_memory_budget(pipe, args, device)
+    prompt_cache = create_prompt_cache(args)
+    result_cache = create_result_cache(args)
+    executor = WorkflowExecutor(
+        cache,
+        device,
+        dtype,
+        prompt_cache,
+        max_entries=args.workflow_cache_size,
+        max_bytes=parse_size(args.workflow_cache_memory),
+    )
+    writer = create_output_writer(args)
+    print(
+        json.dumps(
+            {
+                "event": "worker_ready",
+                "device": device,
+                "load_s": round(load_s, 4),
+                "lora_s": round(lora_s, 4),
+                "memory_plan": memory_plan,
+            }
+        )
+    )
+
+    buffer: deque[Job] = deque()
+    # Renews the leases of buffered, generating and writing jobs until they finish.
+    leases = LeaseKeeper(queue)
+    try:
+        while True:
+            want = max(args.prefetch, 0) + 1 - len(buffer)
+            if want > 0:
+                for job in queue.receive(want):
+                    leases.hold(job)
+                    buffer.append(job)
+            if not buffer:
+                if args.exit_when_idle and len(queue) == 0:
+                    break
+                time.sleep(args.poll_interval)
+                continue
+
+            job = buffer.popleft()
+            if not queue.extend(job):
+                leases.drop(job)
+                print(json.dumps({"event": "lease_lost", "job_id": job.id}))
+                continue
+
+            queue_wait_s = max(time.time() - job.enqueued_at, 0.0)
+            token = CancellationToken(lambda job_id=job.id: queue.is_cancelled(job_id))
+            try:
+                result, batch = process_job(
+                    cache,
+                    prompt_cache,
+                    device,
+                    dtype,
+                    args,
+                    job,
+                    writer,
+                    token,
+                    result_cache,
+                    executor,
+                    enhancer,
+                )
+            except GenerationCancelled as exc:
+                leases.drop(job)
+                queue.discard(job, str(exc))
+                print(json.dumps({"event": "job_cancelled", "job_id": job.id, "reason": str(exc)}))
+                continue
+            except Exception as exc:
+                leases.drop(job)
+                queue.nack(job, str(exc))
+                print(
+                    json.dumps(
+                        {
+                            "event": "job_failed",
+                            "job_id": job.id,
+                            "attempt": job.attempts,
+                            "error": str(exc),
+                        }
+                    )
+                )
+                continue
+            finally:
+                if args.metrics_file:
+                    tracing.METRICS.write(args.metrics_file)
+
+            result["queue_wait_s"] = round(queue_wait_s, 4)
+            # Encoding continues on the writer threads while the next job denoises.
+            batch.add_done_callback(
+                lambda batch, job=job, result=result: finish_job(
+                    queue, job, result, batch, prompt_cache, result_cache, leases
+                )
+            )
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # Let queued writes finish so their jobs are acknowledged before exiting.
+        writer.close()
+        # Hand prefetched jobs back so other workers can pick them up immediately.
+        for job in buffer:
+            leases.drop(job)
+            queue.release(job)
+        leases.close()
@@ -0,0 +1,797 @@
+import argparse
+import hashlib
+import inspect
+import json
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+import tracing
+from main import check_lora_compatibility, resolve_base_model, resolve_lora_values, stage_pipeline
+
+if TYPE_CHECKING:
+    import torch
+    from diffusers import StableDiffusionXLPipeline
+
+    from output_writer import OutputFormat, OutputWriter
+    from pipeline_cache import PipelineCache
+    from previews import StepMonitor
+    from prompt_cache import PromptEmbeddingCache
+
+
+DEFAULT_MAX_ENTRIES = 64
+DEFAULT_MAX_BYTES = 2 << 30
+
+# Widget order of each supported node in ComfyUI's UI (`widgets_values`) format.
+# `control_after_generate` is a UI-only widget that follows every seed.
+NODE_WIDGETS: dict[str, tuple[str, ...]] = {
+    "CheckpointLoaderSimple": ("ckpt_name",),
+    "LoraLoader": ("lora_name", "strength_model", "strength_clip"),
+    "LoraLoaderModelOnly": ("lora_name", "strength_model"),
+    "CLIPSetLastLayer": ("stop_at_clip_layer",),
+    "CLIPTextEncode": ("text",),
+    "EmptyLatentImage": ("width", "height", "batch_size"),
+    "KSampler": (
+        "seed",
+        "control_after_generate",
+        "steps",
+        "cfg",
+        "sampler_name",
+        "scheduler",
+        "denoise",
+    ),
+    "KSamplerAdvanced": (
+        "add_noise",
+        "noise_seed",
+        "control_after_generate",
+        "steps",
+        "cfg",
+        "sampler_name",
+        "scheduler",
+        "start_at_step",
+        "end_at_step",
+        "return_with_leftover_noise",
+    ),
+    "VAEDecode": (),
+    "SaveImage": ("filename_prefix",),
+    "PreviewImage": (),
+}
+OUTPUT_NODES = {"SaveImage", "PreviewImage"}
+UI_ONLY_INPUTS = {"control_after_generate"}
+# UI node modes: 2 is muted (never runs), 4 is bypassed (inputs pass straight through).
+MODE_MUTED = 2
+MODE_BYPASSED = 4
+
+
+@dataclass(frozen=True)
+class NodeRef:
+    """Output `output` of node `node`, used as another node's input."""
+
+    node: str
+    output: int
+
+
+@dataclass
+class WorkflowNode:
+    id: str
+    class_type: str
+    inputs: dict[str, object]
+    title: str = ""
+
+
+@dataclass
+class WorkflowPlan:
+    """
+    The nodes a workflow needs, in execution order.
+
+    Only nodes that an output node (`SaveImage`/`PreviewImage`) depends on are
+    kept. `signatures` identifies each node by its class, its literal inputs and
+    the signatures of the nodes feeding it, so two runs of a node with the same
+    signature produce the same outputs.
+    """
+
+    nodes: list[WorkflowNode]
+    signatures: dict[str, str] = field(default_factory=dict)
+
+    def outputs(self) -> list[WorkflowNode]:
+        return [node for node in self.nodes if node.class_type in OUTPUT_NODES]
+
+
+@dataclass(frozen=True)
+class ModelSpec:
+    """A checkpoint plus the LoRAs and CLIP skip applied on top; loaded on first use."""
+
+    base_model: str
+    loras: tuple[tuple[str, str, float], ...] = ()
+    clip_skip: int | None = None
+
+
+@dataclass
+class RunContext:
+    writer: "OutputWriter"
+    out_dir: Path
+    image_format: "OutputFormat"
+    monitor: "StepMonitor | None" = None
+
+
+def load_workflow(path: str) -> dict[str, object]:
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except OSError as exc:
+        raise RuntimeError(f"Workflow file '{path}' could not be read: {exc}")
+    except ValueError as exc:
+        raise RuntimeError(f"Workflow file '{path}' is not valid JSON: {exc}")
+    if not isinstance(data, dict):
+        raise RuntimeError(f"Workflow file '{path}' must contain a JSON object")
+    return data
+
+
+def is_api_graph(data: dict[str, object]) -> bool:
+    return bool(data) and all(
+        isinstance(node, dict) and "class_type" in node for node in data.values()
+    )
+
+
+def parse_api_graph(data: dict[str, object]) -> dict[str, WorkflowNode]:
+    nodes: dict[str, WorkflowNode] = {}
+    for node_id, raw in data.items():
+        inputs: dict[str, object] = {}
+        for name, value in dict(raw.get("inputs") or {}).items():
+            if name in UI_ONLY_INPUTS:
+                continue
+            if isinstance(value, list) and len(value) == 2 and isinstance(value[1], int):
+                value = NodeRef(str(value[0]), value[1])
+            inputs[name] = value
+        meta = raw.get("_meta") or {}
+        nodes[str(node_id)] = WorkflowNode(
+            id=str(node_id),
+            class_type=str(raw["class_type"]),
+            inputs=inputs,
+            title=str(meta.get("title", "")) if isinstance(meta, dict) else "",
+        )
+    return nodes
+
+
+def parse_ui_graph(data: dict[str, object]) -> dict[str, WorkflowNode]:
+    raw_nodes = [node for node in data.get("nodes") or [] if isinstance(node, dict)]
+    # [link id, origin node, origin slot, target node, target slot, type]
+    links = {
+        link[0]: (str(link[1]), int(link[2]))
+        for link in data.get("links") or []
+        if isinstance(link, list) and len(link) >= 5
+    }
+    by_id = {str(node.get("id")): node for node in raw_nodes}
+
+    def source(link_id: object) -> NodeRef | None:
+        origin = links.get(link_id)
+        return NodeRef(*origin) if origin is not None else None
+
+    nodes: dict[str, WorkflowNode] = {}
+    forwards: dict[tuple[str, int], NodeRef | object] = {}
+    for node_id, node in by_id.items():
+        node_type = str(node.get("type", ""))
+        mode = node.get("mode", 0)
+        if mode == MODE_MUTED:
+            continue
+        widgets = node.get("widgets_values")
+        if node_type == "PrimitiveNode":
+            # A primitive feeds its value into the widget it was connected to.
+            if isinstance(widgets, list) and widgets:
+                forwards[(node_id, 0)] = widgets[0]
+            continue
+        input_list = [item for item in node.get("inputs") or [] if isinstance(item, dict)]
+        if node_type == "Reroute" or mode == MODE_BYPASSED:
+            for slot, output in enumerate(node.get("outputs") or []):
+                # Pass through the first input of the same type (any input for reroutes).
+                for item in input_list:
+                    if node_type == "Reroute" or item.get("type") == output.get("type"):
+                        ref = source(item.get("link"))
+                        if ref is not None:
+                            forwards[(node_id, slot)] = ref
+                        break
+            continue
+
+        inputs: dict[str, object] = {}
+        if isinstance(widgets, dict):
+            inputs.update(widgets)
+        elif isinstance(widgets, list):
+            names = NODE_WIDGETS.get(node_type, ())
+            inputs.update(zip(names, widgets))
+        for item in input_list:
+            ref = source(item.get("link"))
+            if ref is not None:
+                inputs[str(item.get("name"))] = ref
+        for name in UI_ONLY_INPUTS:
+            inputs.pop(name, None)
+        nodes[node_id] = WorkflowNode(
+            id=node_id,
+            class_type=node_type,
+            inputs=inputs,
+            title=str(node.get("title", "") or ""),
+        )
+
+    def follow(value: object) -> object:
+        seen = set()
+        while isinstance(value, NodeRef) and (value.node, value.output) in forwards:
+            if (value.node, value.output) in seen:
+                raise RuntimeError(f"Workflow reroute loop at node {value.node}")
+            seen.add((value.node, value.output))
+            value = forwards[(value.node, value.output)]
+        return value
+
+    for node in nodes.values():
+        node.inputs = {name: follow(value) for name, value in node.inputs.items()}
+    return nodes
+
+
+def check_node_inputs(node: WorkflowNode) -> None:
+    """
+    Rejects literal inputs the diffusers pipelines cannot honour, instead of silently
+    sampling something other than what the graph asks for.
+    """
+    inputs = node.inputs
+    try:
+        if node.class_type == "LoraLoader":
+            # Diffusers adapters carry one weight for the UNet and text encoders alike.
+            strength_model = float(inputs.get("strength_model", 1.0))
+            strength_clip = float(inputs.get("strength_clip", 1.0))
+            if strength_clip != strength_model:
+                raise RuntimeError(
+                    f"strength_clip ({strength_clip}) must equal strength_model "
+                    f"({strength_model}); one LoRA weight applies to the UNet and text encoders"
+                )
+        elif node.class_type == "KSamplerAdvanced":
+            steps = int(inputs.get("steps", 20))
+            start = int(inputs.get("start_at_step", 0))
+            end = min(int(inputs.get("end_at_step", 10000)), steps)
+            # Diffusers adds noise exactly when a stage starts from step 0, and a stage that
+            # ends early always hands on its leftover noise.
+            add_noise = "enable" if start == 0 else "disable"
+            if inputs.get("add_noise", "enable") != add_noise:
+                raise RuntimeError(f"add_noise must be '{add_noise}' when start_at_step is {start}")
+            if end < steps and inputs.get("return_with_leftover_noise", "disable") != "enable":
+                raise RuntimeError(
+                    f"return_with_leftover_noise must be 'enable' when end_at_step ({end}) "
+                    f"is before the last step ({steps})"
+                )
+    except (TypeError, ValueError, RuntimeError) as exc:
+        raise RuntimeError(f"Workflow node {node.id} ({node.class_type}): {exc}")
+
+
+def output_bytes(value: object) -> int:
+    """Memory held by a node's outputs: tensors, PIL images and containers of them."""
+    if hasattr(value, "numel") and hasattr(value, "element_size"):
+        return value.numel() * value.element_size()
+    if hasattr(value, "getbands"):
+        return value.width * value.height * len(value.getbands())
+    if isinstance(value, dict):
+        return sum(output_bytes(item) for item in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(output_bytes(item) for item in value)
+    return 0
+
+
+def node_signature(node: WorkflowNode, signatures: dict[str, str]) -> str:
+    inputs: dict[str, object] = {}
+    for name, value in node.inputs.items():
+        if isinstance(value, NodeRef):
+            inputs[name] = ["ref", signatures[value.node], value.output]
+        else:
+            inputs[name] = value
+    payload = json.dumps([node.class_type, inputs], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def compile_workflow(data: dict[str, object]) -> WorkflowPlan:
+    """
+    Compiles a ComfyUI workflow (API `prompt` format or UI `nodes`/`links` format)
+    into a topologically ordered plan.
+
+    Needs neither torch nor diffusers, so a malformed graph or an unsupported node
+    is rejected before any model is loaded.
+    """
+    if isinstance(data.get("prompt"), dict) and is_api_graph(data["prompt"]):
+        data = data["prompt"]
+    if is_api_graph(data):
+        nodes = parse_api_graph(data)
+    elif isinstance(data.get("nodes"), list):
+        nodes = parse_ui_graph(data)
+    else:
+        raise RuntimeError("Workflow must be a ComfyUI graph in API or UI format")
+
+    outputs = sorted(
+        (node_id for node_id, node in nodes.items() if node.class_type in OUTPUT_NODES),
+        key=sort_key,
+    )
+    if not outputs:
+        raise RuntimeError("Workflow has no SaveImage or PreviewImage node")
+
+    # Keep what the outputs depend on; notes, groups and dangling nodes are ignored.
+    needed: set[str] = set()
+    pending = list(outputs)
+    while pending:
+        node_id = pending.pop()
+        if node_id in needed:
+            continue
+        node = nodes.get(node_id)
+        if node is None:
+            raise RuntimeError(f"Workflow references missing or muted node {node_id}")
+        if node.class_type not in NODE_WIDGETS:
+            raise RuntimeError(
+                f"Workflow node {node_id} has unsupported type {node.class_type!r}; "
+                f"supported: {', '.join(sorted(NODE_WIDGETS))}"
+            )
+        needed.add(node_id)
+        pending.extend(value.node for value in node.inputs.values() if isinstance(value, NodeRef))
+
+    order: list[WorkflowNode] = []
+    state: dict[str, str] = {}
+
+    def visit(node_id: str) -> None:
+        if state.get(node_id) == "done":
+            return
+        if state.get(node_id) == "visiting":
+            raise RuntimeError(f"Workflow has a cycle through node {node_id}")
+        state[node_id] = "visiting"
+        node = nodes[node_id]
+        for name in sorted(node.inputs):
+            value = node.inputs[name]
+            if isinstance(value, NodeRef):
+                visit(value.node)
+        state[node_id] = "done"
+        order.append(node)
+
+    for node_id in sorted(needed, key=sort_key):
+        visit(node_id)
+    for node in order:
+        check_node_inputs(node)
+
+    plan = WorkflowPlan(nodes=order)
+    for node in order:
+        plan.signatures[node.id] = node_signature(node, plan.signatures)
+    return plan
+
+
+def sort_key(node_id: str) -> tuple[int, str]:
+    return (int(node_id), "") if node_id.isdigit() else (1 << 62, node_id)
+
+
+def check_models(plan: WorkflowPlan) -> None:
+    """
+    Resolves every literal checkpoint and LoRA name, checks each LoRA against the
+    checkpoint it is applied to and each sampler/scheduler name against the
+    registry, failing before torch is loaded.
+    """
+    from schedulers import check_scheduler
+
+    by_id = {node.id: node for node in plan.nodes}
+    checkpoints: dict[str, str] = {}
+    for node in plan.nodes:
+        ckpt_name = node.inputs.get("ckpt_name")
+        if node.class_type == "CheckpointLoaderSimple" and isinstance(ckpt_name, str):
+            checkpoints[node.id] = resolve_base_model(ckpt_name)
+        lora_name = node.inputs.get("lora_name")
+        if node.class_type.startswith("LoraLoader") and isinstance(lora_name, str):
+            repo_or_dir, weight_name = resolve_lora_values(lora_name, None)
+            # Follow the model input back through any other LoRA loaders.
+            source = node.inputs.get("model")
+            while isinstance(source, NodeRef) and by_id[source.node].class_type.startswith("LoraLoader"):
+                source = by_id[source.node].inputs.get("model")
+            if isinstance(source, NodeRef) and source.node in checkpoints:
+                check_lora_compatibility(checkpoints[source.node], [(repo_or_dir, weight_name, 1.0)])
+        if node.class_type in {"KSampler", "KSamplerAdvanced"}:
+            sampler_name = node.inputs.get("sampler_name", "euler")
+            scheduler = node.inputs.get("scheduler", "normal")
+            if isinstance(sampler_name, str) and isinstance(scheduler, str):
+                check_scheduler(sampler_name, scheduler)
+
+
+def decode_latents(pipe: "StableDiffusionXLPipeline", latents: "torch.Tensor") -> list[object]:
+    import torch
+
+    vae = pipe.vae
+    # SDXL's VAE overflows in fp16; the pipeline upcasts it for the decode as well.
+    needs_upcast = vae.dtype == torch.float16 and vae.config.force_upcast
+    if needs_upcast:
+        pipe.upcast_vae()
+    latents = latents.to(vae.device, dtype=next(iter(vae.post_quant_conv.parameters())).dtype)
+    with torch.no_grad():
+        image = vae.decode(latents / vae.config.scaling_factor, return_dict=False)[0]
+    if needs_upcast:
+        vae.to(dtype=torch.float16)
+    return pipe.image_processor.postprocess(image, output_type="pil")
+
+
+class WorkflowExecutor:
+    """
+    Runs compiled workflows, reusing node outputs from earlier runs.
+
+    A node executes only when no earlier run produced its signature, so editing
+    the seed re-runs the sampler, decode and save while the checkpoint, LoRA and
+    prompt encodes come from the cache; editing the negative prompt re-encodes
+    that prompt and re-samples. Outputs (specs, conditioning, latents, images,
+    saved paths) are kept in an LRU bounded by `max_entries` and by `max_bytes`
+    of tensor and image data; the pipelines themselves live in the PipelineCache.
+    """
+
+    HANDLERS = {
+        "CheckpointLoaderSimple": "load_checkpoint",
+        "LoraLoader": "load_lora",
+        "LoraLoaderModelOnly": "load_lora_model_only",
+        "CLIPSetLastLayer": "set_clip_skip",
+        "CLIPTextEncode": "encode_text",
+        "EmptyLatentImage": "empty_latent",
+        "KSampler": "ksampler",
+        "KSamplerAdvanced": "ksampler_advanced",
+        "VAEDecode": "vae_decode",
+        "SaveImage": "save_image",
+        "PreviewImage": "preview_image",
+    }
+
+    def __init__(
+        self,
+        pipelines: "PipelineCache",
+        device: str,
+        dtype: "torch.dtype",
+        prompt_cache: "PromptEmbeddingCache | None" = None,
+        max_entries: int = DEFAULT_MAX_ENTRIES,
+        max_bytes: int | None = DEFAULT_MAX_BYTES,
+    ):
+        self.pipelines = pipelines
+        self.device = device
+        self.dtype = dtype
+        self.prompt_cache = prompt_cache
+        self.max_entries = max(max_entries, 1)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[str, tuple[object, ...]] = OrderedDict()
+        self._sizes: dict[str, int] = {}
+
+    def _lookup(self, node: WorkflowNode, signature: str) -> tuple[object, ...] | None:
+        outputs = self._entries.get(signature)
+        if outputs is None:
+            return None
+        if node.class_type in OUTPUT_NODES and not all(Path(path).is_file() for path in outputs[0]):
+            # The saved files were removed since; save them again.
+            del self._entries[signature]
+            self._sizes.pop(signature, None)
+            return None
+        self._entries.move_to_end(signature)
+        return outputs
+
+    def total_bytes(self) -> int:
+        return sum(self._sizes.values())
+
+    def _remember(self, signature: str, outputs: tuple[object, ...]) -> None:
+        self._entries[signature] = outputs
+        self._entries.move_to_end(signature)
+        self._sizes[signature] = output_bytes(outputs)
+        while self._entries and (
+            len(self._entries) > self.max_entries
+            or (self.max_bytes is not None and self.total_bytes() > self.max_bytes)
+        ):
+            evicted, _ = self._entries.popitem(last=False)
+            self._sizes.pop(evicted, None)
+
+    def execute(
+        self,
+        plan: WorkflowPlan,
+        writer: "OutputWriter",
+        out_dir: Path,
+        image_format: "OutputFormat",
+        monitor: "StepMonitor | None" = None,
+    ) -> dict[str, object]:
+        context = RunContext(writer=writer, out_dir=out_dir, image_format=image_format, monitor=monitor)
+        cached: dict[str, tuple[object, ...]] = {}
+        for node in plan.nodes:
+            outputs = self._lookup(node, plan.signatures[node.id])
+            if outputs is not None:
+                cached[node.id] = outputs
+
+        # Walk back from the outputs: a cached node's inputs are not needed at all.
+        required = {node.id for node in plan.outputs()}
+        for node in reversed(plan.nodes):
+            if node.id in required and node.id not in cached:
+                required.update(
+                    value.node for value in node.inputs.values() if isinstance(value, NodeRef)
+                )
+
+        results: dict[str, tuple[object, ...]] = {}
+        report: list[dict[str, object]] = []
+        for node in plan.nodes:
+            if node.id not in required:
+                continue
+            if node.id in cached:
+                results[node.id] = cached[node.id]
+                self.hits += 1
+                report.append({"id": node.id, "type": node.class_type, "cached": True})
+                continue
+            self.misses += 1
+            inputs = {
+                name: results[value.node][value.output] if isinstance(value, NodeRef) else value
+                for name, value in node.inputs.items()
+            }
+            handler = getattr(self, self.HANDLERS[node.class_type])
+            try:
+                inspect.signature(handler).bind(context, **inputs)
+            except TypeError as exc:
+                raise RuntimeError(f"Workflow node {node.id} ({node.class_type}): {exc}")
+            start = time.perf_counter()
+            outputs = handler(context, **inputs)
+            results[node.id] = outputs
+            self._remember(plan.signatures[node.id], outputs)
+            report.append(
+                {
+                    "id": node.id,
+                    "type": node.class_type,
+                    "cached": False,
+                    "seconds": round(time.perf_counter() - start, 4),
+                }
+            )
+
+        images = [str(path) for node in plan.outputs() for path in results[node.id][0]]
+        return {"images": images, "nodes": report}
+
+    def stats(self) -> dict[str, object]:
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "bytes": self.total_bytes(),
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+    def _pipeline(self, model: ModelSpec) -> "StableDiffusionXLPipeline":
+        pipe, _, _ = self.pipelines.get(model.base_model, self.dtype, self.device, list(model.loras))
+        return pipe
+
+    def load_checkpoint(self, context: RunContext, ckpt_name: str) -> tuple[object, ...]:
+        spec = ModelSpec(resolve_base_model(ckpt_name))
+        return spec, spec, spec
+
+    def load_lora(
+        self,
+        context: RunContext,
+        model: ModelSpec,
+        clip: ModelSpec,
+        lora_name: str,
+        strength_model: float = 1.0,
+        strength_clip: float = 1.0,
+    ) -> tuple[object, ...]:
+        # check_node_inputs() has made sure strength_clip matches strength_model.
+        repo_or_dir, weight_name = resolve_lora_values(lora_name, None)
+        lora = (repo_or_dir, weight_name, float(strength_model))
+        model = ModelSpec(model.base_model, model.loras + (lora,), model.clip_skip)
+        clip = ModelSpec(clip.base_model, clip.loras + (lora,), clip.clip_skip)
+        return model, clip
+
+    def load_lora_model_only(
+        self, context: RunContext, model: ModelSpec, lora_name: str, strength_model: float = 1.0
+    ) -> tuple[object, ...]:
+        repo_or_dir, weight_name = resolve_lora_values(lora_name, None)
+        lora = (repo_or_dir, weight_name, float(strength_model))
+        return (ModelSpec(model.base_model, model.loras + (lora,), model.clip_skip),)
+
+    def set_clip_skip(
+        self, context: RunContext, clip: ModelSpec, stop_at_clip_layer: int = -1
+    ) -> tuple[object, ...]:
+        # ComfyUI counts from the end (-1 = last layer); diffusers counts skipped layers.
+        skip = -int(stop_at_clip_layer) - 1
+        return (ModelSpec(clip.base_model, clip.loras, skip if skip > 0 else None),)
+
+    def encode_text(self, context: RunContext, clip: ModelSpec, text: str) -> tuple[object, ...]:
+        import torch
+        from cpu_inference import autocast
+
+        pipe = self._pipeline(clip)
+        tracing.instrument_pipeline(pipe)
+        with autocast(pipe):
+            if self.prompt_cache is not None:
+                prompt_embeds, pooled = self.prompt_cache.encode(pipe, str(text), clip.clip_skip)
+            else:
+                with torch.no_grad():
+                    prompt_embeds, _, pooled, _ = pipe.encode_prompt(
+                        prompt=str(text),
+                        device=pipe._execution_device,
+                        num_images_per_prompt=1,
+                        do_classifier_free_guidance=False,
+                        clip_skip=clip.clip_skip,
+                    )
+        return ({"prompt_embeds": prompt_embeds, "pooled_prompt_embeds": pooled},)
+
+    def empty_latent(
+        self, context: RunContext, width: int = 1024, height: int = 1024, batch_size: int = 1
+    ) -> tuple[object, ...]:
+        return ({"samples": None, "width": int(width), "height": int(height), "batch_size": int(batch_size)},)
+
+    def ksampler(
+        self,
+        context: RunContext,
+        model: ModelSpec,
+        positive: dict[str, object],
+        negative: dict[str, object],
+        latent_image: dict[str, object],
+        seed: int = 0,
+        steps: int = 20,
+        cfg: float = 7.0,
+        sampler_name: str = "euler",
+        scheduler: str = "normal",
+        denoise: float = 1.0,
+    ) -> tuple[object, ...]:
+        return self._sample(
+            context, model, positive, negative, latent_image, int(seed), int(steps), float(cfg),
+            str(sampler_name), str(scheduler), denoise=float(denoise),
+        )
+
+    def ksampler_advanced(
+        self,
+        context: RunContext,
+        model: ModelSpec,
+        positive: dict[str, object],
+        negative: dict[str, object],
+        latent_image: dict[str, object],
+        add_noise: str = "enable",
+        noise_seed: int = 0,
+        steps: int = 20,
+        cfg: float = 7.0,
+        sampler_name: str = "euler",
+        scheduler: str = "normal",
+        start_at_step: int = 0,
+        end_at_step: int = 10000,
+        return_with_leftover_noise: str = "disable",
+    ) -> tuple[object, ...]:
+        # Diffusers adds noise exactly when a stage starts from step 0, which is what
+        # base -> refiner workflows ask for with add_noise enable/disable; other
+        # combinations are rejected by check_node_inputs().
+        return self._sample(
+            context, model, positive, negative, latent_image, int(noise_seed), int(steps), float(cfg),
+            str(sampler_name), str(scheduler), start=int(start_at_step), end=int(end_at_step),
+        )
+
+    def _sample(
+        self,
+        context: RunContext,
+        model: ModelSpec,
+        positive: dict[str, object],
+        negative: dict[str, object],
+        latent: dict[str, object],
+        seed: int,
+        steps: int,
+        cfg: float,
+        sampler_name: str,
+        scheduler: str,
+        denoise: float = 1.0,
+        start: int = 0,
+        end: int | None = None,
+    ) -> tuple[object, ...]:
+        import torch
+        from cpu_inference import autocast
+        from schedulers import apply_scheduler
+
+        # Each sampler node swaps in its own scheduler on the shared warm pipeline.
+        pipe = self._pipeline(model)
+        tracing.instrument_pipeline(pipe)
+        batch = int(latent["batch_size"])
+        generator_device = self.device if self.device in {"cuda", "cpu"} else "cpu"
+        generators = [
+            torch.Generator(generator_device).manual_seed(seed + index) for index in range(batch)
+        ]
+        end = steps if end is None else min(end, steps)
+        kwargs: dict[str, object] = {
+            "prompt_embeds": positive["prompt_embeds"],
+            "pooled_prompt_embeds": positive["pooled_prompt_embeds"],
+            "num_images_per_prompt": batch,
+            "num_inference_steps": steps,
+            "guidance_scale": cfg,
+            "denoising_end": end / steps if end < steps else None,
+            "generator": generators,
+            "output_type": "latent",
+        }
+        if cfg > 1.0:
+            kwargs["negative_prompt_embeds"] = negative["prompt_embeds"]
+            kwargs["negative_pooled_prompt_embeds"] = negative["pooled_prompt_embeds"]
+        if context.monitor is not None:
+            context.monitor.begin(0)
+            kwargs["callback_on_step_end"] = context.monitor
+            kwargs["callback_on_step_end_tensor_inputs"] = ["latents"]
+
+        with tracing.stage("denoise"), autocast(pipe):
+            if latent["samples"] is None:
+                apply_scheduler(pipe, sampler_name, scheduler)
+                samples = pipe(height=latent["height"], width=latent["width"], **kwargs).images
+            else:
+                stage_pipe, _ = stage_pipeline(pipe, None)
+                apply_scheduler(stage_pipe, sampler_name, scheduler)
+                tracing.instrument_pipeline(stage_pipe)
+                if start > 0:
+                    kwargs["denoising_start"] = start / steps
+                else:
+                    kwargs["strength"] = denoise
+                samples = stage_pipe(image=latent["samples"], **kwargs).images
+        return ({**latent, "samples": samples, "seed": seed},)
+
+    def vae_decode(
+        self, context: RunContext, samples: dict[str, object], vae: ModelSpec
+    ) -> tuple[object, ...]:
+        from cpu_inference import autocast
+
+        pipe = self._pipeline(vae)
+        tracing.instrument_pipeline(pipe)
+        with autocast(pipe):
+            return (decode_latents(pipe, samples["samples"]),)
+
+    def save_image(
+        self, context: RunContext, images: list[object], filename_prefix: str = "asset"
+    ) -> tuple[object, ...]:
+        with tracing.stage("save"):
+            batch = context.writer.submit(
+                images, context.out_dir, str(filename_prefix), context.image_format
+            )
+            return (batch.result(),)
+
+    def preview_image(self, context: RunContext, images: list[object]) -> tuple[object, ...]:
+        return self.save_image(context, images, "preview")
+
+
+def run_workflow(args: argparse.Namespace) -> None:
+    from main import (
+        create_cpu_options,
+        create_model_cache,
+        create_output_writer,
+        create_prompt_cache,
+        create_residency_manager,
+        create_step_monitor,
+        output_format,
+        parse_size,
+        prepare_args,
+        select_device,
+    )
+
+    with tracing.trace_job(trace_file=args.trace_file) as trace:
+        prepare_args(args)
+        if getattr(args, "enhance_prompt", False):
+            raise RuntimeError(
+                "--enhance-prompt does not apply to --workflow: prompts come from the "
+                "graph's CLIPTextEncode nodes"
+            )
+        with tracing.stage("resolve_model"):
+            plan = compile_workflow(load_workflow(args.workflow))
+            check_models(plan)
+        image_format = output_format(args)
+        device, dtype = select_device(args.device)
+
+        from pipeline_cache import PipelineCache
+
+        residency = create_residency_manager(args, device)
+        pipelines = PipelineCache(
+            max_bytes=parse_size(args.pipeline_cache_memory),
+            device=device,
+            model_cache=create_model_cache(args),
+            cpu_options=create_cpu_options(args),
+            residency=residency,
+        )
+        executor = WorkflowExecutor(pipelines, device, dtype, create_prompt_cache(args))
+        writer = create_output_writer(args)
+        try:
+            outcome = executor.execute(
+                plan,
+                writer,
+                Path(args.output_dir),
+                image_format,
+                create_step_monitor(args, args.filename_prefix),
+            )
+        finally:
+            writer.close()
+        trace.annotate("workflow", outcome["nodes"])
+        for output_path in outcome["images"]:
+            print(f"Image saved to {output_path}")
+        if residency is not None:
+            residency.report()
+    print(json.dumps(trace.record()))
+    if args.metrics_file:
+        tracing.METRICS.write(args.metrics_file)
@@ -0,0 +1,84 @@
+import argparse
+import json
+import statistics
+import time
+
+import torch
+
+from llm_prompt_enhancer import LLMPromptEnhancer
+
+
+IDEAS = [
+    "a rusty sword",
+    "a health potion with a cork stopper",
+    "a cyberpunk street samurai with a neon katana",
+    "a wooden treasure chest",
+]
+
+
+def time_prefill(enhancer, prompts, use_prefix_cache):
+    inputs = enhancer._prepare_inputs(prompts, use_prefix_cache=use_prefix_cache)
+    past = inputs.pop("past_key_values", None)
+    input_ids = inputs["input_ids"]
+    if past is not None:
+        # Only the uncached suffix goes through the model; the mask still covers the prefix.
+        input_ids = input_ids[:, past.get_seq_length() :]
+    start = time.perf_counter()
+    with torch.inference_mode():
+        enhancer.pipe.model(
+            input_ids=input_ids,
+            attention_mask=inputs["attention_mask"],
+            past_key_values=past,
+            use_cache=True,
+        )
+    return time.perf_counter() - start
+
+
+def time_first_token(enhancer, prompts, use_prefix_cache):
+    start = time.perf_counter()
+    enhancer._generate(prompts, use_prefix_cache=use_prefix_cache, max_new_tokens=1)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare prompt-enhancer prefill with and without the system-prompt KV cache."
+    )
+    parser.add_argument("--model-id", default="TinyLlama/TinyLlama-1.1B-Chat-v1.0")
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--output", default=None, help="Optional path for the JSON report.")
+    args = parser.parse_args()
+
+    enhancer = LLMPromptEnhancer(model_id=args.model_id, use_prefix_cache=True)
+    enhancer._build_prefix_cache()
+    if enhancer._prefix_cache is None:
+        raise SystemExit("Prefix cache unavailable (transformers too old or prefix not found)")
+
+    prompts = [
+        enhancer._build_prompt(IDEAS[i % len(IDEAS)], "fantasy") for i in range(args.batch_size)
+    ]
+    report = {
+        "model_id": args.model_id,
+        "device": enhancer.device,
+        "batch_size": args.batch_size,
+        "prefix_tokens": len(enhancer._prefix_ids),
+    }
+    for name, func in (("prefill_s", time_prefill), ("first_token_s", time_first_token)):
+        for use_cache in (False, True):
+            func(enhancer, prompts, use_cache)  # warm-up
+            samples = [func(enhancer, prompts, use_cache) for _ in range(args.repeats)]
+            key = f"{name}_{'cached' if use_cache else 'uncached'}"
+            report[key] = round(statistics.median(samples), 5)
+        report[f"{name}_speedup"] = round(
+            report[f"{name}_uncached"] / max(report[f"{name}_cached"], 1e-9), 2
+        )
+
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,69 @@
+import hashlib
+from threading import Thread
+
 import torch
-from transformers import pipeline
+from transformers import StoppingCriteria, StoppingCriteriaList, TextIteratorStreamer, pipeline
+
+try:
+    from transformers import DynamicCache
+except ImportError:  # transformers < 4.36
+    DynamicCache = None
+
+
+# Markers that mean the model has left its answer: a new chat turn, or a replay of the example.
+END_OF_ANSWER_MARKERS = ("<|user|>", "<|system|>", "<|assistant|>", "</s>", "Example:")
+
+
+def trim_response(text):
+    """
+    Cuts a raw completion at the first marker that starts a new turn or repeats the example.
+    """
+    cut = len(text)
+    for marker in END_OF_ANSWER_MARKERS:
+        index = text.find(marker)
+        if index != -1:
+            cut = min(cut, index)
+    lower = text.lower()
+    first_pair = lower.find("positive prompt:")
+    if first_pair != -1:
+        second_pair = lower.find("positive prompt:", first_pair + 1)
+        if second_pair != -1:
+            cut = min(cut, second_pair)
+    return text[:cut]
+
+
+def is_answer_complete(text):
+    """
+    True once a full Positive/Negative pair has been produced, or the model has moved on.
+    """
+    if trim_response(text) != text:
+        return True
+    lower = text.lower()
+    positive_at = lower.find("positive prompt:")
+    negative_at = lower.find("negative prompt:", positive_at + 1) if positive_at != -1 else -1
+    if negative_at == -1:
+        return False
+    # The negative line is finished once the model ends it with a newline.
+    line, newline, _ = text[negative_at:].partition("\n")
+    return bool(newline) and bool(line.split(":", 1)[1].strip())
+
+
+class PromptPairStoppingCriteria(StoppingCriteria):
+    """
+    Stops generation once every sequence in the batch has a complete Positive/Negative pair.
+
+    Returns a single bool rather than a per-row tensor: transformers before 4.39 only accept
+    a bool here. Rows that finish early keep sampling until the batch is done, and the extra
+    text is cut off by trim_response().
+    """
+
+    def __init__(self, tokenizer, prompt_length):
+        self.tokenizer = tokenizer
+        self.prompt_length = prompt_length
+
+    def __call__(self, input_ids, scores, **kwargs):
+        texts = self.tokenizer.batch_decode(input_ids[:, self.prompt_length :])
+        return all(is_answer_complete(text) for text in texts)
 
 
 class LLMPromptEnhancer:
@@ -14,12 +78,47 @@ class LLMPromptEnhancer:
         "signature, watermark, username, artist name"
     )
 
-    def __init__(self, model_id="TinyLlama/TinyLlama-1.1B-Chat-v1.0"):
+    # Sampling settings for every generation; part of the memo key.
+    SAMPLING_PARAMS = {
+        "max_new_tokens": 256,
+        "do_sample": True,
+        "temperature": 0.7,
+        "top_k": 50,
+        "top_p": 0.95,
+    }
+
+    def __init__(
+        self,
+        model_id="TinyLlama/TinyLlama-1.1B-Chat-v1.0",
+        batch_size=8,
+        use_prefix_cache=True,
+        memo=None,
+        seed=None,
+        residency=None,
+    ):
         """
         Initialize the LLM-based prompt enhancer using a lightweight local model.
         Args:
             model_id (str): HuggingFace model ID. Defaults to TinyLlama (1.1B parameters) for speed.
+            batch_size (int): Default number of ideas generated together by enhance_prompts().
+            use_prefix_cache (bool): Precompute the KV cache of the fixed system prompt once and
+                reuse it for every request instead of re-encoding it each time.
+            memo (PromptMemo | None): Opt-in result cache. Only seeded calls are memoized.
+            seed (int | None): Default seed. When set, each idea is sampled from its own seeded
+                RNG state so identical requests give identical (and cacheable) results.
+            residency (ResidencyManager | None): Shares a device memory budget with other models
+                in the process (e.g. SDXL). The LLM is loaded in RAM, registered as "llm" and
+                moved to the device only while it generates.
         """
+        self.model_id = model_id
+        self.batch_size = batch_size
+        self.memo = memo
+        self.seed = seed
+        self.residency = residency
+        # Part of the memo key, so editing the system prompt or chat template retires old results.
+        self.template_hash = hashlib.sha256(
+            self._build_prompt("{idea}", "{style}").encode("utf-8")
+        ).hexdigest()[:16]
         print(f"Loading LLM model: {model_id}...")
 
         # Determine device
@@ -41,27 +140,134 @@ class LLMPromptEnhancer:
             model=model_id,
             torch_dtype=dtype,
             device_map="auto"
-            if self.device != "cpu"
+            if self.device != "cpu" and residency is None
             else None,  # auto handles mps/cuda often, but explicit device might be safer for pipeline if auto fails
         )
+        if residency is not None:
+            residency.register("llm", self.pipe.model)
+        tokenizer = self.pipe.tokenizer
+        tokenizer.padding_side = "left"
+        if tokenizer.pad_token_id is None:
+            tokenizer.pad_token = tokenizer.eos_token
+
+        # Built on first use, so the LLM is not paged onto the device just to load it.
+        self.use_prefix_cache = use_prefix_cache and DynamicCache is not None
+        self._prefix_ids = None
+        self._prefix_cache = None
+        self._prefix_built = False
         print("LLM loaded successfully.")
 
-    def enhance_prompt(self, user_idea, style="cinematic"):
+    def _acquire(self):
+        # generate() creates its working tensors on the model's device, so the weights must be
+        # resident before the inputs are built, not just when forward() runs.
+        if self.residency is not None:
+            self.residency.acquire("llm")
+
+    def _build_prefix_cache(self):
         """
-        Uses the LLM to generate a detailed positive and negative prompt based on the user's idea.
+        Runs the shared `<|system|>` prefix through the model once and keeps its KV cache.
+
+        The cache is kept in host memory and copied to the model's current device per call,
+        so it never pins device memory while the model is paged out, and it stays valid when
+        the residency manager moves the model between devices.
         """
+        if self._prefix_built or not self.use_prefix_cache:
+            return
+        self._prefix_built = True
+        self._acquire()
+        tokenizer = self.pipe.tokenizer
+        model = self.pipe.model
 
-        # Construct the instruction for the LLM
-        # TinyLlama Chat format:
-        # <|system|>
-        # {system_message}
-        # </s>
-        # <|user|>
-        # {user_message}
-        # </s>
-        # <|assistant|>
+        # The prefix is whatever two unrelated requests tokenize to identically, which keeps
+        # the boundary exact even when the tokenizer merges across the system/user join.
+        first = tokenizer(self._build_prompt("a red apple", "flat"))["input_ids"]
+        second = tokenizer(self._build_prompt("castle gate at dusk", "isometric pixel art"))[
+            "input_ids"
+        ]
+        length = 0
+        while length < min(len(first), len(second)) and first[length] == second[length]:
+            length += 1
+        if length < 2:
+            return
+
+        prefix_ids = torch.tensor([first[:length]], device=model.device)
+        with torch.inference_mode():
+            outputs = model(input_ids=prefix_ids, use_cache=True)
+        past = outputs.past_key_values
+        if hasattr(past, "to_legacy_cache"):
+            past = past.to_legacy_cache()
+        self._prefix_ids = first[:length]
+        self._prefix_cache = tuple((key.to("cpu"), value.to("cpu")) for key, value in past)
 
-        system_prompt = (
+    def _prefix_past(self, batch_size, device):
+        # DynamicCache.update concatenates into new tensors, so the stored prefix is never mutated.
+        legacy = tuple(
+            (
+                key.to(device).expand(batch_size, -1, -1, -1).contiguous(),
+                value.to(device).expand(batch_size, -1, -1, -1).contiguous(),
+            )
+            for key, value in self._prefix_cache
+        )
+        return DynamicCache.from_legacy_cache(legacy)
+
+    def _prepare_inputs(self, prompts, use_prefix_cache=True):
+        """
+        Tokenizes a batch for generate(). With the prefix cache, each row is laid out as
+        [system prefix | padding | request suffix] so the cached prefix keeps positions 0..P-1
+        and only the suffix is prefilled.
+        """
+        self._acquire()
+        tokenizer = self.pipe.tokenizer
+        device = self.pipe.model.device
+
+        if use_prefix_cache:
+            self._build_prefix_cache()
+        if use_prefix_cache and self._prefix_cache is not None:
+            rows = tokenizer(prompts)["input_ids"]
+            prefix_length = len(self._prefix_ids)
+            if all(row[:prefix_length] == self._prefix_ids for row in rows):
+                suffixes = [row[prefix_length:] for row in rows]
+                width = max(len(suffix) for suffix in suffixes)
+                input_ids = []
+                attention_mask = []
+                for suffix in suffixes:
+                    pad = width - len(suffix)
+                    input_ids.append(self._prefix_ids + [tokenizer.pad_token_id] * pad + suffix)
+                    attention_mask.append([1] * prefix_length + [0] * pad + [1] * len(suffix))
+                return {
+                    "input_ids": torch.tensor(input_ids, device=device),
+                    "attention_mask": torch.tensor(attention_mask, device=device),
+                    "past_key_values": self._prefix_past(len(prompts), device),
+                }
+
+        # Left padding keeps every prompt flush against its first generated token.
+        return dict(tokenizer(prompts, return_tensors="pt", padding=True).to(device))
+
+    def _generate(self, prompts, use_prefix_cache=True, early_stopping=True, **generate_kwargs):
+        """
+        Generates one completion per prompt and returns the decoded assistant responses.
+        """
+        tokenizer = self.pipe.tokenizer
+        inputs = self._prepare_inputs(prompts, use_prefix_cache=use_prefix_cache)
+        options = {
+            **self.SAMPLING_PARAMS,
+            "num_return_sequences": 1,
+            "pad_token_id": tokenizer.pad_token_id,
+        }
+        options.update(generate_kwargs)
+        prompt_length = inputs["input_ids"].shape[1]
+        if early_stopping:
+            options["stopping_criteria"] = StoppingCriteriaList(
+                [PromptPairStoppingCriteria(tokenizer, prompt_length)]
+            )
+        with torch.inference_mode():
+            output_ids = self.pipe.model.generate(**inputs, **options)
+        new_tokens = output_ids[:, prompt_length:]
+        responses = tokenizer.batch_decode(new_tokens, skip_special_tokens=True)
+        return [trim_response(response).strip() for response in responses]
+
+    def _system_prompt(self):
+        return (
             "You are an expert AI art prompt engineer for Stable Diffusion XL. "
             "Your goal is to format the user's idea into a professional prompt WITHOUT adding unrequested content.\n"
             "RULES for Positive Prompt:\n"
@@ -80,32 +286,126 @@ class LLMPromptEnhancer:
             "Negative Prompt: low quality, worst quality, bad anatomy, bad hands, text, error, missing fingers, extra digit, fewer digits, cropped, jpeg artifacts, signature, watermark, username, artist name"
         )
 
+    def _build_prompt(self, user_idea, style):
+        # TinyLlama Chat format:
+        # <|system|>
+        # {system_message}
+        # </s>
+        # <|user|>
+        # {user_message}
+        # </s>
+        # <|assistant|>
         user_message = f"Convert this idea into a professional prompt pair.\nIdea: {user_idea}\nStyle: {style}"
+        return f"<|system|>\n{self._system_prompt()}</s>\n<|user|>\n{user_message}</s>\n<|assistant|>\n"
 
-        prompt_template = f"<|system|>\n{system_prompt}</s>\n<|user|>\n{user_message}</s>\n<|assistant|>\n"
-
-        # Generate
-        outputs = self.pipe(
-            prompt_template,
-            max_new_tokens=256,
-            do_sample=True,
-            temperature=0.7,
-            top_k=50,
-            top_p=0.95,
-            num_return_sequences=1,
-            pad_token_id=self.pipe.tokenizer.eos_token_id,
-        )
+    def enhance_prompt(self, user_idea, style="cinematic", seed=None):
+        """
+        Uses the LLM to generate a detailed positive and negative prompt based on the user's idea.
+        """
+        return self.enhance_prompts([user_idea], style=style, batch_size=1, seed=seed)[0]
+
+    def enhance_prompts(self, user_ideas, style="cinematic", batch_size=None, seed=None):
+        """
+        Enhances many ideas at once, generating up to `batch_size` sequences per forward pass.
+        Args:
+            user_ideas (list[str]): Raw ideas, e.g. one per asset of a game project.
+            style (str | list[str]): One style for every idea, or one style per idea.
+            batch_size (int): Sequences generated together. Defaults to the value given at init.
+            seed (int | None): Deterministic mode. Overrides the seed given at init; each distinct
+                idea/style pair is then generated on its own so its result does not depend on
+                its batch neighbours.
+        Returns:
+            list[dict]: {"positive", "negative"} pairs in the same order as `user_ideas`.
+        """
+        user_ideas = list(user_ideas)
+        styles = [style] * len(user_ideas) if isinstance(style, str) else list(style)
+        if len(styles) != len(user_ideas):
+            raise ValueError("style must be a string or a list with one style per idea")
+        batch_size = max(1, batch_size or self.batch_size)
+        seed = self.seed if seed is None else seed
 
-        generated_text = outputs[0]["generated_text"]
+        results = [None] * len(user_ideas)
+        keys = [None] * len(user_ideas)
+        if self.memo is not None and seed is not None:
+            for index, (idea, idea_style) in enumerate(zip(user_ideas, styles)):
+                keys[index] = self.memo.make_key(
+                    self.model_id, self.template_hash, idea, idea_style, self.SAMPLING_PARAMS, seed
+                )
+                results[index] = self.memo.get(keys[index])
+        pending = [index for index, result in enumerate(results) if result is None]
+        prompts = {index: self._build_prompt(user_ideas[index], styles[index]) for index in pending}
 
-        # Extract the assistant's response (remove the prompt part)
-        response = generated_text.split("<|assistant|>\n")[-1].strip()
+        if seed is not None:
+            # generate() samples every row from one global RNG, and padding shifts each row's
+            # logits, so a batched row would depend on its neighbours. Seeded ideas therefore
+            # run one per call; repeats of the same idea/style share that call.
+            repeats = {}
+            for index in pending:
+                repeats.setdefault(prompts[index], []).append(index)
+            for prompt, indices in repeats.items():
+                torch.manual_seed(seed)
+                result = self._parse_response(self._generate([prompt])[0])
+                for index in indices:
+                    results[index] = dict(result)
+        else:
+            # Group prompts of similar length so each batch carries as little padding as possible.
+            order = sorted(pending, key=lambda i: len(prompts[i]))
+            for start in range(0, len(order), batch_size):
+                indices = order[start : start + batch_size]
+                responses = self._generate([prompts[i] for i in indices])
+                for index, response in zip(indices, responses):
+                    results[index] = self._parse_response(response)
 
-        return self._parse_response(response)
+        for index in pending:
+            if keys[index] is not None:
+                self.memo.put(keys[index], results[index])
+        return results
 
-    def _parse_response(self, response_text):
+    def memo_stats(self):
         """
-        Parses the raw text response into a dictionary AND enforces constraints.
+        Hit/miss counters and hit rate of the result memo, or None when memoization is off.
+        """
+        return self.memo.stats() if self.memo is not None else None
+
+    def stream_enhance_prompt(self, user_idea, style="cinematic"):
+        """
+        Streams the enhancement token by token so a UI can show progress.
+        Yields dicts with the raw `text` so far, the partially parsed `positive`/`negative`
+        sections and `done`. The final item is the fully parsed, constraint-enforced result.
+        """
+        tokenizer = self.pipe.tokenizer
+        inputs = self._prepare_inputs([self._build_prompt(user_idea, style)])
+        prompt_length = inputs["input_ids"].shape[1]
+        streamer = TextIteratorStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)
+        options = {
+            **inputs,
+            **self.SAMPLING_PARAMS,
+            "pad_token_id": tokenizer.pad_token_id,
+            "streamer": streamer,
+            "stopping_criteria": StoppingCriteriaList(
+                [PromptPairStoppingCriteria(tokenizer, prompt_length)]
+            ),
+        }
+
+        def run():
+            with torch.inference_mode():
+                self.pipe.model.generate(**options)
+
+        worker = Thread(target=run, daemon=True)
+        worker.start()
+        text = ""
+        for chunk in streamer:
+            text += chunk
+            positive, negative = self._split_sections(trim_response(text))
+            yield {"text": text, "positive": positive, "negative": negative, "done": False}
+        worker.join()
+
+        result = self._parse_response(trim_response(text).strip())
+        yield {"text": text, **result, "done": True}
+
+    def _split_sections(self, response_text):
+        """
+        Splits a (possibly partial) response into raw positive and negative sections.
         """
         positive = ""
         negative = ""
@@ -127,8 +427,13 @@ class LLMPromptEnhancer:
                 negative += clean_line + " "
 
         # Clean up strings
-        positive = positive.strip()
-        negative = negative.strip()
+        return positive.strip(), negative.strip()
+
+    def _parse_response(self, response_text):
+        """
+        Parses the raw text response into a dictionary AND enforces constraints.
+        """
+        positive, negative = self._split_sections(response_text)
 
         # Fallback if parsing fails (LLM hallucination or format break)
         if not positive:
@@ -0,0 +1,131 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+
+class PromptMemo:
+    """
+    Two-tier memo of enhancement results: an in-memory LRU in front of a SQLite file.
+
+    Keys are derived from (model_id, prompt template, idea, style, sampling params, seed),
+    so a hit is only valid to reuse when generation was seeded, and editing the system
+    prompt retires every earlier entry. Entries expire after `ttl`
+    seconds (if set), and each tier is trimmed to its size limit, least recently
+    used first.
+    """
+
+    def __init__(self, path=None, max_memory_entries=1024, max_disk_entries=100_000, ttl=None):
+        """
+        Args:
+            path (str | Path | None): SQLite file for the persistent tier. Memory-only when None.
+            max_memory_entries (int): Size of the in-memory LRU.
+            max_disk_entries (int): Rows kept in SQLite before the least recently used are dropped.
+            ttl (float | None): Seconds an entry stays valid. None keeps entries until evicted.
+        """
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_entries = max_disk_entries
+        self.ttl = ttl
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        if path is not None:
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+            self._db = sqlite3.connect(str(path), check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS memo ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS memo_accessed ON memo (accessed)")
+            self._db.commit()
+
+    @staticmethod
+    def make_key(model_id, template, idea, style, sampling, seed):
+        raw = json.dumps([model_id, template, idea, style, sampling, seed], sort_keys=True)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _expired(self, created, now):
+        return self.ttl is not None and now - created > self.ttl
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, created = entry
+                if not self._expired(created, now):
+                    self._entries.move_to_end(key)
+                    self.memory_hits += 1
+                    return value
+                del self._entries[key]
+
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT value, created FROM memo WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None:
+                    value, created = json.loads(row[0]), row[1]
+                    if self._expired(created, now):
+                        self._db.execute("DELETE FROM memo WHERE key = ?", (key,))
+                    else:
+                        self._db.execute("UPDATE memo SET accessed = ? WHERE key = ?", (now, key))
+                        self._remember(key, value, created)
+                        self._db.commit()
+                        self.disk_hits += 1
+                        return value
+                    self._db.commit()
+
+            self.misses += 1
+            return None
+
+    def _remember(self, key, value, created):
+        self._entries[key] = (value, created)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_memory_entries:
+            self._entries.popitem(last=False)
+
+    def put(self, key, value):
+        now = time.time()
+        with self._lock:
+            self._remember(key, value, now)
+            if self._db is None:
+                return
+            self._db.execute(
+                "INSERT OR REPLACE INTO memo (key, value, created, accessed) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value), now, now),
+            )
+            if self.ttl is not None:
+                self._db.execute("DELETE FROM memo WHERE created < ?", (now - self.ttl,))
+            self._db.execute(
+                "DELETE FROM memo WHERE key IN ("
+                "SELECT key FROM memo ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+                (self.max_disk_entries,),
+            )
+            self._db.commit()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            disk_entries = 0
+            if self._db is not None:
+                disk_entries = self._db.execute("SELECT COUNT(*) FROM memo").fetchone()[0]
+            return {
+                "memory_entries": len(self._entries),
+                "disk_entries": disk_entries,
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+            }
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
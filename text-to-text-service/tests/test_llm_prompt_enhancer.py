@@ -0,0 +1,48 @@
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+from llm_prompt_enhancer import (  # noqa: E402
+    PromptPairStoppingCriteria,
+    is_answer_complete,
+    trim_response,
+)
+
+PAIR = "Positive Prompt: a red apple, masterpiece\nNegative Prompt: blurry\n"
+
+
+def test_trim_response_cuts_at_turn_markers_and_repeats():
+    assert trim_response(PAIR) == PAIR
+    assert trim_response(PAIR + "<|user|>\nnext idea") == PAIR
+    assert trim_response(PAIR + "Example:\nPositive Prompt: a samurai") == PAIR
+    assert trim_response(PAIR + "positive prompt: again") == PAIR
+    assert trim_response("Positive Prompt: x</s>trailing") == "Positive Prompt: x"
+
+
+def test_is_answer_complete_waits_for_the_negative_line():
+    assert not is_answer_complete("Positive Prompt: a red apple")
+    assert not is_answer_complete("Positive Prompt: a red apple\nNegative Prompt: blur")
+    assert not is_answer_complete("Positive Prompt: a red apple\nNegative Prompt:\n")
+    assert is_answer_complete(PAIR)
+    assert is_answer_complete("Positive Prompt: a red apple<|user|>")
+    # A negative line without a positive one does not count as a pair.
+    assert not is_answer_complete("Negative Prompt: blurry\n")
+
+
+class FakeTokenizer:
+    def __init__(self, texts):
+        self.texts = texts
+
+    def batch_decode(self, ids):
+        return self.texts
+
+
+def test_stopping_criteria_waits_for_every_row():
+    import torch
+
+    ids = torch.zeros((2, 4), dtype=torch.long)
+    waiting = PromptPairStoppingCriteria(FakeTokenizer([PAIR, "Positive Prompt: x"]), 2)
+    done = PromptPairStoppingCriteria(FakeTokenizer([PAIR, PAIR]), 2)
+    assert waiting(ids, None) is False
+    assert done(ids, None) is True
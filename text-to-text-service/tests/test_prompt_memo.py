@@ -0,0 +1,89 @@
+import threading
+import time
+
+from prompt_memo import PromptMemo
+
+
+def key(idea, seed=1, template="v1"):
+    return PromptMemo.make_key(
+        "tinyllama", template, idea, "cinematic", {"temperature": 0.7}, seed
+    )
+
+
+def test_keys_cover_every_input():
+    assert key("chest") == key("chest")
+    assert key("chest") != key("sword")
+    assert key("chest", seed=1) != key("chest", seed=2)
+    assert key("chest", template="v1") != key("chest", template="v2")
+
+
+def test_memory_tier_is_lru():
+    memo = PromptMemo(max_memory_entries=2)
+    for idea in ("a", "b"):
+        memo.put(key(idea), {"positive": idea})
+    assert memo.get(key("a")) == {"positive": "a"}
+    memo.put(key("c"), {"positive": "c"})
+    assert memo.get(key("b")) is None
+    assert memo.get(key("a")) is not None
+    assert memo.stats()["memory_hits"] == 2 and memo.stats()["misses"] == 1
+
+
+def test_disk_tier_survives_restart(tmp_path):
+    path = tmp_path / "memo" / "prompts.sqlite"
+    memo = PromptMemo(path)
+    memo.put(key("chest"), {"positive": "a wooden chest", "negative": "blurry"})
+    memo.close()
+
+    reopened = PromptMemo(path)
+    assert reopened.get(key("chest")) == {"positive": "a wooden chest", "negative": "blurry"}
+    assert reopened.get(key("chest")) is not None
+    stats = reopened.stats()
+    assert (stats["disk_hits"], stats["memory_hits"], stats["disk_entries"]) == (1, 1, 1)
+    reopened.close()
+
+
+def test_disk_tier_is_trimmed_least_recently_used(tmp_path):
+    memo = PromptMemo(tmp_path / "prompts.sqlite", max_memory_entries=1, max_disk_entries=2)
+    memo.put(key("a"), "a")
+    time.sleep(0.01)
+    memo.put(key("b"), "b")
+    time.sleep(0.01)
+    assert memo.get(key("a")) == "a"
+    time.sleep(0.01)
+    memo.put(key("c"), "c")
+    assert memo.stats()["disk_entries"] == 2
+    assert memo.get(key("b")) is None
+    assert memo.get(key("a")) == "a"
+    memo.close()
+
+
+def test_expired_entries_are_misses(tmp_path):
+    memo = PromptMemo(tmp_path / "prompts.sqlite", ttl=0.05)
+    memo.put(key("chest"), "value")
+    assert memo.get(key("chest")) == "value"
+    time.sleep(0.1)
+    assert memo.get(key("chest")) is None
+    assert memo.stats()["disk_entries"] == 0
+    memo.close()
+
+
+def test_concurrent_access(tmp_path):
+    memo = PromptMemo(tmp_path / "prompts.sqlite", max_memory_entries=8)
+    errors = []
+
+    def work(offset):
+        try:
+            for index in range(50):
+                memo.put(key(f"{offset}-{index}"), index)
+                assert memo.get(key(f"{offset}-{index}")) == index
+        except BaseException as exc:
+            errors.append(exc)
+
+    threads = [threading.Thread(target=work, args=(offset,)) for offset in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert memo.stats()["disk_entries"] == 200
+    memo.close()